@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+import math
+import numpy as np
+from qgis.core import QgsGeometry, QgsRectangle, QgsSpatialIndex, QgsCoordinateTransform, QgsWkbTypes
+from .cellstore import UnionFind
+
+class AoiIndex():
+    """The AoI geometries in the CRS of the grid, with a spatial index over their bounding
+    boxes and prepared geometries for the exact tests.
+
+    Geometries with more than maxVertices vertices are subdivided into pieces with at most
+    maxVertices vertices, and the pieces are indexed and tested instead, so each test only
+    touches a few hundred vertices of a detailed AoI (e.g. a coastline). With a simplification
+    tolerance, the geometries are first simplified outward (the simplified geometry contains
+    the original one), so no sheet is deleted that intersects the original AoI.
+    """
+
+    # Segments per quarter circle of the buffers around simplified geometries
+    BUFFER_SEGMENTS = 8
+
+    def __init__(self,aoiLayer,crs,transformContext,maxVertices=256,simplifyTolerance=0):
+        self.geometries = {}
+        self.pieces = []
+        self.owners = []
+        self.index = QgsSpatialIndex()
+        self.engines = {}
+        self.maxVertices = maxVertices
+        self.parts = None
+        self.ringsAndPaths = None
+
+        transform = None
+        if aoiLayer.crs() != crs:
+            transform = QgsCoordinateTransform(aoiLayer.crs(), crs, transformContext)
+
+        for f in aoiLayer.getFeatures():
+            geom = f.geometry()
+            if geom.isNull() or geom.isEmpty():
+                continue
+            if transform is not None:
+                geom.transform(transform)
+            if simplifyTolerance > 0:
+                geom = self.simplifyOutward(geom,simplifyTolerance)
+            self.geometries[f.id()] = geom
+            for piece in self.subdivide(geom,maxVertices):
+                self.index.addFeature(len(self.pieces), piece.boundingBox())
+                self.pieces.append(piece)
+                self.owners.append(f.id())
+
+    def __len__(self):
+        return len(self.geometries)
+
+    @classmethod
+    def simplifyOutward(cls,geom,tolerance):
+        # Douglas-Peucker keeps the simplified geometry within the tolerance of the original, so the simplified
+        # geometry buffered by the tolerance contains the original. The buffer distance is increased, so the
+        # straight segments of the buffer arcs stay outside the true offset curve
+        distance = tolerance / math.cos(math.pi / (4 * cls.BUFFER_SEGMENTS))
+        parts = []
+        for part in geom.asGeometryCollection():
+            simplified = part.simplify(tolerance)
+            if simplified.isNull() or simplified.isEmpty():
+                # Parts smaller than the tolerance may collapse, and are kept as they are
+                parts.append(part)
+            else:
+                parts.append(simplified.buffer(distance, cls.BUFFER_SEGMENTS))
+        return QgsGeometry.collectGeometry(parts)
+
+    @staticmethod
+    def subdivide(geom,maxVertices):
+        if geom.constGet().nCoordinates() <= maxVertices:
+            return [geom]
+        return geom.subdivide(maxVertices).asGeometryCollection()
+
+    def engine(self,piece):
+        # Pieces are prepared the first time they are tested
+        engine = self.engines.get(piece)
+        if engine is None:
+            engine = QgsGeometry.createGeometryEngine(self.pieces[piece].constGet())
+            engine.prepareGeometry()
+            self.engines[piece] = engine
+        return engine
+
+    def candidates(self,xmin,ymin,xmax,ymax):
+        return self.index.intersects(QgsRectangle(float(xmin), float(ymin), float(xmax), float(ymax)))
+
+    def intersectsRect(self,xmin,ymin,xmax,ymax):
+        candidates = self.candidates(xmin, ymin, xmax, ymax)
+        if not candidates:
+            return False
+        rect = QgsGeometry.fromRect(QgsRectangle(float(xmin), float(ymin), float(xmax), float(ymax)))
+        for piece in candidates:
+            if self.engine(piece).intersects(rect.constGet()):
+                return True
+        return False
+
+    def isPolygonal(self):
+        return all(piece.type() == QgsWkbTypes.GeometryType.PolygonGeometry for piece in self.pieces)
+
+    def clippedArea(self,xmin,ymin,xmax,ymax):
+        """Returns the area of the polygon parts of the AoI within a rectangle. Only the pieces found
+        through the spatial index are clipped. Pieces of the same AoI feature do not overlap, so their
+        areas are summed, while the pieces of different features are dissolved first."""
+        rect = QgsRectangle(float(xmin), float(ymin), float(xmax), float(ymax))
+        clipped = {}
+        for piece in self.candidates(xmin, ymin, xmax, ymax):
+            if self.pieces[piece].type() != QgsWkbTypes.GeometryType.PolygonGeometry:
+                continue
+            part = self.pieces[piece].clipped(rect)
+            if not part.isNull() and not part.isEmpty():
+                clipped.setdefault(self.owners[piece], []).append(part)
+        if len(clipped) > 1:
+            return QgsGeometry.unaryUnion([part for parts in clipped.values() for part in parts]).area()
+        return sum(part.area() for parts in clipped.values() for part in parts)
+
+    def clip(self,xmin,ymin,xmax,ymax):
+        """Returns the polygon parts of the AoI within a rectangle, dissolved into one geometry, or None if
+        there are none. Only the pieces found through the spatial index are clipped."""
+        rect = QgsRectangle(float(xmin), float(ymin), float(xmax), float(ymax))
+        parts = []
+        for piece in self.candidates(xmin, ymin, xmax, ymax):
+            if self.pieces[piece].type() != QgsWkbTypes.GeometryType.PolygonGeometry:
+                continue
+            part = self.pieces[piece].clipped(rect)
+            if not part.isNull() and not part.isEmpty():
+                parts.append(part)
+        if not parts:
+            return None
+        return QgsGeometry.unaryUnion(parts)
+
+    def rings(self):
+        """Returns the rings of all polygon parts as (part number, x, y) and the vertices of all line
+        and point parts as (x, y), with the vertex coordinates as NumPy arrays. The result is computed once."""
+        if self.ringsAndPaths is None:
+            self.ringsAndPaths = self.partRings([part for geom in self.geometries.values() for part in geom.asGeometryCollection()])
+        return self.ringsAndPaths
+
+    @staticmethod
+    def partRings(parts):
+        # The rings and paths (see rings) of a list of single-part geometries
+        (rings,paths) = ([], [])
+        for (partNo,part) in enumerate(parts):
+            abstract = part.constGet()
+            if abstract.hasCurvedSegments():
+                abstract = abstract.segmentize()
+            if part.type() == QgsWkbTypes.GeometryType.PolygonGeometry:
+                ringList = [abstract.exteriorRing()] + [abstract.interiorRing(k) for k in range(abstract.numInteriorRings())]
+                for ring in ringList:
+                    if ring is not None and ring.numPoints() > 1:
+                        rings.append((partNo, np.array(ring.xVector()), np.array(ring.yVector())))
+            elif part.type() == QgsWkbTypes.GeometryType.LineGeometry:
+                paths.append((np.array(abstract.xVector()), np.array(abstract.yVector())))
+            else:
+                point = part.asPoint()
+                paths.append((np.array([point.x()]), np.array([point.y()])))
+        return (rings,paths)
+
+    def clusters(self,distance):
+        """Groups the AoI parts into clusters of parts closer than the given distance to each other
+        (measured between bounding boxes, directly or through other parts) and returns the bounding
+        box of each cluster."""
+        boxes = [part.boundingBox() for geom in self.geometries.values() for part in geom.asGeometryCollection()]
+        boxIndex = QgsSpatialIndex()
+        for (k,box) in enumerate(boxes):
+            boxIndex.addFeature(k, box)
+
+        unionFind = UnionFind(len(boxes))
+        for (k,box) in enumerate(boxes):
+            for other in boxIndex.intersects(box.buffered(distance)):
+                unionFind.union(k, other)
+
+        clusters = {}
+        for (k,label) in enumerate(unionFind.labels()):
+            if label in clusters:
+                clusters[label].combineExtentWith(boxes[k])
+            else:
+                clusters[label] = QgsRectangle(boxes[k])
+        return list(clusters.values())
+
+    def connectedParts(self):
+        """Splits the AoI geometries into their single parts and finds the groups of parts that
+        touch or intersect each other (directly or through other parts).
+
+        Only parts with intersecting bounding boxes (found through a spatial index) are tested
+        exactly, and no union geometry is built. Returns the parts, subdivided into pieces with at
+        most maxVertices vertices, and a group label for each piece. The result is computed once.
+        """
+        if self.parts is not None:
+            return self.parts
+        parts = []
+        for geom in self.geometries.values():
+            parts.extend(geom.asGeometryCollection())
+
+        partIndex = QgsSpatialIndex()
+        for (k,part) in enumerate(parts):
+            partIndex.addFeature(k, part.boundingBox())
+
+        unionFind = UnionFind(len(parts))
+        for (k,part) in enumerate(parts):
+            engine = None
+            for other in partIndex.intersects(part.boundingBox()):
+                # Each pair is only tested once, and not if the parts are already connected
+                if other <= k or unionFind.find(other) == unionFind.find(k):
+                    continue
+                if engine is None:
+                    engine = QgsGeometry.createGeometryEngine(part.constGet())
+                    engine.prepareGeometry()
+                if engine.intersects(parts[other].constGet()):
+                    unionFind.union(k, other)
+
+        (pieces,groups) = ([], [])
+        for (part,group) in zip(parts,unionFind.labels()):
+            for piece in self.subdivide(part,self.maxVertices):
+                pieces.append(piece)
+                groups.append(group)
+        self.parts = (pieces, groups)
+        return self.parts
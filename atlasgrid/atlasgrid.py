@@ -22,15 +22,16 @@
  ***************************************************************************/
 """
 import os.path
-from qgis.PyQt.QtCore import Qt, QSettings, QTranslator, QCoreApplication
+from qgis.PyQt.QtCore import QSettings, QTranslator, QCoreApplication
 from qgis.PyQt.QtGui import QIcon
-from qgis.PyQt.QtWidgets import QAction, QApplication
-from qgis.core import Qgis, QgsApplication, QgsProject, QgsFeature
-from qgis import processing
+from qgis.PyQt.QtWidgets import QAction
+from qgis.core import Qgis, QgsApplication
 from .grid import GridCreator
+from .atlasgrid_task import AtlasGridTask
 
 # Import the code for the processing plugin
 from .atlasgrid_provider import AtlasGridProvider
+from .expressions import registerFunctions, unregisterFunctions
 # Import the code for the dialog
 from .atlasgrid_dialog import AtlasGridDialog
 # Initialize Qt resources from file resources.py
@@ -70,6 +71,8 @@ class AtlasGrid:
         # Declare instance attributes
         self.actions = []
         self.menu = self.tr(u'&AtlasGrid')
+        # Running grid tasks (references are kept while the tasks are running)
+        self.tasks = []
         
 
         # Check if plugin was started the first time in current QGIS session
@@ -167,8 +170,9 @@ class AtlasGrid:
         return action
 
     def initGui(self):
-        # Add provider
-        QgsApplication.processingRegistry().addProvider(self.provider)
+        # Add provider and expression functions (initProcessing is only called by QGIS for plugins
+        # with hasProcessingProvider=yes)
+        self.initProcessing()
 
         """Create the menu entries and toolbar icons inside the QGIS GUI."""
         icon_path = ':/plugins/atlasgrid/atlasgrid.png'
@@ -183,9 +187,11 @@ class AtlasGrid:
 
     def initProcessing(self):
         QgsApplication.processingRegistry().addProvider(self.provider)
+        registerFunctions()
 
     def unload(self):
         QgsApplication.processingRegistry().removeProvider(self.provider)
+        unregisterFunctions()
         """Removes the plugin menu item and icon from QGIS GUI."""
         for action in self.actions:
             self.iface.removePluginMenu(
@@ -217,12 +223,22 @@ class AtlasGrid:
         result = self.dlg.exec()
         # See if OK was pressed
         if result:
-            try:
-                QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
-                gridLayer = self.gridCreator.createGrid(self.dlg.mapScale,self.dlg.gridExtent,self.dlg.rwDimensions,self.dlg.nRowsAndCols,self.dlg.chkboxDeleteNonIntersecting.isChecked(),self.dlg.cmbAOILayer.currentLayer())
-                QgsProject.instance().addMapLayer(gridLayer)
-
-            finally:
-                QApplication.restoreOverrideCursor()
+            # Create the grid in the background, the layer is added to the project when the task finishes
+            task = AtlasGridTask(self.gridCreator.crs,self.dlg.mapScale,self.dlg.gridExtent,self.dlg.rwDimensions,self.dlg.nRowsAndCols,self.dlg.chkboxDeleteNonIntersecting.isChecked(),self.dlg.cmbAOILayer.currentLayer())
+            task.taskCompleted.connect(lambda: self.taskDone(task))
+            task.taskTerminated.connect(lambda: self.taskFailed(task))
+            self.tasks.append(task)
+            QgsApplication.taskManager().addTask(task)
+
+    def taskDone(self, task):
+        self.tasks.remove(task)
+        self.iface.messageBar().pushSuccess("AtlasGrid", self.tr(u'Grid created'))
+
+    def taskFailed(self, task):
+        self.tasks.remove(task)
+        if task.exception is not None:
+            self.iface.messageBar().pushCritical("AtlasGrid", self.tr(u'Creating grid failed: {}').format(task.exception))
+        else:
+            self.iface.messageBar().pushInfo("AtlasGrid", self.tr(u'Creating grid was canceled'))
             
             
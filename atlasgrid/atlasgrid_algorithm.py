@@ -2,22 +2,33 @@
 
 from qgis.PyQt.QtGui import QIcon
 from qgis.core import (
+    QgsProcessing,
     QgsProcessingAlgorithm,
     QgsProcessingParameterVectorLayer,
     QgsProcessingParameterLayout,
     QgsProcessingParameterLayoutItem,
     QgsProcessingParameterNumber,
     QgsProcessingParameterBoolean,
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterString,
+    QgsProcessingException,
     QgsProcessingParameterExtent,
     QgsProcessingParameterCrs,
     QgsProcessingParameterFeatureSink,
+    QgsProcessingParameterFileDestination,
+    QgsProcessingOutputNumber,
     QgsFeatureSink,
     QgsLayoutItemRegistry,
     QgsCoordinateTransform,
-    QgsProject
+    QgsFeatureRequest,
+    QgsProcessingUtils,
+    QgsVectorDataProvider
 )
-from qgis.utils import iface
 from .grid import GridCreator
+from .cellstore import SHEET_ORDERS
+from .gridlayer import storeLattice
+from .profiler import Profiler
+from .memorytracker import MB
 
 class AtlasGridProcessingAlgorithm(QgsProcessingAlgorithm):
 
@@ -33,7 +44,25 @@ class AtlasGridProcessingAlgorithm(QgsProcessingAlgorithm):
     AOI = 'AOI'
     EXTENT = 'EXTENT'
     CRS = 'CRS'
+    NEIGHBOURFIELDS = 'NEIGHBOURFIELDS'
+    SHEETORDER = 'SHEETORDER'
+    PRINTORDERFIELD = 'PRINTORDERFIELD'
+    APPROXIMATE = 'APPROXIMATE'
+    PIXELSIZE = 'PIXELSIZE'
+    COMPAREEXACT = 'COMPAREEXACT'
+    SIMPLIFY = 'SIMPLIFY'
+    SUBDIVISIONS = 'SUBDIVISIONS'
+    CLUSTERGRIDS = 'CLUSTERGRIDS'
+    CLUSTERDISTANCE = 'CLUSTERDISTANCE'
+    COVERAGE = 'COVERAGE'
+    MINCOVERAGE = 'MINCOVERAGE'
     OUTPUT = 'OUTPUT'
+    ADJACENCY = 'ADJACENCY'
+    MASKS = 'MASKS'
+    PROFILE = 'PROFILE'
+    TRACKMEMORY = 'TRACKMEMORY'
+    PEAKMEMORY = 'PEAKMEMORY'
+    PEAKRSS = 'PEAKRSS'
 
     def initAlgorithm(self, config=None):
         self.addParameter(
@@ -71,48 +100,237 @@ class AtlasGridProcessingAlgorithm(QgsProcessingAlgorithm):
         )
         self.addParameter(
             QgsProcessingParameterCrs(self.CRS, 'Output CRS'
-                ,defaultValue=iface.mapCanvas().mapSettings().destinationCrs()
+                ,defaultValue='ProjectCrs'
             )
         )
+        self.addParameter(
+            QgsProcessingParameterBoolean(self.NEIGHBOURFIELDS, 'Add fields with names of adjoining sheets',False)
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(self.SHEETORDER, 'Sheet order',
+                options=['Row by row (west to east)', 'Serpentine (alternating direction)', 'Hilbert curve', 'Z-order curve'],
+                defaultValue=0)
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(self.PRINTORDERFIELD, 'Write sheet order to a print_order field (cellnum is numbered row by row)',False)
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(self.APPROXIMATE, 'Approximate classification of sheets (fast, may keep a few extra sheets)',False)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.PIXELSIZE, 'Pixel size for approximate classification (0 = half the sheet size)',
+                type=QgsProcessingParameterNumber.Type.Double,
+                defaultValue=0,
+                minValue=0)
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(self.COMPAREEXACT, 'Report the number of sheets classified differently in exact mode',False)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.SIMPLIFY, 'Simplification tolerance for the AoI (0 = no simplification)',
+                type=QgsProcessingParameterNumber.Type.Double,
+                defaultValue=0,
+                minValue=0)
+        )
+        self.addParameter(
+            QgsProcessingParameterString(self.SUBDIVISIONS, 'Nested levels - subdivision of each level, e.g. 2,2 (empty = single grid)',
+                defaultValue='',
+                optional=True)
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(self.CLUSTERGRIDS, 'Create a separate grid for each cluster of the AoI',False)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.CLUSTERDISTANCE, 'Minimum distance between clusters (0 = the sheet size)',
+                type=QgsProcessingParameterNumber.Type.Double,
+                defaultValue=0,
+                minValue=0)
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(self.COVERAGE, 'Write the AoI coverage of the sheets to coverage fields',False)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.MINCOVERAGE, 'Minimum AoI coverage of sheets (in %, 0 = keep all sheets)',
+                type=QgsProcessingParameterNumber.Type.Double,
+                defaultValue=0,
+                minValue=0,
+                maxValue=100)
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(self.TRACKMEMORY, 'Report the memory use of each stage',False)
+        )
         self.addParameter(
             QgsProcessingParameterFeatureSink(self.OUTPUT,'AtlasGrid')
         )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(self.ADJACENCY,'Adjacency table',
+                type=QgsProcessing.SourceType.TypeVector,
+                optional=True,
+                createByDefault=False)
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(self.MASKS,'Masks (sheets outside the AoI)',
+                type=QgsProcessing.SourceType.TypeVectorPolygon,
+                optional=True,
+                createByDefault=False)
+        )
+        self.addParameter(
+            QgsProcessingParameterFileDestination(self.PROFILE,'Profile of the run',
+                fileFilter='Profile statistics (*.pstats)',
+                optional=True,
+                createByDefault=False)
+        )
+        self.addOutput(
+            QgsProcessingOutputNumber(self.PEAKMEMORY, 'Peak of Python allocations (MB)')
+        )
+        self.addOutput(
+            QgsProcessingOutputNumber(self.PEAKRSS, 'Peak resident memory of the process (MB)')
+        )
 
-    def processAlgorithm(self, parameters, context, feedback):
+    def prepareAlgorithm(self, parameters, context, feedback):
+        # Layouts and project layers belong to the main thread, so everything needed from
+        # them is copied here (prepareAlgorithm always runs in the main thread)
+        self.dest_id = None
         layout = self.parameterAsLayout(parameters, self.LAYOUT, context)
         mapitem = self.parameterAsLayoutItem(parameters, self.MAPITEM, context, layout)
+        if mapitem is None:
+            feedback.reportError('Map item not found in print layout', fatalError=True)
+            return False
+        self.mapScale = mapitem.scale()
+        self.atlasCellSize = mapitem.sizeWithUnits()
+
+        aoiLayer = self.parameterAsVectorLayer(parameters, self.AOI, context)
+        self.aoiLayer = aoiLayer.materialize(QgsFeatureRequest().setFilterFids(aoiLayer.allFeatureIds()))
+        return True
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # With a profile destination, the run is profiled with cProfile, and a summary of the hottest
+        # functions is written next to the profile and to the log
+        profilePath = None
+        if parameters.get(self.PROFILE) is not None:
+            profilePath = self.parameterAsFileOutput(parameters, self.PROFILE, context)
+        with Profiler(profilePath) as profiler:
+            results = self.createAtlasGrid(parameters, context, feedback)
+        if profiler.profiled():
+            feedback.pushInfo('Profile written to {} (summary in {})'.format(profilePath, profiler.summaryPath()))
+            feedback.pushDebugInfo(profiler.summary())
+            results[self.PROFILE] = profilePath
+        elif profilePath:
+            feedback.pushWarning('The run was not profiled, as another run was being profiled')
+        return results
+
+    def createAtlasGrid(self, parameters, context, feedback):
         horzOverlap = self.parameterAsInt(parameters, self.HORZOVERLAP, context)
         vertOverlap = self.parameterAsInt(parameters, self.VERTOVERLAP, context)
         deleteNonIntersects = self.parameterAsBoolean(parameters, self.DELETENONINTERSECTS, context)
-        aoiLayer = self.parameterAsVectorLayer(parameters, self.AOI, context)
+        neighbourFields = self.parameterAsBoolean(parameters, self.NEIGHBOURFIELDS, context)
+        adjacencyTable = parameters.get(self.ADJACENCY) is not None
+        masks = parameters.get(self.MASKS) is not None
+        sheetOrder = SHEET_ORDERS[self.parameterAsEnum(parameters, self.SHEETORDER, context)]
+        printOrderField = self.parameterAsBoolean(parameters, self.PRINTORDERFIELD, context)
+        approximate = self.parameterAsBoolean(parameters, self.APPROXIMATE, context)
+        pixelSize = self.parameterAsDouble(parameters, self.PIXELSIZE, context)
+        compareExact = self.parameterAsBoolean(parameters, self.COMPAREEXACT, context)
+        simplifyTolerance = self.parameterAsDouble(parameters, self.SIMPLIFY, context)
+        subdivisions = self.parameterAsString(parameters, self.SUBDIVISIONS, context).replace(';', ',')
+        try:
+            subdivisions = [int(n) for n in subdivisions.split(',') if n.strip()]
+        except ValueError:
+            raise QgsProcessingException('The subdivisions must be integers separated by commas')
+        if any(n < 2 for n in subdivisions):
+            raise QgsProcessingException('Each level must subdivide the sheets into at least 2 x 2 sheets')
+        clusterGrids = self.parameterAsBoolean(parameters, self.CLUSTERGRIDS, context)
+        clusterDistance = self.parameterAsDouble(parameters, self.CLUSTERDISTANCE, context)
+        coverage = self.parameterAsBoolean(parameters, self.COVERAGE, context)
+        trackMemory = self.parameterAsBoolean(parameters, self.TRACKMEMORY, context)
+        minCoverage = self.parameterAsDouble(parameters, self.MINCOVERAGE, context)
+        aoiLayer = self.aoiLayer
         crs = self.parameterAsCrs(parameters, self.CRS, context)
         extent = self.parameterAsExtent(parameters, self.EXTENT, context)
         
         if aoiLayer.crs() != crs:
             # Transform the extent
-            transform = QgsCoordinateTransform(aoiLayer.crs(), crs, QgsProject.instance())
+            transform = QgsCoordinateTransform(aoiLayer.crs(), crs, context.transformContext())
             extent = transform.transformBoundingBox(extent)
 
         gridCreator = GridCreator()
         # Set default CRS and extent and initialize the GridCreator object
         gridCreator.setFeedback(feedback)
+        gridCreator.setContext(context)
         gridCreator.setCRS(crs.authid())
-        mapScale = mapitem.scale()
-        atlasCellSize = mapitem.sizeWithUnits()
+        gridCreator.setNeighbourFields(neighbourFields)
+        gridCreator.setAdjacencyTable(adjacencyTable)
+        gridCreator.setMasks(masks)
+        gridCreator.setTrackMemory(trackMemory)
+        gridCreator.setSheetOrder(sheetOrder,printOrderField)
+        gridCreator.setApproximate(approximate,pixelSize,compareExact)
+        gridCreator.setSimplifyTolerance(simplifyTolerance)
+        gridCreator.setSubdivisions(subdivisions)
+        gridCreator.setClusterGrids(clusterGrids,clusterDistance)
+        gridCreator.setCoverage(coverage,minCoverage / 100)
+        mapScale = self.mapScale
+        atlasCellSize = self.atlasCellSize
 
         (rwDimensions,nRowsAndCols,gridExtent) = gridCreator.calcGridMetrics(mapScale,extent,atlasCellSize,horzOverlap,vertOverlap)
         
         gridLayer = gridCreator.createGrid(
                         mapScale,gridExtent,rwDimensions,nRowsAndCols,deleteNonIntersects,aoiLayer)
+        if gridLayer is None:
+            # Canceled by the user
+            return {}
 
         (sink, dest_id) = self.parameterAsSink(parameters,
                         self.OUTPUT,context,gridLayer.fields(),gridLayer.wkbType(),gridLayer.sourceCrs())
         
+        # Features are added in cellnum order
         for current, feature in enumerate(gridLayer.getFeatures()):
             # Add a feature to the sink
             sink.addFeature(feature, QgsFeatureSink.Flag.FastInsert)
 
-        return {self.OUTPUT: dest_id}
+        self.dest_id = dest_id
+        # Levels of a nested series and cluster grids have different lattices, so no lattice is stored with them
+        self.lattice = None if subdivisions or clusterGrids else gridCreator.lattice
+        results = {self.OUTPUT: dest_id}
+        if trackMemory:
+            peakRss = gridCreator.memoryTracker.peakRss()
+            results[self.PEAKMEMORY] = gridCreator.memoryTracker.peakPython() / MB
+            results[self.PEAKRSS] = None if peakRss is None else peakRss / MB
+
+        if adjacencyTable:
+            adjacencyLayer = gridCreator.adjacencyLayer
+            (adjacencySink, adjacency_id) = self.parameterAsSink(parameters,
+                            self.ADJACENCY,context,adjacencyLayer.fields(),adjacencyLayer.wkbType(),gridLayer.sourceCrs())
+            for feature in adjacencyLayer.getFeatures():
+                adjacencySink.addFeature(feature, QgsFeatureSink.Flag.FastInsert)
+            results[self.ADJACENCY] = adjacency_id
+
+        if masks:
+            maskLayer = gridCreator.maskLayer
+            (maskSink, mask_id) = self.parameterAsSink(parameters,
+                            self.MASKS,context,maskLayer.fields(),maskLayer.wkbType(),gridLayer.sourceCrs())
+            for feature in maskLayer.getFeatures():
+                maskSink.addFeature(feature, QgsFeatureSink.Flag.FastInsert)
+            results[self.MASKS] = mask_id
+
+        return results
+
+    def postProcessAlgorithm(self, context, feedback):
+        # Create a spatial index on the output layer, if its provider supports it (e.g. shapefiles
+        # and memory layers - GeoPackages are indexed by OGR when written)
+        if self.dest_id is None:
+            return {}
+        layer = QgsProcessingUtils.mapLayerFromString(self.dest_id, context)
+        if layer is not None:
+            if self.lattice is not None:
+                storeLattice(layer,self.lattice)
+            provider = layer.dataProvider()
+            if provider.capabilities() & QgsVectorDataProvider.Capability.CreateSpatialIndex:
+                provider.createSpatialIndex()
+            # Index the integer identifiers in file outputs, so joins on them are indexed lookups
+            if provider.capabilities() & QgsVectorDataProvider.Capability.CreateAttributeIndex:
+                for name in ('row', 'col', 'cell_key'):
+                    provider.createAttributeIndex(layer.fields().indexOf(name))
+        return {self.OUTPUT: self.dest_id}
     
     def name(self):
         return "Create AtlasGrid"
@@ -147,8 +365,26 @@ class AtlasGridProcessingAlgorithm(QgsProcessingAlgorithm):
         <li><b>Layer with area of interest:</b> The layer that defines the area of interest.</li>
         <li><b>Extent of grid:</b> Specification of the rectangular extent, that the grid should cover.</li>
         <li><b>Output CRS:</b> The coordinate reference system in which the grid should be created.</li>
+        <li><b>Add fields with names of adjoining sheets:</b> Adds the fields n_sheet, ne_sheet, e_sheet, se_sheet, s_sheet, sw_sheet, w_sheet and nw_sheet with the name of the adjoining sheet in each direction (empty where the neighbouring sheet has been deleted).</li>
+        <li><b>Sheet order:</b> The order in which the sheets are numbered: row by row, serpentine (row by row in alternating direction), along a Hilbert curve or along a Z-order curve. With the curves, consecutive sheets are close to each other, so render caches are reused between consecutive atlas pages.</li>
+        <li><b>Write sheet order to a print_order field:</b> Writes the sheet order to a separate print_order field and numbers cellnum row by row.</li>
+        <li><b>Approximate classification of sheets:</b> Decides which sheets to delete on a bitmap of the area of interest instead of exact geometry tests. This is much faster for large grids. The bitmap is conservative, so no sheet intersecting the area of interest is deleted, but a few sheets near the boundary may be kept that would be deleted in exact mode.</li>
+        <li><b>Pixel size for approximate classification:</b> The pixel size of the bitmap in units of the output CRS. 0 uses half the (net) sheet size. Smaller pixels keep fewer extra sheets.</li>
+        <li><b>Report the number of sheets classified differently in exact mode:</b> Also runs the exact classification and reports how many sheets are decided differently.</li>
+        <li><b>Simplification tolerance for the AoI:</b> Simplifies detailed areas of interest (e.g. coastlines) before testing the sheets, in units of the output CRS. The area of interest is only enlarged, so no sheet intersecting it is deleted, but sheets within the tolerance of it may be kept. Detailed areas of interest are always split into small pieces for the tests.</li>
+        <li><b>Nested levels:</b> Creates a nested map series in one pass, e.g. 2,2 for sheets at 1:50,000, 1:25,000 and 1:12,500 with a map item at 1:50,000. Each level subdivides each sheet of the previous level into n x n sheets, and all levels are written to the output with the fields level (0 for the grid itself), scale, parent_name and parent_key (the cell_key of the containing sheet of the previous level). Only the sheets within kept sheets of the previous level (and their neighbours) are tested against the area of interest. Use an atlas filter on level to print each scale.</li>
+        <li><b>Create a separate grid for each cluster of the AoI:</b> Groups the features of the area of interest into clusters (e.g. islands), and creates a grid centered on each cluster instead of one grid over the whole extent. The sheets are numbered consecutively over all clusters (from the north-west), the cell names are prefixed with the cluster number (e.g. 2-B4), and a cluster field is added. The extent is not used.</li>
+        <li><b>Minimum distance between clusters:</b> Features closer to each other than this distance (in units of the output CRS) belong to the same cluster. 0 uses the sheet size.</li>
+        <li><b>Write the AoI coverage of the sheets to coverage fields:</b> Adds the fields coverage and net_coverage with the fraction (0 to 1) of each sheet and of its net rectangle (the sheet without half the overlap on each side) covered by the area of interest.</li>
+        <li><b>Minimum AoI coverage of sheets:</b> Deletes sheets with less of their area covered by the area of interest, if the area of interest on them is still printed on the overlapping neighbouring sheets. Sheets are deleted starting with the least covered. Only for an area of interest of polygons.</li>
+        <li><b>Report the memory use of each stage:</b> Records the Python allocations and the resident memory of the process at the start and end of each stage of the run (AoI index, cell store, classification, numbering, output layer, ...), and reports them in the log and the peaks as outputs. Tracing the allocations slows down the run.</li>
         <li><b>AtlasGrid</b> Specification of the output destination layer.</li>
+        <li><b>Adjacency table</b> Optional table with a row for each pair of adjoining sheets.</li>
+        <li><b>Masks</b> Optional layer with the part of each sheet outside the area of interest (empty for sheets within it) and the cellname and cellnum of the sheet (and level in nested series), e.g. to grey out the surroundings of the area of interest with a stored polygon instead of an overlay on every atlas page.</li>
+        <li><b>Profile of the run</b> Optional .pstats file with a cProfile profile of the run, e.g. for support on slow runs. A summary of the hottest functions is written to a .txt file next to it and to the log.</li>
         </ul>
+
+        <p>Besides cellname, cellnum and dj_cellnum, each sheet has the row and column index of the sheet in the grid (row, col - counted from 0 from the north-west) and a 64 bit cell_key, that only depends on the grid parameters (origin, sheet size and overlap) and the row and column, so it does not change when the AoI changes. Attribute indexes are created on row, col and cell_key in file outputs.</p>
         
         <p>Developed by <a href="https://www.styrke10.dk">Styrke 10 ApS</a>.</p>
 
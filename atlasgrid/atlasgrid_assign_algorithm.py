@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from qgis.PyQt.QtCore import QVariant
+from qgis.PyQt.QtGui import QIcon
+from qgis.core import (
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterVectorLayer,
+    QgsProcessingParameterLayout,
+    QgsProcessingParameterLayoutItem,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterExtent,
+    QgsProcessingParameterCrs,
+    QgsProcessingParameterFeatureSink,
+    QgsProcessingUtils,
+    QgsFeatureSink,
+    QgsFields,
+    QgsField,
+    QgsLayoutItemRegistry,
+    QgsCoordinateTransform
+)
+from .grid import GridCreator
+from .gridlayer import GridLayer
+
+class AtlasGridAssignAlgorithm(QgsProcessingAlgorithm):
+
+    INPUT = 'INPUT'
+    GRID = 'GRID'
+    LAYOUT = 'LAYOUT'
+    MAPITEM = 'MAPITEM'
+    HORZOVERLAP = 'HORZOVERLAP'
+    VERTOVERLAP = 'VERTOVERLAP'
+    EXTENT = 'EXTENT'
+    CRS = 'CRS'
+    OUTPUT = 'OUTPUT'
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(self.INPUT, 'Point layer',
+                types=[QgsProcessing.SourceType.TypeVectorPoint])
+        )
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(self.GRID, 'AtlasGrid layer',
+                types=[QgsProcessing.SourceType.TypeVectorPolygon],
+                optional=True)
+        )
+        # Without an AtlasGrid layer, the grid is given by the parameters of the AtlasGrid algorithm
+        self.addParameter(
+            QgsProcessingParameterLayout(self.LAYOUT, 'Print layout (without AtlasGrid layer)',
+                optional=True)
+        )
+        self.addParameter(
+            QgsProcessingParameterLayoutItem(self.MAPITEM, 'Map Item (without AtlasGrid layer)',
+                itemType=QgsLayoutItemRegistry.ItemType.LayoutMap,
+                parentLayoutParameterName = self.LAYOUT,
+                optional=True)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.HORZOVERLAP, 'Horizontal overlap (in %)',
+                type=QgsProcessingParameterNumber.Type.Integer,
+                defaultValue=0,
+                minValue=0,
+                maxValue=50)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.VERTOVERLAP, 'Vertical overlap (in %)',
+                type=QgsProcessingParameterNumber.Type.Integer,
+                defaultValue=0,
+                minValue=0,
+                maxValue=50)
+        )
+        self.addParameter(
+            QgsProcessingParameterExtent(self.EXTENT, 'Extent of grid (without AtlasGrid layer)',
+                optional=True)
+        )
+        self.addParameter(
+            QgsProcessingParameterCrs(self.CRS, 'CRS of grid (without AtlasGrid layer)',
+                defaultValue='ProjectCrs',
+                optional=True)
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(self.OUTPUT, 'Points with sheets',
+                type=QgsProcessing.SourceType.TypeVectorPoint)
+        )
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        # The grid layer and the layout are read in the main thread
+        gridLayer = self.parameterAsVectorLayer(parameters, self.GRID, context)
+        if gridLayer is not None:
+            try:
+                grid = GridLayer(gridLayer)
+            except ValueError as e:
+                feedback.reportError(str(e), fatalError=True)
+                return False
+            (self.lattice, self.cellnum, self.gridCrs) = (grid.lattice, grid.cellnum, grid.crs)
+            return True
+
+        layout = self.parameterAsLayout(parameters, self.LAYOUT, context)
+        mapitem = self.parameterAsLayoutItem(parameters, self.MAPITEM, context, layout) if layout is not None else None
+        if mapitem is None:
+            feedback.reportError('Either an AtlasGrid layer or a print layout with a map item must be given', fatalError=True)
+            return False
+        self.gridCrs = self.parameterAsCrs(parameters, self.CRS, context)
+        extent = self.parameterAsExtent(parameters, self.EXTENT, context, self.gridCrs)
+        if extent.isNull():
+            feedback.reportError('The extent of the grid must be given without an AtlasGrid layer', fatalError=True)
+            return False
+
+        # The same lattice as created by the AtlasGrid algorithm (all sheets, numbered row by row)
+        gridCreator = GridCreator()
+        gridCreator.setFeedback(feedback)
+        (rwDimensions,nRowsAndCols,gridExtent) = gridCreator.calcGridMetrics(mapitem.scale(),extent,mapitem.sizeWithUnits(),
+            self.parameterAsInt(parameters, self.HORZOVERLAP, context),self.parameterAsInt(parameters, self.VERTOVERLAP, context))
+        self.lattice = gridCreator.createLattice(gridExtent,rwDimensions,nRowsAndCols)
+        self.cellnum = np.arange(1, self.lattice.rows * self.lattice.cols + 1, dtype=np.int64)
+        return True
+
+    # Number of points assigned at a time
+    BATCH_SIZE = 10000
+
+    def processAlgorithm(self, parameters, context, feedback):
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        transform = None
+        if source.sourceCrs() != self.gridCrs:
+            transform = QgsCoordinateTransform(source.sourceCrs(), self.gridCrs, context.transformContext())
+
+        newFields = QgsFields()
+        newFields.append(QgsField('sheet', QVariant.String))
+        newFields.append(QgsField('sheet_num', QVariant.Int))
+        newFields.append(QgsField('cell_key', QVariant.LongLong))
+        newFields.append(QgsField('sheets', QVariant.String))
+        newFields.append(QgsField('n_sheets', QVariant.Int))
+        fields = QgsProcessingUtils.combineFields(source.fields(), newFields)
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context, fields, source.wkbType(), source.sourceCrs())
+
+        # A single pass over the points - the sheets of a batch of points are computed at once
+        names = {}
+        total = source.featureCount()
+        batch = []
+        for current, f in enumerate(source.getFeatures()):
+            if current % self.BATCH_SIZE == 0:
+                if feedback.isCanceled():
+                    return {}
+                feedback.setProgress(100 * current / max(total, 1))
+            batch.append(f)
+            if len(batch) == self.BATCH_SIZE:
+                self.writeBatch(batch,transform,names,sink)
+                batch = []
+        if batch:
+            self.writeBatch(batch,transform,names,sink)
+        feedback.setProgress(100)
+
+        return {self.OUTPUT: dest_id}
+
+    def writeBatch(self,batch,transform,names,sink):
+        lattice = self.lattice
+        # Points without geometry are placed outside the grid
+        outside = (lattice.xMin - 2 * lattice.width, lattice.yMax + 2 * lattice.height)
+        (xs,ys) = ([], [])
+        for f in batch:
+            geom = f.geometry()
+            if geom.isNull() or geom.isEmpty():
+                (x,y) = outside
+            else:
+                if transform is not None:
+                    geom.transform(transform)
+                point = geom.centroid().asPoint()
+                (x,y) = (point.x(), point.y())
+            xs.append(x)
+            ys.append(y)
+
+        # All sheets containing each point, with the sheet whose net cell contains the point first
+        (index,nums,counts) = lattice.sheetsAt(np.array(xs, dtype=np.float64), np.array(ys, dtype=np.float64), self.cellnum)
+        cellKeys = lattice.cellKey(index[:,0] // lattice.cols, index[:,0] % lattice.cols)
+
+        def cellName(i):
+            if i not in names:
+                names[i] = lattice.cellName(i // lattice.cols, i % lattice.cols)
+            return names[i]
+
+        for k,f in enumerate(batch):
+            n = int(counts[k])
+            if n > 0:
+                sheets = [cellName(int(i)) for i in index[k,:n]]
+                attributes = [sheets[0], int(nums[k,0]), int(cellKeys[k]), ','.join(sheets), n]
+            else:
+                attributes = [None, None, None, None, 0]
+            f.setAttributes(f.attributes() + attributes)
+            sink.addFeature(f, QgsFeatureSink.Flag.FastInsert)
+        return
+
+    def name(self):
+        return "Assign points to AtlasGrid sheets"
+
+    def displayName(self):
+        return "Assign points to sheets"
+
+    def group(self):
+        return "AtlasGrid"
+
+    def groupId(self):
+        return "atlasgrid"
+
+    def createInstance(self):
+        return AtlasGridAssignAlgorithm()
+
+    def icon(self):
+        return QIcon(':/plugins/atlasgrid/atlasgrid.png')
+
+    def shortDescription(self):
+        str = """<p>Finds the AtlasGrid sheets containing each point of a point layer, e.g. to find the atlas page of address points or incident locations.</p>
+
+        <p>The sheets are computed arithmetically from the grid parameters, so no spatial join or spatial index is needed, and millions of points are assigned in seconds.</p>
+
+        <p>The processing algorithm takes the following parameters:</p>
+        <ul>
+        <li><b>Point layer:</b> The points to assign to sheets.</li>
+        <li><b>AtlasGrid layer:</b> An AtlasGrid layer. The grid is reconstructed from its sheets, and only sheets in the layer are assigned.</li>
+        <li><b>Print layout, Map item, Horizontal/Vertical overlap, Extent and CRS of grid:</b> Without an AtlasGrid layer, the grid is computed from the same parameters as in the AtlasGrid algorithm. All sheets of the grid are assigned, numbered row by row.</li>
+        <li><b>Points with sheets:</b> The points with the fields sheet (the name of the sheet containing the point - if sheets overlap, the sheet whose net cell contains it, i.e. the sheet shrunk by half the overlap on each side, so the net cells tile the plane; if that sheet is not in the AtlasGrid layer, the sheet with the lowest cellnum), sheet_num (its cellnum), cell_key, sheets (the names of all sheets containing the point, separated by commas) and n_sheets (the number of sheets containing the point).</li>
+        </ul>
+        """
+        return str
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from qgis.PyQt.QtGui import QIcon
+from qgis.core import (
+    QgsApplication,
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingException,
+    QgsProcessingParameterLayout,
+    QgsProcessingParameterVectorLayer,
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterFolderDestination,
+    QgsProcessingOutputFile,
+    QgsVectorFileWriter
+)
+
+class AtlasGridExportAlgorithm(QgsProcessingAlgorithm):
+
+    LAYOUT = 'LAYOUT'
+    COVERAGE = 'COVERAGE'
+    FORMAT = 'FORMAT'
+    WORKERS = 'WORKERS'
+    OUTPUT = 'OUTPUT'
+    OUTPUT_PDF = 'OUTPUT_PDF'
+
+    FORMATS = ['pdf', 'png']
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterLayout(self.LAYOUT, 'Print layout')
+        )
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(self.COVERAGE, 'AtlasGrid coverage layer',
+                types=[QgsProcessing.SourceType.TypeVectorPolygon])
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(self.FORMAT, 'Output format',
+                options=['PDF (merged in page order)', 'PNG (one file per page)'],
+                defaultValue=0)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.WORKERS, 'Number of worker processes',
+                type=QgsProcessingParameterNumber.Type.Integer,
+                defaultValue=max(1, (os.cpu_count() or 2) - 1),
+                minValue=1)
+        )
+        self.addParameter(
+            QgsProcessingParameterFolderDestination(self.OUTPUT, 'Output folder')
+        )
+        self.addOutput(
+            QgsProcessingOutputFile(self.OUTPUT_PDF, 'Merged PDF')
+        )
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        # The workers read the saved project, so the project and layout are only inspected here (main thread)
+        project = context.project()
+        if not project.fileName():
+            feedback.reportError('The project must be saved before the atlas can be exported', fatalError=True)
+            return False
+        if project.isDirty():
+            feedback.pushWarning('The project has unsaved changes, which are not included in the export')
+        self.projectFile = project.fileName()
+
+        layout = self.parameterAsLayout(parameters, self.LAYOUT, context)
+        if layout is None:
+            feedback.reportError('Print layout not found', fatalError=True)
+            return False
+        self.layoutName = layout.name()
+
+        coverage = self.parameterAsVectorLayer(parameters, self.COVERAGE, context)
+        if coverage.fields().indexOf('cellnum') < 0:
+            feedback.reportError('The coverage layer has no cellnum field', fatalError=True)
+            return False
+        # The workers split the pages of the atlas, so there is no point in more workers than sheets
+        self.sheets = coverage.featureCount()
+
+        # Layers that are not stored in the project (e.g. a newly created AtlasGrid) are written to a file
+        self.tempDir = tempfile.mkdtemp(prefix='atlasgrid_')
+        self.coverageArgs = ['--coverage-id', coverage.id()]
+        if coverage.providerType() == 'memory' or project.mapLayer(coverage.id()) is None:
+            coverageFile = os.path.join(self.tempDir, 'coverage.gpkg')
+            options = QgsVectorFileWriter.SaveVectorOptions()
+            options.driverName = 'GPKG'
+            (error, message, _, _) = QgsVectorFileWriter.writeAsVectorFormatV3(coverage, coverageFile,
+                                                                             context.transformContext(), options)
+            if error != QgsVectorFileWriter.WriterError.NoError:
+                feedback.reportError('Could not write coverage layer: {}'.format(message), fatalError=True)
+                shutil.rmtree(self.tempDir, ignore_errors=True)
+                return False
+            self.coverageArgs = ['--coverage-file', coverageFile]
+        return True
+
+    def pythonExecutable(self):
+        # Inside QGIS sys.executable is usually the QGIS binary, so look for the interpreter QGIS runs on
+        names = ['python.exe', 'python3.exe'] if sys.platform == 'win32' else ['bin/python3', 'bin/python']
+        for name in names:
+            candidate = os.path.join(sys.exec_prefix, name)
+            if os.path.exists(candidate):
+                return candidate
+        return shutil.which('python3') or shutil.which('python') or sys.executable
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # However the export ends (also when canceled or failing), the workers are stopped, their logs
+        # closed and the temporary folder (coverage layer file, range PDFs and logs) removed
+        (processes,logs) = ([], [])
+        try:
+            return self.export(parameters, context, feedback, processes, logs)
+        finally:
+            for (process,log,k) in processes:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+            for log in logs:
+                log.close()
+            shutil.rmtree(self.tempDir, ignore_errors=True)
+
+    def export(self, parameters, context, feedback, processes, logs):
+        outputFormat = self.FORMATS[self.parameterAsEnum(parameters, self.FORMAT, context)]
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        outputFolder = self.parameterAsString(parameters, self.OUTPUT, context)
+        os.makedirs(outputFolder, exist_ok=True)
+
+        if self.sheets == 0:
+            raise QgsProcessingException('The coverage layer has no sheets')
+        if self.sheets > 0:
+            workers = min(workers, self.sheets)
+
+        worker = os.path.join(os.path.dirname(__file__), 'export_worker.py')
+        env = dict(os.environ)
+        env.setdefault('QGIS_PREFIX_PATH', QgsApplication.prefixPath())
+
+        # Each worker prepares the whole atlas and exports its part of the pages, so the atlas variables
+        # (e.g. @atlas_featurenumber and @atlas_totalfeatures) and the file names are those of a serial export
+        pages = os.path.join(self.tempDir, 'pages')
+        os.makedirs(pages)
+        output = pages if outputFormat == 'pdf' else outputFolder
+        for k in range(workers):
+            command = [self.pythonExecutable(), worker, '--project', self.projectFile, '--layout', self.layoutName,
+                       '--worker', str(k), '--workers', str(workers), '--format', outputFormat, '--output', output] + self.coverageArgs
+            # Errors are written to a file (a pipe could fill up and block the worker)
+            log = open(os.path.join(self.tempDir, 'worker_{:04d}.log'.format(k)), 'w+b')
+            logs.append(log)
+            process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=log)
+            processes.append((process, log, k))
+        feedback.pushInfo('Exporting the atlas in {} worker processes'.format(workers))
+
+        # Wait for the workers
+        running = list(processes)
+        while running:
+            if feedback.isCanceled():
+                return {}
+            time.sleep(0.5)
+            running = [p for p in running if p[0].poll() is None]
+            feedback.setProgress(90 * (len(processes) - len(running)) / len(processes))
+
+        for (process,log,k) in processes:
+            log.seek(0)
+            message = log.read().decode(errors='replace')
+            if process.returncode != 0:
+                raise QgsProcessingException('Export of part {} of {} failed: {}'.format(k + 1, workers, message))
+
+        results = {self.OUTPUT: outputFolder, self.OUTPUT_PDF: None}
+        if outputFormat == 'pdf':
+            # The page PDFs are named by their page number (padded to six digits) and the atlas file name
+            results[self.OUTPUT_PDF] = self.mergePdfs([os.path.join(pages, name) for name in sorted(os.listdir(pages))],
+                                                      outputFolder, feedback)
+        feedback.setProgress(100)
+        return results
+
+    def mergePdfs(self, pdfs, outputFolder, feedback):
+        merged = os.path.join(outputFolder, '{}.pdf'.format(self.layoutName))
+        try:
+            from pypdf import PdfWriter
+        except ImportError:
+            # Without pypdf the pages are kept as separate PDFs named by the atlas file names, as in a serial
+            # export to separate PDF files
+            feedback.pushWarning('pypdf is not installed - the PDFs of the pages are not merged')
+            for pdf in pdfs:
+                shutil.move(pdf, os.path.join(outputFolder, os.path.basename(pdf).split('_', 1)[1]))
+            return None
+        if not pdfs:
+            feedback.pushWarning('The atlas has no pages')
+            return None
+
+        writer = PdfWriter()
+        for pdf in pdfs:
+            writer.append(pdf)
+        with open(merged, 'wb') as f:
+            writer.write(f)
+        return merged
+
+    def name(self):
+        return "Export AtlasGrid atlas"
+
+    def displayName(self):
+        return "Export atlas in parallel"
+
+    def group(self):
+        return "AtlasGrid"
+
+    def groupId(self):
+        return "atlasgrid"
+
+    def createInstance(self):
+        return AtlasGridExportAlgorithm()
+
+    def icon(self):
+        return QIcon(':/plugins/atlasgrid/atlasgrid.png')
+
+    def shortDescription(self):
+        str = """<p>Exports the atlas of a print layout, using an AtlasGrid layer as coverage layer, in several QGIS worker processes running in parallel.</p>
+
+        <p>Each worker is a headless QGIS process, which prepares the atlas as for a serial export (with the filter and sort order of the layout) and exports a contiguous part of its pages. So page numbers (@atlas_featurenumber and @atlas_totalfeatures) and file names (the file name expression of the atlas) are the same as in a serial export. The workers read the saved project, so the project must be saved before exporting. The merged PDF is put together from a PDF per page, so unlike a serial export it has no document properties (e.g. title) and no layer tree of a geospatial PDF.</p>
+
+        <p>The processing algorithm takes the following parameters:</p>
+        <ul>
+        <li><b>Print layout:</b> Name of the print layout that contains the atlas.</li>
+        <li><b>AtlasGrid coverage layer:</b> The AtlasGrid layer to use as coverage layer. The pages are in the order of the atlas of the layout (AtlasGrid layers are stored in cellnum order).</li>
+        <li><b>Output format:</b> PDF (the pages are exported to a PDF each and merged into one PDF in page order, if pypdf is installed - otherwise they are kept as separate PDFs named by the file name expression of the atlas) or a PNG file per page named by the file name expression of the atlas.</li>
+        <li><b>Number of worker processes:</b> The number of parts of the atlas exported in parallel.</li>
+        <li><b>Output folder:</b> The folder the PDF or PNG files are written to.</li>
+        </ul>
+        """
+        return str
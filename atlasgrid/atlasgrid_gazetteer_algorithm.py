@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from qgis.PyQt.QtCore import QVariant
+from qgis.PyQt.QtGui import QIcon
+from qgis.core import (
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterField,
+    QgsProcessingParameterVectorLayer,
+    QgsProcessingParameterFeatureSink,
+    QgsFeatureSink,
+    QgsFeatureRequest,
+    QgsFeature,
+    QgsFields,
+    QgsField,
+    QgsGeometry,
+    QgsRectangle,
+    QgsWkbTypes,
+    QgsCoordinateTransform
+)
+from .gridlayer import GridLayer
+
+class AtlasGridGazetteerAlgorithm(QgsProcessingAlgorithm):
+
+    INPUT = 'INPUT'
+    NAMEFIELD = 'NAMEFIELD'
+    GRID = 'GRID'
+    OUTPUT = 'OUTPUT'
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(self.INPUT, 'Features to index (e.g. roads or places)',
+                types=[QgsProcessing.SourceType.TypeVectorAnyGeometry])
+        )
+        self.addParameter(
+            QgsProcessingParameterField(self.NAMEFIELD, 'Name field',
+                parentLayerParameterName=self.INPUT)
+        )
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(self.GRID, 'AtlasGrid layer',
+                types=[QgsProcessing.SourceType.TypeVectorPolygon])
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(self.OUTPUT, 'Gazetteer',
+                type=QgsProcessing.SourceType.TypeVector)
+        )
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        # The grid layer is read in the main thread
+        try:
+            grid = GridLayer(self.parameterAsVectorLayer(parameters, self.GRID, context))
+        except ValueError as e:
+            feedback.reportError(str(e), fatalError=True)
+            return False
+        (self.lattice, self.cellnum, self.gridCrs) = (grid.lattice, grid.cellnum, grid.crs)
+        return True
+
+    def processAlgorithm(self, parameters, context, feedback):
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        nameField = self.parameterAsString(parameters, self.NAMEFIELD, context)
+        lattice = self.lattice
+        transform = None
+        if source.sourceCrs() != self.gridCrs:
+            transform = QgsCoordinateTransform(source.sourceCrs(), self.gridCrs, context.transformContext())
+
+        # The sheets of each name - only the sheets within the row/column range of the bounding box
+        # of a feature are tested exactly
+        sheets = {}
+        unnamed = 0
+        total = source.featureCount()
+        request = QgsFeatureRequest().setSubsetOfAttributes([nameField], source.fields())
+        for current, f in enumerate(source.getFeatures(request)):
+            if current % 1000 == 0:
+                if feedback.isCanceled():
+                    return {}
+                feedback.setProgress(90 * current / max(total, 1))
+            name = f[nameField]
+            geom = f.geometry()
+            if name is None or str(name).strip() == '' or geom.isNull() or geom.isEmpty():
+                unnamed += 1
+                continue
+            if transform is not None:
+                geom.transform(transform)
+            bbox = geom.boundingBox()
+            indexRange = lattice.indexRange(bbox.xMinimum(),bbox.yMinimum(),bbox.xMaximum(),bbox.yMaximum())
+            if indexRange is None:
+                continue
+
+            (row0,row1,col0,col1) = indexRange
+            (row,col) = np.meshgrid(np.arange(row0, row1 + 1), np.arange(col0, col1 + 1), indexing='ij')
+            candidates = (row * lattice.cols + col).ravel()
+            candidates = candidates[self.cellnum[candidates] > 0]
+            if len(candidates) == 0:
+                continue
+            found = sheets.setdefault(str(name).strip(), set())
+            if bbox.width() == 0 and bbox.height() == 0:
+                # The range of a point only contains the sheets containing it
+                found.update(int(i) for i in candidates)
+                continue
+            engine = QgsGeometry.createGeometryEngine(geom.constGet())
+            engine.prepareGeometry()
+            (xmin,ymin,xmax,ymax) = lattice.cellBounds(candidates // lattice.cols, candidates % lattice.cols)
+            for k,i in enumerate(candidates):
+                if int(i) in found:
+                    continue
+                rect = QgsGeometry.fromRect(QgsRectangle(xmin[k],ymin[k],xmax[k],ymax[k]))
+                if engine.intersects(rect.constGet()):
+                    found.add(int(i))
+        if unnamed:
+            feedback.pushWarning('{} features without name or geometry were skipped'.format(unnamed))
+
+        fields = QgsFields()
+        fields.append(QgsField('name', QVariant.String))
+        fields.append(QgsField('sheets', QVariant.String))
+        fields.append(QgsField('n_sheets', QVariant.Int))
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context, fields, QgsWkbTypes.Type.NoGeometry)
+
+        # Names in alphabetical order, each with its sheets ordered by column and row (e.g. A3, A4, B4)
+        for name in sorted(sheets, key=lambda name: (name.casefold(), name)):
+            cells = sorted(sheets[name], key=lambda i: (i % lattice.cols, i // lattice.cols))
+            if not cells:
+                continue
+            feat = QgsFeature(fields)
+            feat.setAttributes([name, ', '.join(lattice.cellName(i // lattice.cols, i % lattice.cols) for i in cells), len(cells)])
+            sink.addFeature(feat, QgsFeatureSink.Flag.FastInsert)
+        feedback.setProgress(100)
+
+        return {self.OUTPUT: dest_id}
+
+    def name(self):
+        return "Create AtlasGrid gazetteer"
+
+    def displayName(self):
+        return "Gazetteer (street index)"
+
+    def group(self):
+        return "AtlasGrid"
+
+    def groupId(self):
+        return "atlasgrid"
+
+    def createInstance(self):
+        return AtlasGridGazetteerAlgorithm()
+
+    def icon(self):
+        return QIcon(':/plugins/atlasgrid/atlasgrid.png')
+
+    def shortDescription(self):
+        str = """<p>Creates a gazetteer (e.g. a street index) for an atlas: a table listing each name with the sheets it appears on, such as "Main Street ... A3, A4, B4".</p>
+
+        <p>The bounding box of each feature is converted to a range of rows and columns of the grid, and only the sheets within that range are tested exactly, so no overlay with the grid layer is needed.</p>
+
+        <p>The processing algorithm takes the following parameters:</p>
+        <ul>
+        <li><b>Features to index:</b> The features (e.g. road segments or places) to list in the gazetteer.</li>
+        <li><b>Name field:</b> The field with the name of the features. Features with the same name are listed together.</li>
+        <li><b>AtlasGrid layer:</b> The AtlasGrid layer used as coverage layer of the atlas.</li>
+        <li><b>Gazetteer:</b> A table with the fields name, sheets (the names of the sheets, ordered by column and row) and n_sheets, sorted by name.</li>
+        </ul>
+        """
+        return str
@@ -3,10 +3,20 @@
 from qgis.PyQt.QtGui import QIcon
 from qgis.core import QgsProcessingProvider
 from .atlasgrid_algorithm import AtlasGridProcessingAlgorithm
+from .atlasgrid_export_algorithm import AtlasGridExportAlgorithm
+from .atlasgrid_assign_algorithm import AtlasGridAssignAlgorithm
+from .atlasgrid_gazetteer_algorithm import AtlasGridGazetteerAlgorithm
+from .atlasgrid_scale_algorithm import AtlasGridScaleAlgorithm
+from .atlasgrid_stats_algorithm import AtlasGridStatsAlgorithm
 
 class AtlasGridProvider(QgsProcessingProvider):
     def loadAlgorithms(self):
         self.addAlgorithm(AtlasGridProcessingAlgorithm())
+        self.addAlgorithm(AtlasGridExportAlgorithm())
+        self.addAlgorithm(AtlasGridAssignAlgorithm())
+        self.addAlgorithm(AtlasGridGazetteerAlgorithm())
+        self.addAlgorithm(AtlasGridScaleAlgorithm())
+        self.addAlgorithm(AtlasGridStatsAlgorithm())
 
     def id(self):
         return "atlasgrid"
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+import math
+from qgis.PyQt.QtCore import QVariant
+from qgis.PyQt.QtGui import QIcon
+from qgis.core import (
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingException,
+    QgsProcessingFeedback,
+    QgsProcessingParameterVectorLayer,
+    QgsProcessingParameterLayout,
+    QgsProcessingParameterLayoutItem,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterCrs,
+    QgsProcessingParameterFeatureSink,
+    QgsProcessingOutputNumber,
+    QgsFeatureSink,
+    QgsFeatureRequest,
+    QgsFeature,
+    QgsFields,
+    QgsField,
+    QgsWkbTypes,
+    QgsLayoutItemRegistry,
+    QgsCoordinateTransform
+)
+from .grid import GridCreator
+from .cellstore import CellStore
+from .aoi import AoiIndex
+
+class AtlasGridScaleAlgorithm(QgsProcessingAlgorithm):
+
+    LAYOUT = 'LAYOUT'
+    MAPITEM = 'MAPITEM'
+    HORZOVERLAP = 'HORZOVERLAP'
+    VERTOVERLAP = 'VERTOVERLAP'
+    MINOVERLAP = 'MINOVERLAP'
+    AOI = 'AOI'
+    CRS = 'CRS'
+    MAXPAGES = 'MAXPAGES'
+    MINSCALE = 'MINSCALE'
+    MAXSCALE = 'MAXSCALE'
+    SCALESTEP = 'SCALESTEP'
+    OUTPUT = 'OUTPUT'
+    SCALE = 'SCALE'
+    SHEETS = 'SHEETS'
+
+    # Steps of the overlaps tried, if the overlap is searched as well
+    OVERLAP_STEP = 5
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterLayout(self.LAYOUT, 'Print layout')
+        )
+        self.addParameter(
+            QgsProcessingParameterLayoutItem(self.MAPITEM, 'Map Item',
+                itemType=QgsLayoutItemRegistry.ItemType.LayoutMap,
+                parentLayoutParameterName = self.LAYOUT)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.HORZOVERLAP, 'Horizontal overlap (in %)',
+                type=QgsProcessingParameterNumber.Type.Integer,
+                defaultValue=0,
+                minValue=0,
+                maxValue=50)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.VERTOVERLAP, 'Vertical overlap (in %)',
+                type=QgsProcessingParameterNumber.Type.Integer,
+                defaultValue=0,
+                minValue=0,
+                maxValue=50)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.MINOVERLAP, 'Smallest overlap to try (in %, empty = only the given overlap)',
+                type=QgsProcessingParameterNumber.Type.Integer,
+                minValue=0,
+                maxValue=50,
+                optional=True)
+        )
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(self.AOI, 'Layer with area of interest (AoI)')
+        )
+        self.addParameter(
+            QgsProcessingParameterCrs(self.CRS, 'Output CRS',
+                defaultValue='ProjectCrs')
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.MAXPAGES, 'Maximum number of pages',
+                type=QgsProcessingParameterNumber.Type.Integer,
+                defaultValue=64,
+                minValue=1)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.MINSCALE, 'Largest scale to try (1:n)',
+                type=QgsProcessingParameterNumber.Type.Double,
+                defaultValue=1000,
+                minValue=1)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.MAXSCALE, 'Smallest scale to try (1:n)',
+                type=QgsProcessingParameterNumber.Type.Double,
+                defaultValue=1000000,
+                minValue=1)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.SCALESTEP, 'Round scales to multiples of',
+                type=QgsProcessingParameterNumber.Type.Integer,
+                defaultValue=500,
+                minValue=1)
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(self.OUTPUT, 'Sheets per scale',
+                type=QgsProcessing.SourceType.TypeVector)
+        )
+        self.addOutput(
+            QgsProcessingOutputNumber(self.SCALE, 'Scale (1:n)')
+        )
+        self.addOutput(
+            QgsProcessingOutputNumber(self.SHEETS, 'Number of sheets')
+        )
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        # Layouts and project layers belong to the main thread
+        layout = self.parameterAsLayout(parameters, self.LAYOUT, context)
+        mapitem = self.parameterAsLayoutItem(parameters, self.MAPITEM, context, layout)
+        if mapitem is None:
+            feedback.reportError('Map item not found in print layout', fatalError=True)
+            return False
+        self.atlasCellSize = mapitem.sizeWithUnits()
+
+        aoiLayer = self.parameterAsVectorLayer(parameters, self.AOI, context)
+        self.aoiLayer = aoiLayer.materialize(QgsFeatureRequest().setFilterFids(aoiLayer.allFeatureIds()))
+        return True
+
+    def processAlgorithm(self, parameters, context, feedback):
+        horzOverlap = self.parameterAsInt(parameters, self.HORZOVERLAP, context)
+        vertOverlap = self.parameterAsInt(parameters, self.VERTOVERLAP, context)
+        minOverlap = parameters.get(self.MINOVERLAP)
+        maxPages = self.parameterAsInt(parameters, self.MAXPAGES, context)
+        step = self.parameterAsInt(parameters, self.SCALESTEP, context)
+        minScale = self.parameterAsDouble(parameters, self.MINSCALE, context)
+        maxScale = self.parameterAsDouble(parameters, self.MAXSCALE, context)
+        crs = self.parameterAsCrs(parameters, self.CRS, context)
+        if minScale > maxScale:
+            raise QgsProcessingException('The largest scale must be larger than the smallest scale (1:{:g} - 1:{:g})'.format(minScale, maxScale))
+
+        # The AoI is prepared once, and each candidate scale is only classified against it. The grid
+        # creator reports to a silent feedback, that is canceled with this one
+        aoiIndex = AoiIndex(self.aoiLayer, crs, context.transformContext(), GridCreator.AOI_MAX_VERTICES)
+        extent = self.aoiLayer.extent()
+        if self.aoiLayer.crs() != crs:
+            extent = QgsCoordinateTransform(self.aoiLayer.crs(), crs, context.transformContext()).transformBoundingBox(extent)
+        silent = QgsProcessingFeedback(False)
+        feedback.canceled.connect(silent.cancel)
+        gridCreator = GridCreator()
+        gridCreator.setFeedback(silent)
+        gridCreator.setContext(context)
+
+        # Overlaps to try, from the given overlap down to the smallest overlap
+        overlaps = [(horzOverlap, vertOverlap)]
+        if minOverlap is not None and minOverlap != '':
+            minOverlap = self.parameterAsInt(parameters, self.MINOVERLAP, context)
+            o = max(horzOverlap, vertOverlap) - self.OVERLAP_STEP
+            while o >= minOverlap:
+                overlaps.append((min(horzOverlap, o), min(vertOverlap, o)))
+                o -= self.OVERLAP_STEP
+            if overlaps[-1] != (min(horzOverlap, minOverlap), min(vertOverlap, minOverlap)):
+                overlaps.append((min(horzOverlap, minOverlap), min(vertOverlap, minOverlap)))
+            overlaps = list(dict.fromkeys(overlaps))
+
+        counts = {}
+        def sheetCount(k, overlap):
+            # Number of kept sheets at scale 1:k*step (None if canceled)
+            if (k, overlap) not in counts:
+                scale = k * step
+                (rwDimensions,nRowsAndCols,gridExtent) = gridCreator.calcGridMetrics(scale,extent,self.atlasCellSize,overlap[0],overlap[1])
+                store = CellStore(gridCreator.createLattice(gridExtent,rwDimensions,nRowsAndCols))
+                if not gridCreator.identifyCellsToDelete(store,aoiIndex):
+                    return None
+                counts[(k, overlap)] = int(store.keep.sum())
+                feedback.pushInfo('1:{:g} with {}% / {}% overlap: {} sheets'.format(scale, overlap[0], overlap[1], counts[(k, overlap)]))
+            return counts[(k, overlap)]
+
+        # Binary search for the largest scale (smallest denominator) fitting the budget. The number of
+        # sheets mostly grows with the scale, but may jump a little depending on how the grid falls
+        best = None
+        low = max(1, math.ceil(minScale / step))
+        high = max(low, math.floor(maxScale / step))
+        for (n,overlap) in enumerate(overlaps):
+            if feedback.isCanceled():
+                return {}
+            feedback.setProgress(100 * n / len(overlaps))
+            count = sheetCount(high, overlap)
+            if count is None:
+                return {}
+            if count > maxPages:
+                continue
+            (lo,hi) = (low, high)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                count = sheetCount(mid, overlap)
+                if count is None:
+                    return {}
+                if count <= maxPages:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            # The first overlap (the largest) wins ties
+            if best is None or lo < best[0]:
+                best = (lo, overlap)
+
+        fields = QgsFields()
+        fields.append(QgsField('scale', QVariant.Double))
+        fields.append(QgsField('horz_overlap', QVariant.Int))
+        fields.append(QgsField('vert_overlap', QVariant.Int))
+        fields.append(QgsField('sheets', QVariant.Int))
+        fields.append(QgsField('fits', QVariant.Bool))
+        fields.append(QgsField('selected', QVariant.Bool))
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context, fields, QgsWkbTypes.Type.NoGeometry)
+        for ((k,overlap),count) in sorted(counts.items(), key=lambda item: (item[0][1], item[0][0]), reverse=True):
+            feat = QgsFeature(fields)
+            feat.setAttributes([float(k * step), overlap[0], overlap[1], count, count <= maxPages, best == (k, overlap)])
+            sink.addFeature(feat, QgsFeatureSink.Flag.FastInsert)
+
+        results = {self.OUTPUT: dest_id, self.SCALE: None, self.SHEETS: None}
+        if best is None:
+            feedback.reportError('No scale up to 1:{:g} fits {} pages'.format(high * step, maxPages))
+        else:
+            (k,overlap) = best
+            feedback.pushInfo('Largest scale with at most {} pages: 1:{:g} with {}% / {}% overlap ({} sheets)'.format(
+                maxPages, k * step, overlap[0], overlap[1], counts[best]))
+            results[self.SCALE] = k * step
+            results[self.SHEETS] = counts[best]
+        feedback.setProgress(100)
+        return results
+
+    def name(self):
+        return "Find AtlasGrid scale for page budget"
+
+    def displayName(self):
+        return "Find scale for page budget"
+
+    def group(self):
+        return "AtlasGrid"
+
+    def groupId(self):
+        return "atlasgrid"
+
+    def createInstance(self):
+        return AtlasGridScaleAlgorithm()
+
+    def icon(self):
+        return QIcon(':/plugins/atlasgrid/atlasgrid.png')
+
+    def shortDescription(self):
+        str = """<p>Finds the largest map scale for which the AtlasGrid of an area of interest has at most a given number of sheets (e.g. "the book must be at most 64 pages").</p>
+
+        <p>The scale is found by a binary search. The area of interest is prepared once, and for each candidate scale only the sheets of the grid are classified against it. The number of sheets mostly grows with the scale, but can vary a little with how the grid falls on the area of interest, so the result is the largest scale found by the search.</p>
+
+        <p>The processing algorithm takes the following parameters:</p>
+        <ul>
+        <li><b>Print layout, Map item, Horizontal/Vertical overlap, Layer with area of interest and Output CRS:</b> As for the AtlasGrid algorithm. The grid covers the extent of the area of interest, and sheets not intersecting it are not counted.</li>
+        <li><b>Smallest overlap to try:</b> If given, the search is repeated with overlaps from the given overlap down to this overlap in steps of 5%, and the largest scale over all overlaps is selected (with the largest overlap on ties).</li>
+        <li><b>Maximum number of pages:</b> The page budget.</li>
+        <li><b>Largest/Smallest scale to try:</b> The range of scales searched.</li>
+        <li><b>Round scales to multiples of:</b> The scales tried are multiples of this number.</li>
+        <li><b>Sheets per scale:</b> A table with the number of sheets for each scale and overlap tried. The selected scale is marked in the selected field.</li>
+        </ul>
+        """
+        return str
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import re
+import numpy as np
+from qgis.PyQt.QtCore import QVariant
+from qgis.PyQt.QtGui import QIcon
+from qgis.core import (
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingParameterVectorLayer,
+    QgsProcessingParameterMultipleLayers,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterFeatureSink,
+    QgsProcessingUtils,
+    QgsVectorLayerFeatureSource,
+    QgsFeatureSink,
+    QgsFeatureRequest,
+    QgsFields,
+    QgsField,
+    QgsGeometry,
+    QgsRectangle,
+    QgsCoordinateTransform
+)
+from .gridlayer import GridLayer
+from .cellstore import Lattice
+
+class AtlasGridStatsAlgorithm(QgsProcessingAlgorithm):
+
+    GRID = 'GRID'
+    LAYERS = 'LAYERS'
+    DELETEEMPTY = 'DELETEEMPTY'
+    OUTPUT = 'OUTPUT'
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(self.GRID, 'AtlasGrid layer',
+                types=[QgsProcessing.SourceType.TypeVectorPolygon])
+        )
+        self.addParameter(
+            QgsProcessingParameterMultipleLayers(self.LAYERS, 'Content layers (e.g. buildings and roads)',
+                layerType=QgsProcessing.SourceType.TypeVectorAnyGeometry)
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(self.DELETEEMPTY, 'Delete sheets without content',False)
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(self.OUTPUT, 'AtlasGrid with content statistics',
+                type=QgsProcessing.SourceType.TypeVectorPolygon)
+        )
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        # The layers are read in the main thread, and feature sources are created for the worker thread
+        gridLayer = self.parameterAsVectorLayer(parameters, self.GRID, context)
+        try:
+            grid = GridLayer(gridLayer)
+        except ValueError as e:
+            feedback.reportError(str(e), fatalError=True)
+            return False
+        (self.lattice, self.cellnum, self.gridCrs) = (grid.lattice, grid.cellnum, grid.crs)
+        self.gridSource = QgsVectorLayerFeatureSource(gridLayer)
+        self.gridFields = gridLayer.fields()
+        self.gridWkbType = gridLayer.wkbType()
+        self.layers = [(layer.name(), layer.crs(), layer.featureCount(), QgsVectorLayerFeatureSource(layer))
+                       for layer in self.parameterAsLayerList(parameters, self.LAYERS, context)]
+        return True
+
+    @staticmethod
+    def fieldName(name,used):
+        # n_features_ followed by the layer name in lower case with other characters than letters and digits replaced
+        base = 'n_features_' + (re.sub(r'[^0-9a-z]+', '_', name.lower()).strip('_') or 'layer')
+        fieldName = base
+        n = 2
+        while fieldName in used:
+            fieldName = '{}_{}'.format(base, n)
+            n += 1
+        used.add(fieldName)
+        return fieldName
+
+    def processAlgorithm(self, parameters, context, feedback):
+        deleteEmpty = self.parameterAsBoolean(parameters, self.DELETEEMPTY, context)
+        lattice = self.lattice
+        cells = lattice.rows * lattice.cols
+
+        # One streamed pass over each layer. The bounding box of each feature is converted to the range of
+        # rows and columns of the sheets it can intersect, and the kept sheets are tested exactly unless the
+        # feature is a point or within a single sheet
+        counts = np.zeros((len(self.layers), cells), dtype=np.int64)
+        vertices = np.zeros(cells, dtype=np.int64)
+        for (n,(name,crs,total,source)) in enumerate(self.layers):
+            feedback.pushInfo('Counting the features of {}'.format(name))
+            transform = None
+            if crs != self.gridCrs:
+                transform = QgsCoordinateTransform(crs, self.gridCrs, context.transformContext())
+            request = QgsFeatureRequest().setNoAttributes()
+            for current, f in enumerate(source.getFeatures(request)):
+                if current % 1000 == 0:
+                    if feedback.isCanceled():
+                        return {}
+                    feedback.setProgress(90 * (n + current / max(total, 1)) / len(self.layers))
+                geom = f.geometry()
+                if geom.isNull() or geom.isEmpty():
+                    continue
+                if transform is not None:
+                    geom.transform(transform)
+                bbox = geom.boundingBox()
+                (candidates,exact) = lattice.cellsIntersecting(bbox.xMinimum(),bbox.yMinimum(),bbox.xMaximum(),bbox.yMaximum())
+                candidates = candidates[self.cellnum[candidates] > 0]
+                if len(candidates) == 0:
+                    continue
+                if exact:
+                    engine = QgsGeometry.createGeometryEngine(geom.constGet())
+                    engine.prepareGeometry()
+                    (xmin,ymin,xmax,ymax) = lattice.cellBounds(candidates // lattice.cols, candidates % lattice.cols)
+                    candidates = [i for k,i in enumerate(candidates)
+                                  if engine.intersects(QgsGeometry.fromRect(QgsRectangle(xmin[k],ymin[k],xmax[k],ymax[k])).constGet())]
+                # Each sheet renders all vertices of the features intersecting it
+                counts[n,candidates] += 1
+                vertices[candidates] += geom.constGet().nCoordinates()
+
+        used = set(self.gridFields.names())
+        newFields = QgsFields()
+        for (name,crs,total,source) in self.layers:
+            newFields.append(QgsField(self.fieldName(name,used), QVariant.Int))
+        newFields.append(QgsField('n_features', QVariant.Int))
+        newFields.append(QgsField('n_vertices', QVariant.LongLong))
+        fields = QgsProcessingUtils.combineFields(self.gridFields, newFields)
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context, fields, self.gridWkbType, self.gridCrs)
+
+        # The sheets are written in the order of the grid layer
+        hasIndex = self.gridFields.indexOf('row') >= 0 and self.gridFields.indexOf('col') >= 0
+        (written,deleted) = (0, 0)
+        for f in self.gridSource.getFeatures():
+            if feedback.isCanceled():
+                return {}
+            (row,col) = (f['row'], f['col']) if hasIndex else Lattice.parseCellName(f['cellname'])
+            if row is None or col is None or not (0 <= row < lattice.rows and 0 <= col < lattice.cols):
+                attributes = [None] * len(newFields)
+            else:
+                i = row * lattice.cols + col
+                content = int(counts[:,i].sum())
+                if deleteEmpty and content == 0:
+                    deleted += 1
+                    continue
+                attributes = [int(c) for c in counts[:,i]] + [content, int(vertices[i])]
+            f.setAttributes(f.attributes() + attributes)
+            sink.addFeature(f, QgsFeatureSink.Flag.FastInsert)
+            written += 1
+        if deleteEmpty:
+            feedback.pushInfo('{} sheets without content deleted, {} sheets written'.format(deleted, written))
+        feedback.setProgress(100)
+
+        return {self.OUTPUT: dest_id}
+
+    def name(self):
+        return "Count AtlasGrid sheet content"
+
+    def displayName(self):
+        return "Sheet content statistics"
+
+    def group(self):
+        return "AtlasGrid"
+
+    def groupId(self):
+        return "atlasgrid"
+
+    def createInstance(self):
+        return AtlasGridStatsAlgorithm()
+
+    def icon(self):
+        return QIcon(':/plugins/atlasgrid/atlasgrid.png')
+
+    def shortDescription(self):
+        str = """<p>Counts the features and vertices of content layers (e.g. buildings and roads) on each sheet of an AtlasGrid layer, e.g. to delete sheets without relevant content, or to estimate how heavy each page is to render when scheduling exports.</p>
+
+        <p>Each content layer is read once. The bounding box of each feature is converted to a range of rows and columns of the grid, and only the sheets within that range are tested exactly (points and features within a single sheet need no test), so no overlay with the grid layer is needed.</p>
+
+        <p>The processing algorithm takes the following parameters:</p>
+        <ul>
+        <li><b>AtlasGrid layer:</b> The AtlasGrid layer.</li>
+        <li><b>Content layers:</b> The layers to count the features of.</li>
+        <li><b>Delete sheets without content:</b> Leaves out the sheets without features of any of the content layers. The remaining sheets keep their cellnum, so the atlas order is unchanged.</li>
+        <li><b>AtlasGrid with content statistics:</b> The sheets with a field n_features_&lt;layer&gt; for each content layer (the number of features intersecting the sheet), n_features (the total) and n_vertices (the number of vertices of the features intersecting the sheet, as an estimate of the rendering cost).</li>
+        </ul>
+        """
+        return str
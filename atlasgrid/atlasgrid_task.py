@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import Qgis, QgsTask, QgsProject, QgsMessageLog, QgsProcessingContext, QgsProcessingFeedback, \
+                      QgsFeatureRequest, QgsSettings
+from .grid import GridCreator
+from .profiler import Profiler, PROFILE_SETTING
+
+class MessageLogFeedback(QgsProcessingFeedback):
+    """Processing feedback writing the messages to the message log, as there is no processing dialog
+    showing them for grids created from the dialog (QgsMessageLog can be used from any thread)."""
+
+    def pushInfo(self,info):
+        QgsMessageLog.logMessage(info, "AtlasGrid", Qgis.MessageLevel.Info)
+        super().pushInfo(info)
+
+    def pushWarning(self,warning):
+        QgsMessageLog.logMessage(warning, "AtlasGrid", Qgis.MessageLevel.Warning)
+        super().pushWarning(warning)
+
+    def reportError(self,error,fatalError=False):
+        QgsMessageLog.logMessage(error, "AtlasGrid", Qgis.MessageLevel.Critical)
+        super().reportError(error,fatalError)
+
+class AtlasGridTask(QgsTask):
+    """Creates an AtlasGrid in a background thread and adds it to the project when done."""
+
+    def __init__(self,crs,mapScale,gridExtent,rwDimensions,nRowsAndCols,deleteNonIntersecting,aoiLayer):
+        super().__init__('Creating AtlasGrid', QgsTask.Flag.CanCancel)
+        self.crs = crs
+        self.mapScale = mapScale
+        self.gridExtent = gridExtent
+        self.rwDimensions = rwDimensions
+        self.nRowsAndCols = nRowsAndCols
+        self.deleteNonIntersecting = deleteNonIntersecting
+
+        # Project layers must not be read from the worker thread, so the AoI is copied here (the copy is
+        # a private memory layer, that is never added to the project)
+        if aoiLayer is not None and deleteNonIntersecting:
+            self.aoiLayer = aoiLayer.materialize(QgsFeatureRequest().setFilterFids(aoiLayer.allFeatureIds()))
+        else:
+            self.aoiLayer = None
+
+        # A private processing context with the coordinate transform settings of the project, so the worker
+        # thread neither reads nor registers anything in the project
+        self.context = QgsProcessingContext()
+        self.context.setTransformContext(QgsProject.instance().transformContext())
+
+        # The GridCreator reports progress and messages and checks for cancellation through the feedback object
+        self.feedback = MessageLogFeedback()
+        self.feedback.progressChanged.connect(self.setProgress)
+
+        # With a profile directory in the settings (not shown in the dialog), each run is profiled
+        self.profilePath = None
+        profileDirectory = QgsSettings().value(PROFILE_SETTING, '')
+        if profileDirectory:
+            self.profilePath = os.path.join(profileDirectory, 'atlasgrid_{}.pstats'.format(time.strftime('%Y%m%d_%H%M%S')))
+        self.profiler = Profiler(self.profilePath)
+
+        self.gridLayer = None
+        self.exception = None
+
+    def run(self):
+        try:
+            gridCreator = GridCreator()
+            gridCreator.setCRS(self.crs)
+            gridCreator.setFeedback(self.feedback)
+            gridCreator.setContext(self.context)
+            with self.profiler:
+                self.gridLayer = gridCreator.createGrid(self.mapScale,self.gridExtent,self.rwDimensions,self.nRowsAndCols,
+                                                        self.deleteNonIntersecting,self.aoiLayer)
+        except Exception as e:
+            self.exception = e
+            return False
+
+        if self.gridLayer is None:
+            # Canceled
+            return False
+
+        # Hand the layer over to the main thread, where it is added to the project
+        self.gridLayer.moveToThread(QCoreApplication.instance().thread())
+        return True
+
+    def cancel(self):
+        self.feedback.cancel()
+        super().cancel()
+
+    def finished(self,result):
+        if self.profiler.profiled():
+            QgsMessageLog.logMessage("Profile written to {}".format(self.profilePath), "AtlasGrid", Qgis.MessageLevel.Info)
+        elif self.profilePath:
+            QgsMessageLog.logMessage("The grid was not profiled, as another run was being profiled", "AtlasGrid", Qgis.MessageLevel.Warning)
+        if result:
+            QgsProject.instance().addMapLayer(self.gridLayer)
+        elif self.exception is not None:
+            QgsMessageLog.logMessage("Creating grid failed: {}".format(self.exception), "AtlasGrid", Qgis.MessageLevel.Critical)
+        else:
+            QgsMessageLog.logMessage("Creating grid was canceled", "AtlasGrid", Qgis.MessageLevel.Warning)
+        return
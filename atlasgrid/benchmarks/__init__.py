@@ -0,0 +1,2 @@
+# coding=utf-8
+"""Benchmarks of the AtlasGrid plugin (require a QGIS installation)."""
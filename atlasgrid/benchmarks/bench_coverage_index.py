@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of atlas iteration and overview rendering on an AtlasGrid coverage layer
+with and without a spatial index.
+
+Run with the Python interpreter of a QGIS installation from the repository root:
+
+    python -m atlasgrid.benchmarks.bench_coverage_index [--rows 250] [--cols 200] [--pages 500]
+"""
+
+import argparse
+import random
+import time
+
+from qgis.PyQt.QtCore import QSize
+from qgis.core import QgsApplication, QgsVectorLayer, QgsRectangle, QgsFeatureRequest, QgsMapSettings, \
+                      QgsMapRendererSequentialJob
+from ..grid import GridCreator
+
+
+def buildGrid(rows, cols):
+    gridCreator = GridCreator()
+    gridCreator.setCRS('EPSG:25832')
+    width, height = 2000.0, 3000.0
+    extent = QgsRectangle(500000, 6000000, 500000 + cols * width, 6000000 + rows * height)
+    return gridCreator.createGrid(10000, extent, (width, height, width, height), (rows, cols), False, None)
+
+
+def copyWithoutIndex(layer):
+    copy = QgsVectorLayer("Polygon?crs={}".format(layer.crs().authid()), 'no_index', "memory")
+    copy.dataProvider().addAttributes(layer.fields().toList())
+    copy.updateFields()
+    copy.dataProvider().addFeatures(list(layer.getFeatures()))
+    return copy
+
+
+def atlasIteration(layer, pageExtents):
+    # For each page: fetch the coverage feature and the sheets overlapping the page
+    # (as done for overview map highlighting and intersects filters in layouts)
+    start = time.perf_counter()
+    for cellnum, extent in pageExtents:
+        next(layer.getFeatures(QgsFeatureRequest().setFilterExpression('cellnum = {}'.format(cellnum))))
+        for _ in layer.getFeatures(QgsFeatureRequest().setFilterRect(extent).setNoAttributes()):
+            pass
+    return time.perf_counter() - start
+
+
+def overviewRender(layer, pageExtents):
+    settings = QgsMapSettings()
+    settings.setLayers([layer])
+    settings.setDestinationCrs(layer.crs())
+    settings.setOutputSize(QSize(400, 400))
+    start = time.perf_counter()
+    for _, extent in pageExtents:
+        settings.setExtent(extent.buffered(extent.width()))
+        job = QgsMapRendererSequentialJob(settings)
+        job.start()
+        job.waitForFinished()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=250)
+    parser.add_argument('--cols', type=int, default=200)
+    parser.add_argument('--pages', type=int, default=500, help='Number of atlas pages to sample')
+    args = parser.parse_args()
+
+    app = QgsApplication([], False)
+    app.initQgis()
+
+    indexed = buildGrid(args.rows, args.cols)
+    plain = copyWithoutIndex(indexed)
+    print("Grid with {} sheets".format(indexed.featureCount()))
+
+    random.seed(1)
+    sample = sorted(random.sample(range(1, indexed.featureCount() + 1), min(args.pages, indexed.featureCount())))
+    pageExtents = [(f['cellnum'], f.geometry().boundingBox()) for f in
+                   indexed.getFeatures(QgsFeatureRequest().setFilterFids(sample))]
+
+    for name, layer in (('without index', plain), ('with index', indexed)):
+        print("{:<15} atlas iteration: {:8.3f} s   overview render: {:8.3f} s".format(
+              name, atlasIteration(layer, pageExtents), overviewRender(layer, pageExtents)))
+
+    app.exitQgis()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the memory use of creating AtlasGrids of increasing size: for each grid size, the
+peak of the Python allocations and the peak resident memory of each stage, as CSV (one row per
+grid size and stage) for plotting memory against grid size.
+
+Each grid size is run in a separate process, so the peak resident memory of one size does not
+carry over to the next. Run with the Python interpreter of a QGIS installation from the
+repository root:
+
+    python -m atlasgrid.benchmarks.bench_memory [--sizes 100 300 1000] [--aoi] [--output memory.csv]
+"""
+
+import argparse
+import csv
+import subprocess
+import sys
+
+from qgis.core import QgsApplication, QgsVectorLayer, QgsRectangle, QgsFeature, QgsGeometry, QgsPointXY
+from ..grid import GridCreator
+from ..memorytracker import MB
+
+
+def runGrid(size, withAoi):
+    # A size x size grid, optionally with a circular AoI within the extent
+    gridCreator = GridCreator()
+    gridCreator.setCRS('EPSG:25832')
+    gridCreator.setTrackMemory(True)
+    width, height = 2000.0, 3000.0
+    extent = QgsRectangle(500000, 6000000, 500000 + size * width, 6000000 + size * height)
+    aoiLayer = None
+    if withAoi:
+        aoiLayer = QgsVectorLayer("Polygon?crs=EPSG:25832", 'aoi', "memory")
+        feat = QgsFeature()
+        center = extent.center()
+        feat.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(center)).buffer(min(extent.width(), extent.height()) / 2, 64))
+        aoiLayer.dataProvider().addFeatures([feat])
+    gridCreator.createGrid(10000, extent, (width, height, width, height), (size, size), withAoi, aoiLayer)
+    return gridCreator.memoryTracker
+
+
+def runChild(size, withAoi):
+    app = QgsApplication([], False)
+    app.initQgis()
+    tracker = runGrid(size, withAoi)
+    writer = csv.writer(sys.stdout)
+    for stage in tracker.stages:
+        writer.writerow([size, size * size, stage['stage'], '{:.1f}'.format(stage['python_peak'] / MB),
+                         '' if stage['rss_peak'] is None else '{:.1f}'.format(stage['rss_peak'] / MB)])
+    app.exitQgis()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 200, 400, 700, 1000],
+                        help='Numbers of rows (and columns) of the grids')
+    parser.add_argument('--aoi', action='store_true', help='Delete the sheets outside a circular AoI')
+    parser.add_argument('--output', help='CSV file (default: standard output)')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        runChild(args.child, args.aoi)
+        return
+
+    rows = [['rows', 'cells', 'stage', 'python_peak_mb', 'rss_peak_mb']]
+    for size in args.sizes:
+        command = [sys.executable, '-m', __spec__.name, '--child', str(size)] + (['--aoi'] if args.aoi else [])
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        rows += list(csv.reader(result.stdout.splitlines()))
+        print("{} x {} sheets done".format(size, size), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+    else:
+        csv.writer(sys.stdout).writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,584 @@
+# -*- coding: utf-8 -*-
+"""The computational core of AtlasGrid: the grid metrics, the lattice of sheets with their names,
+keys and numbering, the overlap zones and the grouping of sheets, on NumPy arrays.
+
+The module only depends on the standard library and NumPy, so it can be used, tested and
+benchmarked without QGIS. GridCreator adapts it to QGIS layers and geometries.
+"""
+
+import math
+import zlib
+from array import array
+import numpy as np
+
+# Sheet orders
+ORDER_ROWS = 'rows'                 # Row by row, west to east starting with the northernmost row
+ORDER_SERPENTINE = 'serpentine'     # Row by row, alternating west to east and east to west
+ORDER_HILBERT = 'hilbert'           # Along a Hilbert curve starting in the north-west
+ORDER_ZORDER = 'zorder'             # Along a Z-order (Morton) curve starting in the north-west
+SHEET_ORDERS = (ORDER_ROWS, ORDER_SERPENTINE, ORDER_HILBERT, ORDER_ZORDER)
+
+def sheetOrderKeys(row,col,rows,cols,order=ORDER_ROWS):
+    """Returns sort keys for the cells with the given row and column indices (NumPy arrays), so
+    sorting the cells by key gives them in the given order.
+
+    With the locality preserving orders, consecutive sheets are close to each other, so render
+    and tile caches are reused between consecutive atlas pages.
+    """
+    row = np.asarray(row, dtype=np.int64)
+    col = np.asarray(col, dtype=np.int64)
+    if order == ORDER_ROWS:
+        return row * cols + col
+    if order == ORDER_SERPENTINE:
+        return row * cols + np.where(row % 2 == 0, col, cols - 1 - col)
+
+    # The curves are defined on a square of side n (a power of two) covering the lattice
+    bits = max(1, int(max(rows, cols) - 1).bit_length())
+    if order == ORDER_ZORDER:
+        # Interleave the bits of column and row
+        key = np.zeros(row.shape, dtype=np.int64)
+        for b in range(bits):
+            key |= ((col >> b) & 1) << (2 * b)
+            key |= ((row >> b) & 1) << (2 * b + 1)
+        return key
+    if order == ORDER_HILBERT:
+        n = 1 << bits
+        (x,y) = (col.copy(), row.copy())
+        key = np.zeros(row.shape, dtype=np.int64)
+        s = n // 2
+        while s > 0:
+            rx = ((x & s) > 0).astype(np.int64)
+            ry = ((y & s) > 0).astype(np.int64)
+            key += s * s * ((3 * rx) ^ ry)
+            # Rotate the quadrant
+            flip = (ry == 0) & (rx == 1)
+            x = np.where(flip, n - 1 - x, x)
+            y = np.where(flip, n - 1 - y, y)
+            swap = ry == 0
+            (x,y) = (np.where(swap, y, x), np.where(swap, x, y))
+            s //= 2
+        return key
+    raise ValueError("Unknown sheet order: {}".format(order))
+
+# Neighbour directions as (field prefix, row offset, column offset) - rows are numbered from the north
+NEIGHBOURS = (('n',-1,0), ('ne',-1,1), ('e',0,1), ('se',1,1), ('s',1,0), ('sw',1,-1), ('w',0,-1), ('nw',-1,-1))
+
+def sheetDimensions(width,height,mapScale,horizOverlap,vertOverlap):
+    """Returns the real-world (gross) width and height and the net width and height of the sheets of
+    a map of the given width and height (in metres on paper) at the scale 1:mapScale, with the given
+    overlaps in percent of the width and height."""
+    return (width * mapScale, height * mapScale,
+            width * ((100-horizOverlap)/100) * mapScale, height * ((100-vertOverlap)/100) * mapScale)
+
+def fitExtent(xmin,ymin,xmax,ymax,rwDim):
+    """Returns the number of rows and columns of the sheets with the dimensions rwDim (see
+    sheetDimensions) covering an extent, and the extent moved so the grid is centered on the given
+    extent (its xmin and ymax are the north-west corner of the grid)."""
+    (rwWidth,rwHeight,rwWidthNet,rwHeightNet) = rwDim
+    (width,height) = (xmax - xmin, ymax - ymin)
+    cols = int((width-rwWidth) / rwWidthNet) + 2
+    rows = int((height-rwHeight) / rwHeightNet) + 2
+
+    # Adjust extent, so that the grid is centered
+    adjustX = -(rwWidth + (cols-1) * rwWidthNet - width) / 2
+    adjustY = (rwHeight + (rows-1) * rwHeightNet - height) / 2
+    return ((rows,cols),(xmin + adjustX, ymin + adjustY, xmax + adjustX, ymax + adjustY))
+
+def levelFactor(subdivisions,level):
+    # Scale factor of a level of a nested map series relative to the grid itself
+    factor = 1
+    for n in subdivisions[:level]:
+        factor *= n
+    return factor
+
+def numberConsecutively(stores):
+    """Offsets the cell numbers, disjoint cell numbers and print order of the kept cells of each store,
+    so the cells of the stores are numbered consecutively in the order of the stores (e.g. the grids
+    of the clusters of the AoI)."""
+    offset = 0
+    for store in stores:
+        kept = store.keptIndices()
+        for numbers in (store.cellnum, store.dj_cellnum, store.print_order):
+            numbers[kept] += offset
+        offset += len(kept)
+    return
+
+
+class Lattice():
+    """The regular (possibly overlapping) lattice of map sheets.
+
+    Cells are indexed by row (from the north) and column (from the west). All cells have the
+    full (gross) width and height, and neighbouring cells are offset by the net width and
+    height, so they overlap by the difference between gross and net dimensions.
+    """
+
+    def __init__(self,xMin,yMax,width,height,netWidth,netHeight,rows,cols):
+        self.xMin = xMin
+        self.yMax = yMax
+        self.width = width
+        self.height = height
+        self.netWidth = netWidth
+        self.netHeight = netHeight
+        self.rows = rows
+        self.cols = cols
+
+    def params(self):
+        # The parameters of the lattice as a dict (e.g. for storing them with the grid layer)
+        return {'xMin': self.xMin, 'yMax': self.yMax, 'width': self.width, 'height': self.height,
+                'netWidth': self.netWidth, 'netHeight': self.netHeight, 'rows': self.rows, 'cols': self.cols}
+
+    @classmethod
+    def fromParams(cls,params):
+        return cls(float(params['xMin']), float(params['yMax']), float(params['width']), float(params['height']),
+                   float(params['netWidth']), float(params['netHeight']), int(params['rows']), int(params['cols']))
+
+    @property
+    def overlapX(self):
+        return self.width - self.netWidth
+
+    @property
+    def overlapY(self):
+        return self.height - self.netHeight
+
+    def cellBounds(self,row,col):
+        # Works on scalars as well as on NumPy arrays of row and column indices
+        xmin = self.xMin + col * self.netWidth
+        ymax = self.yMax - row * self.netHeight
+        return (xmin, ymax - self.height, xmin + self.width, ymax)
+
+    def netCellBounds(self,row,col):
+        # The cell shrunk to its net width/height (net cells tile the plane without overlap)
+        (xmin,ymin,xmax,ymax) = self.cellBounds(row,col)
+        shrinkX = self.overlapX / 2
+        shrinkY = self.overlapY / 2
+        return (xmin + shrinkX, ymin + shrinkY, xmax - shrinkX, ymax - shrinkY)
+
+    def coreBounds(self,row,col):
+        # The part of the cell not overlapped by any neighbouring cell
+        # Both edges are offset from the same cell edge, so cores without area (interior cells with
+        # 50% overlap) have exactly equal edges
+        (left,ymin,xmax,top) = self.cellBounds(row,col)
+        xmin = left + np.where(col > 0, self.overlapX, 0)
+        xmax = left + np.where(col < self.cols - 1, self.netWidth, self.width)
+        ymin = top - np.where(row < self.rows - 1, self.netHeight, self.height)
+        ymax = top - np.where(row > 0, self.overlapY, 0)
+        return (xmin, ymin, xmax, ymax)
+
+    def indexRange(self,xmin,ymin,xmax,ymax,net=False):
+        """Returns the (inclusive) row and column range (row0,row1,col0,col1) of the cells whose
+        rectangle intersects the given bounding box, or None if no cells intersect it.
+
+        If net is True, the cells are considered shrunk to their net width/height.
+        """
+        if net:
+            (x0,y0) = (self.xMin + self.overlapX / 2, self.yMax - self.overlapY / 2)
+            (w,h) = (self.netWidth, self.netHeight)
+        else:
+            (x0,y0) = (self.xMin, self.yMax)
+            (w,h) = (self.width, self.height)
+
+        # Cells [x0 + j*netWidth, x0 + j*netWidth + w] intersecting [xmin,xmax] (touching included)
+        col0 = max(0, math.ceil((xmin - w - x0) / self.netWidth))
+        col1 = min(self.cols - 1, math.floor((xmax - x0) / self.netWidth))
+        # Cells [y0 - i*netHeight - h, y0 - i*netHeight] intersecting [ymin,ymax]
+        row0 = max(0, math.ceil((y0 - h - ymax) / self.netHeight))
+        row1 = min(self.rows - 1, math.floor((y0 - ymin) / self.netHeight))
+
+        if row0 > row1 or col0 > col1:
+            return None
+        return (row0,row1,col0,col1)
+
+    def cellsIntersecting(self,xmin,ymin,xmax,ymax):
+        """Returns the indices (row-major) of the cells that can intersect a geometry with the given
+        bounding box, and whether the geometry must be tested exactly against them. A point is in
+        all cells of its index range, and a geometry whose bounding box is within a single cell
+        intersects only that cell - otherwise the geometry may miss any of the cells."""
+        indexRange = self.indexRange(xmin,ymin,xmax,ymax)
+        if indexRange is None:
+            return (np.zeros(0, dtype=np.int64), False)
+        (row0,row1,col0,col1) = indexRange
+        (row,col) = np.meshgrid(np.arange(row0, row1 + 1), np.arange(col0, col1 + 1), indexing='ij')
+        cells = (row * self.cols + col).ravel()
+        exact = not (xmin == xmax and ymin == ymax)
+        if exact and len(cells) == 1:
+            (cellXmin,cellYmin,cellXmax,cellYmax) = self.cellBounds(row0,col0)
+            exact = not (cellXmin <= xmin and xmax <= cellXmax and cellYmin <= ymin and ymax <= cellYmax)
+        return (cells, exact)
+
+    def subdivide(self,n):
+        """Returns the lattice of the cells subdividing each cell of this lattice into n by n cells
+        (a map series at n times the scale with the same overlap in percent). The net cells of the
+        finer lattice subdivide the net cells of this lattice, so the parent of cell (row, col)
+        is cell (row // n, col // n)."""
+        (width,height) = (self.width / n, self.height / n)
+        (netWidth,netHeight) = (self.netWidth / n, self.netHeight / n)
+        # The net cells of both lattices start at the same corner
+        xMin = self.xMin + self.overlapX / 2 - (width - netWidth) / 2
+        yMax = self.yMax - self.overlapY / 2 + (height - netHeight) / 2
+        return Lattice(xMin,yMax,width,height,netWidth,netHeight,self.rows * n,self.cols * n)
+
+    def netCellAt(self,x,y):
+        """Returns the row and column indices (NumPy arrays) of the net cells containing the
+        points with coordinates x and y. Net cells tile the plane, so each point is in exactly
+        one of them. Indices outside the lattice are returned as -1."""
+        col = np.floor((np.asarray(x) - self.xMin - self.overlapX / 2) / self.netWidth).astype(np.int64)
+        row = np.floor((self.yMax - self.overlapY / 2 - np.asarray(y)) / self.netHeight).astype(np.int64)
+        inside = (row >= 0) & (row < self.rows) & (col >= 0) & (col < self.cols)
+        return (np.where(inside, row, -1), np.where(inside, col, -1))
+
+    def cellsAt(self,x,y):
+        """Returns the row and column indices of all cells containing the points with coordinates x
+        and y as two (n, k) arrays, where k is the largest possible number of cells containing a
+        point. Unused entries and cells outside the lattice are -1."""
+        (x,y) = (np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        # Cells [xMin + j*netWidth, xMin + j*netWidth + width] containing x
+        col0 = np.ceil((x - self.xMin - self.width) / self.netWidth).astype(np.int64)
+        row0 = np.ceil((self.yMax - self.height - y) / self.netHeight).astype(np.int64)
+        nCols = int(math.floor(self.width / self.netWidth)) + 1
+        nRows = int(math.floor(self.height / self.netHeight)) + 1
+        (rows,cols) = ([], [])
+        for dRow in range(nRows):
+            for dCol in range(nCols):
+                (row,col) = (row0 + dRow, col0 + dCol)
+                (xmin,ymin,xmax,ymax) = self.cellBounds(row,col)
+                valid = (row >= 0) & (row < self.rows) & (col >= 0) & (col < self.cols) & \
+                        (xmin <= x) & (x <= xmax) & (ymin <= y) & (y <= ymax)
+                rows.append(np.where(valid, row, -1))
+                cols.append(np.where(valid, col, -1))
+        return (np.stack(rows, axis=1), np.stack(cols, axis=1))
+
+    def sheetsAt(self,x,y,cellnum):
+        """Returns the sheets containing the points with coordinates x and y, given the cellnum of
+        each cell (0 for cells without a sheet): the cell indices of the sheets as an (n, k) array,
+        sorted so the sheet whose net cell contains the point comes first and the other sheets
+        follow by cellnum, their cellnums (0 for unused entries) and the number of sheets
+        containing each point."""
+        (rows,cols) = self.cellsAt(x,y)
+        index = np.where(rows >= 0, rows * self.cols + cols, 0)
+        nums = np.where(rows >= 0, np.asarray(cellnum)[index], 0)
+        (netRow,netCol) = self.netCellAt(x,y)
+        netIndex = np.where(netRow >= 0, netRow * self.cols + netCol, -1)
+        keys = np.where(nums > 0, nums, np.iinfo(np.int64).max)
+        keys = np.where((index == netIndex[:,None]) & (nums > 0), 0, keys)
+        order = np.argsort(keys, axis=1, kind='stable')
+        index = np.take_along_axis(index, order, axis=1)
+        nums = np.take_along_axis(nums, order, axis=1)
+        return (index, nums, np.count_nonzero(nums > 0, axis=1))
+
+    # Bits of the cell keys - a lattice id followed by the row and column index
+    KEY_ID_BITS = 23
+    KEY_INDEX_BITS = 20
+
+    def latticeId(self):
+        # Hash of the lattice parameters (rounded to millimetres), so lattices created with the
+        # same origin, cell size and overlap get the same id independently of the AoI
+        params = (self.xMin, self.yMax, self.width, self.height, self.netWidth, self.netHeight)
+        text = ",".join("{:.3f}".format(p) for p in params)
+        return zlib.crc32(text.encode()) & ((1 << self.KEY_ID_BITS) - 1)
+
+    def cellKey(self,row,col):
+        """Returns a stable, positive 64 bit key of the cells with the given row and column indices
+        (scalars or NumPy arrays). The key only depends on the lattice parameters and the index, so it
+        does not change when cells are deleted or renumbered."""
+        mask = (1 << self.KEY_INDEX_BITS) - 1
+        row = np.asarray(row, dtype=np.int64) & mask
+        col = np.asarray(col, dtype=np.int64) & mask
+        return (self.latticeId() << (2 * self.KEY_INDEX_BITS)) | (row << self.KEY_INDEX_BITS) | col
+
+    @classmethod
+    def splitKey(cls,key):
+        # The (row, col) of cell keys
+        mask = (1 << cls.KEY_INDEX_BITS) - 1
+        key = np.asarray(key, dtype=np.int64)
+        return ((key >> cls.KEY_INDEX_BITS) & mask, key & mask)
+
+    @staticmethod
+    def columnName(col):
+        # A-Z, followed by AA-AZ, BA-BZ etc.
+        if col < 26:
+            return chr(ord('A') + col)
+        return chr(ord('A') + col // 26 - 1) + chr(ord('A') + col % 26)
+
+    def cellName(self,row,col):
+        return "{}{}".format(self.columnName(col), row + 1)
+
+    @staticmethod
+    def parseCellName(name):
+        # The (row, col) of a cell name, e.g. AB12 -> (11, 27)
+        letters = name.rstrip('0123456789')
+        if not letters or len(letters) > 2 or len(letters) == len(name):
+            raise ValueError("Invalid cell name: {}".format(name))
+        col = ord(letters[-1]) - ord('A')
+        if len(letters) == 2:
+            col += (ord(letters[0]) - ord('A') + 1) * 26
+        return (int(name[len(letters):]) - 1, col)
+
+
+class UnionFind():
+    """Disjoint sets over the integers 0..n-1"""
+
+    def __init__(self,n):
+        # A typed array is faster than a NumPy array for the element-wise access below
+        self.parent = array('q', range(n))
+
+    def find(self,i):
+        parent = self.parent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        # Path compression
+        while parent[i] != root:
+            (parent[i], i) = (root, parent[i])
+        return root
+
+    def union(self,i,j):
+        (ri,rj) = (self.find(i), self.find(j))
+        if ri != rj:
+            # The smallest index becomes the root
+            if ri < rj:
+                self.parent[rj] = ri
+            else:
+                self.parent[ri] = rj
+        return
+
+    def labels(self):
+        return np.array([self.find(i) for i in range(len(self.parent))], dtype=np.int64)
+
+
+class CellStore():
+    """Column store of the cells of a lattice.
+
+    Each cell has a row, a column, a keep flag, a cell number, a disjoint cell number and the
+    fractions of the sheet and of its net rectangle covered by the AoI held in typed arrays,
+    while the cell geometry is derived from the lattice when needed. All stages of the grid
+    creation work on the store, and features are only created for the output.
+    Cells are stored in row-major order (west to east, starting with the northernmost row).
+    """
+
+    def __init__(self,lattice):
+        self.lattice = lattice
+        index = np.arange(lattice.rows * lattice.cols, dtype=np.int64)
+        self.row = (index // lattice.cols).astype(np.int32)
+        self.col = (index % lattice.cols).astype(np.int32)
+        self.keep = np.ones(len(index), dtype=np.bool_)
+        self.cellnum = np.zeros(len(index), dtype=np.int32)
+        self.dj_cellnum = np.zeros(len(index), dtype=np.int32)
+        self.print_order = np.zeros(len(index), dtype=np.int32)
+        self.coverage = np.zeros(len(index), dtype=np.float64)
+        self.net_coverage = np.zeros(len(index), dtype=np.float64)
+
+    def __len__(self):
+        return len(self.row)
+
+    def cellIndex(self,row,col):
+        return row * self.lattice.cols + col
+
+    def keptIndices(self):
+        return np.flatnonzero(self.keep)
+
+    def bounds(self,indices):
+        return self.lattice.cellBounds(self.row[indices], self.col[indices])
+
+    def cellName(self,i):
+        return self.lattice.cellName(int(self.row[i]), int(self.col[i]))
+
+    def cellKey(self,indices):
+        return self.lattice.cellKey(self.row[indices], self.col[indices])
+
+    def keptInOrder(self,order=ORDER_ROWS):
+        kept = self.keptIndices()
+        keys = sheetOrderKeys(self.row[kept], self.col[kept], self.lattice.rows, self.lattice.cols, order)
+        return kept[np.argsort(keys, kind='stable')]
+
+    def number(self,order=ORDER_ROWS):
+        # Number the kept cells consecutively in the given order
+        self.cellnum[:] = 0
+        self.cellnum[self.keptInOrder(order)] = np.arange(1, np.count_nonzero(self.keep) + 1, dtype=np.int32)
+        return
+
+    def numberPrintOrder(self,order):
+        # Number the kept cells in the given order without changing the cell numbers
+        self.print_order[:] = 0
+        self.print_order[self.keptInOrder(order)] = np.arange(1, np.count_nonzero(self.keep) + 1, dtype=np.int32)
+        return
+
+    def numberDisjoint(self,labels):
+        """Numbers the kept cells consecutively within each group of connected cells.
+
+        The groups are numbered in order of their lowest cell number, and the cells within a
+        group by cell number. labels holds a label of the group of each cell of the store, in
+        the range of the cell indices (e.g. UnionFind.labels()).
+        """
+        kept = self.keptIndices()
+        labels = np.asarray(labels)[kept]
+        # Lowest cell number within the group of each cell
+        first = np.full(len(self), np.iinfo(np.int32).max, dtype=np.int64)
+        np.minimum.at(first, labels, self.cellnum[kept])
+        order = np.lexsort((self.cellnum[kept], first[labels]))
+        self.dj_cellnum[:] = 0
+        self.dj_cellnum[kept[order]] = np.arange(1, len(kept) + 1, dtype=np.int32)
+        return
+
+    def numberDisjointGroups(self,cells,groups):
+        """Numbers the kept cells consecutively within each group of connected cells (see
+        numberDisjoint), where cells are connected if they belong to the same group. cells and
+        groups are arrays of (cell index, group) pairs, and a cell may belong to several groups."""
+        cells = np.asarray(cells, dtype=np.int64)
+        (groupIds,groupIndex) = np.unique(np.asarray(groups), return_inverse=True)
+        # The lowest cell index of each set of connected cells is propagated through the groups until
+        # no label changes (labels are cell indices, so the label of a label is a lower label of the same set)
+        labels = np.arange(len(self), dtype=np.int64)
+        while True:
+            groupLabels = np.full(len(groupIds), len(self), dtype=np.int64)
+            np.minimum.at(groupLabels, groupIndex, labels[cells])
+            updated = labels.copy()
+            np.minimum.at(updated, cells, groupLabels[groupIndex])
+            updated = updated[updated]
+            if (updated == labels).all():
+                break
+            labels = updated
+        self.numberDisjoint(labels)
+        return
+
+    def childCandidates(self,n):
+        """Returns a mask over the cells of the lattice subdivided n times (see Lattice.subdivide),
+        that can intersect the AoI given the keep flags of this store: the children of the kept
+        cells and of their neighbours. A cell whose net rectangle intersects the AoI is either kept
+        or only intersects it in overlaps shared with a kept neighbour, so all children
+        intersecting the AoI are in the mask."""
+        lattice = self.lattice
+        keep = self.keep.reshape(lattice.rows, lattice.cols)
+        dilated = keep.copy()
+        dilated[1:,:] |= keep[:-1,:]
+        dilated[:-1,:] |= keep[1:,:]
+        dilated[:,1:] |= dilated[:,:-1].copy()
+        dilated[:,:-1] |= dilated[:,1:].copy()
+        return np.repeat(np.repeat(dilated, n, axis=0), n, axis=1).ravel()
+
+    def neighbour(self,indices,dRow,dCol):
+        """Returns the index of the kept neighbour of each of the given cells in the direction
+        (dRow,dCol), or -1 where the neighbour is outside the lattice or deleted"""
+        row = self.row[indices] + dRow
+        col = self.col[indices] + dCol
+        inside = (row >= 0) & (row < self.lattice.rows) & (col >= 0) & (col < self.lattice.cols)
+        nb = np.where(inside, self.cellIndex(row, col), 0)
+        return np.where(inside & self.keep[nb], nb, -1)
+
+    def degenerateCores(self):
+        # Mask of the cells whose core has no area - with 50% overlap, the interior cells are completely
+        # overlapped by their neighbours
+        (xmin,ymin,xmax,ymax) = self.lattice.coreBounds(self.row, self.col)
+        return (xmin >= xmax) | (ymin >= ymax)
+
+    def keepCores(self,intersecting,candidates=None):
+        """Keeps the cells whose core intersects the AoI (a mask over the cells) and deletes the
+        others. Cells whose core has no area cannot be classified by their core, and are never
+        deleted. With candidates (a mask over the cells), only those cells are kept."""
+        self.keep[:] = intersecting | self.degenerateCores()
+        if candidates is not None:
+            self.keep &= candidates
+        return
+
+    def keepZone(self,sharing):
+        # Keep the last (south-eastern most) of the cells sharing an overlap zone
+        self.keep[max(sharing)] = True
+        return
+
+    def zoneBounds(self,i,offsets):
+        # Bounds of the overlap zones of the cells i (NumPy array) shared with the neighbours at the given offsets
+        lattice = self.lattice
+        (row,col) = (self.row[i], self.col[i])
+        (xmin,ymin,xmax,ymax) = lattice.coreBounds(row,col)
+        if (0,1) in offsets:
+            # From the left edge of the eastern neighbour to the right edge of the cell
+            xmin = lattice.xMin + (col + 1) * lattice.netWidth
+            xmax = xmin + lattice.overlapX
+        if (1,0) in offsets:
+            # From the top edge of the southern neighbour to the bottom edge of the cell
+            ymax = lattice.yMax - (row + 1) * lattice.netHeight
+            ymin = ymax - lattice.overlapY
+        return (xmin,ymin,xmax,ymax)
+
+    def cellZones(self,i):
+        """Returns the zones of cell i as (bounds, indices of the other cells sharing the zone): the
+        core, shared with no other cell, and the overlap zones shared with the neighbours (with the
+        neighbouring row, column or both). Empty zones (e.g. without overlap) are left out."""
+        lattice = self.lattice
+        (row,col) = (int(self.row[i]), int(self.col[i]))
+        (xmin,ymin,xmax,ymax) = lattice.cellBounds(row,col)
+        (coreXmin,coreYmin,coreXmax,coreYmax) = (float(b) for b in lattice.coreBounds(row,col))
+        # Extent of the zones by column and row offset of the sharing neighbours (rows are numbered from the north)
+        xs = {-1: (xmin,coreXmin), 0: (coreXmin,coreXmax), 1: (coreXmax,xmax)}
+        ys = {-1: (coreYmax,ymax), 0: (coreYmin,coreYmax), 1: (ymin,coreYmin)}
+        zones = []
+        for dRow in (-1,0,1):
+            for dCol in (-1,0,1):
+                ((x0,x1),(y0,y1)) = (xs[dCol], ys[dRow])
+                if x0 >= x1 or y0 >= y1:
+                    continue
+                # The core bounds only leave zones towards neighbours inside the lattice
+                others = [self.cellIndex(row + r, col + c) for r in sorted({0,dRow}) for c in sorted({0,dCol}) if (r,c) != (0,0)]
+                zones.append(((x0,y0,x1,y1), others))
+        return zones
+
+    def lowCoverage(self,minCoverage):
+        # The kept cells covered less than minCoverage, least covered first. Cells whose core has no
+        # area are never deleted, so they are left out
+        low = self.keptIndices()
+        low = low[(self.coverage[low] < minCoverage) & ~self.degenerateCores()[low]]
+        return low[np.argsort(self.coverage[low], kind='stable')]
+
+    def coveredByOthers(self,i,clippedArea,tolerance=0):
+        """Returns whether the AoI on cell i is only within zones shared with other kept cells, so
+        the cell can be deleted without leaving AoI uncovered. The core of a cell is not shared, so
+        the AoI may at most touch it. clippedArea(xmin,ymin,xmax,ymax) returns the area of the AoI
+        within a rectangle, and areas up to the tolerance are ignored."""
+        for (bounds,others) in self.cellZones(i):
+            if not self.keep[others].any() and clippedArea(*bounds) > tolerance:
+                return False
+        return True
+
+    def overlapZones(self,select=None):
+        """Generates the zones shared by neighbouring cells, that none of the sharing cells
+        keeps, as (bounds, sharing cell indices) in row-major order of the cells.
+
+        The keep flags are checked when each zone is generated, so cells kept by the caller
+        while iterating are taken into account. If select is given, it is called with the
+        bounds (xmin,ymin,xmax,ymax) of all candidate zones as NumPy arrays and returns a mask
+        of the zones to generate.
+        """
+        lattice = self.lattice
+        (rows,cols) = (lattice.rows, lattice.cols)
+        candidates = []
+        # East zones (shared with the eastern neighbour), south zones and south-east corners
+        kinds = []
+        if lattice.overlapX > 0 and cols > 1:
+            kinds.append(((0,1),))
+        if lattice.overlapY > 0 and rows > 1:
+            kinds.append(((1,0),))
+        if lattice.overlapX > 0 and lattice.overlapY > 0 and cols > 1 and rows > 1:
+            kinds.append(((0,1),(1,0),(1,1)))
+
+        for (k,offsets) in enumerate(kinds):
+            maxRow = rows - 1 - max(dRow for (dRow,dCol) in offsets)
+            maxCol = cols - 1 - max(dCol for (dRow,dCol) in offsets)
+            owner = np.flatnonzero((self.row <= maxRow) & (self.col <= maxCol))
+            kept = self.keep[owner].copy()
+            for (dRow,dCol) in offsets:
+                kept |= self.keep[owner + dRow * cols + dCol]
+            owner = owner[~kept]
+            bounds = self.zoneBounds(owner,offsets)
+            # Zones without area (next to cores without area) are left out, as in cellZones
+            nonEmpty = (bounds[0] < bounds[2]) & (bounds[1] < bounds[3])
+            (owner,bounds) = (owner[nonEmpty], [b[nonEmpty] for b in bounds])
+            if select is not None:
+                selected = np.asarray(select(*bounds), dtype=np.bool_)
+                (owner,bounds) = (owner[selected], [b[selected] for b in bounds])
+            candidates.extend(zip(owner.tolist(), [k] * len(owner), zip(*(b.tolist() for b in bounds))))
+
+        candidates.sort(key=lambda candidate: candidate[:2])
+        for (i,k,bounds) in candidates:
+            sharing = [i] + [i + dRow * cols + dCol for (dRow,dCol) in kinds[k]]
+            if self.keep[sharing].any():
+                continue
+            yield (bounds, sharing)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Headless export of a range of atlas pages.
+
+Started by the AtlasGrid atlas export algorithm in a separate process for each part of
+the atlas. The atlas of a layout is prepared as for a serial export (with the filter and
+sort order of the layout), and worker k of n exports the k-th of n contiguous ranges of its
+pages, either to a PDF per page (named by the page number and the atlas file name, for
+merging in page order) or to a PNG per page (named by the atlas file name). As the pages
+are taken from the whole atlas, @atlas_featurenumber, @atlas_totalfeatures and the file
+names are those of a serial export.
+"""
+
+import argparse
+import os
+import sys
+
+from qgis.core import QgsApplication, QgsProject, QgsVectorLayer, QgsLayoutExporter
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--project', required=True)
+    parser.add_argument('--layout', required=True)
+    parser.add_argument('--coverage-id', help='Id of the coverage layer in the project')
+    parser.add_argument('--coverage-file', help='Data source of the coverage layer (if not saved in the project)')
+    parser.add_argument('--worker', type=int, required=True, help='Number of this worker (from 0)')
+    parser.add_argument('--workers', type=int, required=True, help='Number of workers')
+    parser.add_argument('--format', choices=('pdf', 'png'), default='pdf')
+    parser.add_argument('--output', required=True, help='Folder for the PDF or PNG files')
+    args = parser.parse_args()
+
+    app = QgsApplication([], False)
+    app.initQgis()
+    try:
+        project = QgsProject.instance()
+        if not project.read(args.project):
+            sys.stderr.write("Could not read project {}\n".format(args.project))
+            return 1
+
+        layout = project.layoutManager().layoutByName(args.layout)
+        if layout is None:
+            sys.stderr.write("Print layout {} not found\n".format(args.layout))
+            return 1
+
+        if args.coverage_file:
+            coverage = QgsVectorLayer(args.coverage_file, 'AtlasGrid', 'ogr')
+            project.addMapLayer(coverage, False)
+        else:
+            coverage = project.mapLayer(args.coverage_id)
+        if coverage is None or not coverage.isValid():
+            sys.stderr.write("Coverage layer not found\n")
+            return 1
+
+        # The atlas of the layout with the coverage layer, keeping the filter and sort order of the layout
+        atlas = layout.atlas()
+        atlas.setCoverageLayer(coverage)
+        atlas.setEnabled(True)
+        if not atlas.beginRender():
+            # No pages
+            return 0
+        try:
+            # The pages of this worker
+            n = atlas.count()
+            (first,last) = (round(args.worker * n / args.workers), round((args.worker + 1) * n / args.workers))
+            exporter = QgsLayoutExporter(layout)
+            for page in range(first, last):
+                if not atlas.seekTo(page):
+                    sys.stderr.write("Could not prepare page {}\n".format(page + 1))
+                    return 1
+                filename = atlas.currentFilename() or 'page_{}'.format(page + 1)
+                if args.format == 'pdf':
+                    path = os.path.join(args.output, '{:06d}_{}.pdf'.format(page + 1, filename))
+                    result = exporter.exportToPdf(path, QgsLayoutExporter.PdfExportSettings())
+                else:
+                    path = os.path.join(args.output, '{}.png'.format(filename))
+                    result = exporter.exportToImage(path, QgsLayoutExporter.ImageExportSettings())
+                if result != QgsLayoutExporter.ExportResult.Success:
+                    sys.stderr.write("Export of page {} to {} failed ({})\n".format(page + 1, path, result))
+                    return 1
+        finally:
+            atlas.endRender()
+        return 0
+    finally:
+        app.exitQgis()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""Expression functions for AtlasGrid layers.
+
+The functions compute sheets arithmetically from the lattice of a grid layer instead of
+querying the layer, e.g. for labels and atlas filters evaluated for each page. The grid
+layer is an optional last argument (layer id, name or layer) and defaults to the atlas
+coverage layer or the layer of the expression context. It must be a layer of the project.
+"""
+
+import threading
+from qgis.core import QgsExpression, QgsProject, QgsMapLayer, QgsVectorLayer, QgsVectorLayerFeatureSource, \
+    QgsGeometry, QgsRectangle, qgsfunction
+from .gridlayer import GridLayer, LATTICE_PROPERTY
+from .cellstore import NEIGHBOURS
+
+class _GridSource():
+    """A snapshot of a grid layer taken in the main thread. Expressions are also evaluated in render
+    and atlas threads, where the layer must not be accessed, so the grid is read from a feature
+    source of the layer by whichever thread needs it first."""
+
+    def __init__(self,layer):
+        self.name = layer.name()
+        self.crs = layer.crs()
+        self.fields = layer.fields()
+        self.params = layer.customProperty(LATTICE_PROPERTY)
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.grid = None
+        self.lock = threading.Lock()
+
+    def gridLayer(self):
+        with self.lock:
+            if self.grid is None:
+                self.grid = GridLayer.fromSource(self.name,self.crs,self.fields,self.params,self.source)
+            return self.grid
+
+# Snapshots of the grid layers of the project by layer id, replaced in the main thread when a layer changes
+_sources = {}
+_sourcesLock = threading.Lock()
+# Signal connections (signal, slot) by layer id (None for the project), disconnected when unregistering
+_connections = {}
+
+def _isGridLayer(layer):
+    fields = layer.fields()
+    return fields.indexOf('cellname') >= 0 and fields.indexOf('cellnum') >= 0
+
+def _connect(key,signal,slot):
+    signal.connect(slot)
+    _connections.setdefault(key, []).append((signal,slot))
+    return
+
+def _disconnect(key):
+    for (signal,slot) in _connections.pop(key, []):
+        try:
+            signal.disconnect(slot)
+        except (RuntimeError, TypeError):
+            # The layer is already deleted
+            pass
+    return
+
+def _update(layer):
+    # Main thread: take a new snapshot of a changed layer
+    source = _GridSource(layer) if _isGridLayer(layer) else None
+    with _sourcesLock:
+        if source is None:
+            _sources.pop(layer.id(), None)
+        else:
+            _sources[layer.id()] = source
+    return
+
+def _watch(layers):
+    # Main thread: follow the vector layers added to the project (fields may be added later)
+    for layer in layers:
+        if not isinstance(layer, QgsVectorLayer):
+            continue
+        _update(layer)
+        update = lambda *args, layer=layer: _update(layer)
+        for signal in (layer.dataChanged, layer.updatedFields, layer.customPropertyChanged, layer.nameChanged):
+            _connect(layer.id(), signal, update)
+    return
+
+def _unwatch(layerIds):
+    for layerId in layerIds:
+        _disconnect(layerId)
+        with _sourcesLock:
+            _sources.pop(layerId, None)
+    return
+
+def _gridLayer(values,nArgs,context):
+    # The GridLayer for the optional layer argument after the first nArgs arguments
+    layer = values[nArgs] if len(values) > nArgs else None
+    if layer is None and context is not None:
+        layer = context.variable('atlas_layerid') or context.variable('layer_id')
+    if layer is None:
+        raise ValueError('No AtlasGrid layer given')
+    key = layer.id() if isinstance(layer, QgsMapLayer) else str(layer)
+    with _sourcesLock:
+        source = _sources.get(key) or next((source for source in _sources.values() if source.name == key), None)
+    if source is None:
+        raise ValueError('AtlasGrid layer not found in the project')
+    return source.gridLayer()
+
+def _cellIndex(grid,cellname):
+    # The index of the sheet with the given name, or None if it is not in the layer
+    lattice = grid.lattice
+    (row,col) = lattice.parseCellName(str(cellname))
+    if row < 0 or row >= lattice.rows or col < 0 or col >= lattice.cols:
+        return None
+    i = row * lattice.cols + col
+    return i if grid.cellnum[i] > 0 else None
+
+@qgsfunction(args=-1, group='AtlasGrid', referenced_columns=[], register=False)
+def atlasgrid_sheet_at(values, feature, parent, context):
+    """
+    Returns the name of the AtlasGrid sheet containing a point. Where sheets overlap, this is the sheet whose
+    net cell (the sheet shrunk by half the overlap on each side, so the net cells tile the plane) contains the
+    point, or if that sheet is not in the layer, the sheet with the lowest cellnum containing the point.
+    Returns NULL outside the sheets of the grid.
+    <h4>Syntax</h4>
+    <p><b>atlasgrid_sheet_at</b>(x, y[, layer])</p>
+    <h4>Arguments</h4>
+    <p><b>x, y</b>: coordinates in the CRS of the grid layer<br>
+    <b>layer</b>: the AtlasGrid layer (default: the atlas coverage layer or the current layer)</p>
+    <h4>Example</h4>
+    <p>atlasgrid_sheet_at(x(@geometry), y(@geometry)) &rarr; 'B4'</p>
+    """
+    grid = _gridLayer(values, 2, context)
+    lattice = grid.lattice
+    (x,y) = (float(values[0]), float(values[1]))
+    (rows,cols) = lattice.cellsAt([x], [y])
+    (netRow,netCol) = lattice.netCellAt([x], [y])
+    candidates = [(int(netRow[0]), int(netCol[0]))] + sorted(zip(rows[0].tolist(), cols[0].tolist()),
+                  key=lambda rc: grid.cellnum[rc[0] * lattice.cols + rc[1]] if rc[0] >= 0 else 0)
+    for (row,col) in candidates:
+        if row >= 0 and grid.cellnum[row * lattice.cols + col] > 0:
+            return lattice.cellName(row, col)
+    return None
+
+@qgsfunction(args=-1, group='AtlasGrid', referenced_columns=[], register=False)
+def atlasgrid_neighbor(values, feature, parent, context):
+    """
+    Returns the name of the adjoining AtlasGrid sheet in a direction, or NULL if there is no sheet there.
+    <h4>Syntax</h4>
+    <p><b>atlasgrid_neighbor</b>(cellname, direction[, layer])</p>
+    <h4>Arguments</h4>
+    <p><b>cellname</b>: name of the sheet<br>
+    <b>direction</b>: one of 'N', 'NE', 'E', 'SE', 'S', 'SW', 'W' and 'NW'<br>
+    <b>layer</b>: the AtlasGrid layer (default: the atlas coverage layer or the current layer)</p>
+    <h4>Example</h4>
+    <p>atlasgrid_neighbor("cellname", 'N') &rarr; 'B3'</p>
+    """
+    if values[0] is None:
+        return None
+    grid = _gridLayer(values, 2, context)
+    lattice = grid.lattice
+    directions = {direction.upper(): (dRow,dCol) for (direction,dRow,dCol) in NEIGHBOURS}
+    direction = str(values[1]).upper()
+    if direction not in directions:
+        raise ValueError('Unknown direction: {}'.format(values[1]))
+    (row,col) = lattice.parseCellName(str(values[0]))
+    (row,col) = (row + directions[direction][0], col + directions[direction][1])
+    if row < 0 or row >= lattice.rows or col < 0 or col >= lattice.cols or grid.cellnum[row * lattice.cols + col] == 0:
+        return None
+    return lattice.cellName(row, col)
+
+@qgsfunction(args=-1, group='AtlasGrid', referenced_columns=[], register=False)
+def atlasgrid_sheet_extent(values, feature, parent, context):
+    """
+    Returns the rectangle of an AtlasGrid sheet as a polygon, or NULL if there is no sheet with the name.
+    <h4>Syntax</h4>
+    <p><b>atlasgrid_sheet_extent</b>(cellname[, layer])</p>
+    <h4>Arguments</h4>
+    <p><b>cellname</b>: name of the sheet<br>
+    <b>layer</b>: the AtlasGrid layer (default: the atlas coverage layer or the current layer)</p>
+    <h4>Example</h4>
+    <p>atlasgrid_sheet_extent(atlasgrid_neighbor("cellname", 'E'))</p>
+    """
+    if values[0] is None:
+        return None
+    grid = _gridLayer(values, 1, context)
+    i = _cellIndex(grid, values[0])
+    if i is None:
+        return None
+    lattice = grid.lattice
+    (xmin,ymin,xmax,ymax) = lattice.cellBounds(i // lattice.cols, i % lattice.cols)
+    return QgsGeometry.fromRect(QgsRectangle(xmin, ymin, xmax, ymax))
+
+FUNCTIONS = (atlasgrid_sheet_at, atlasgrid_neighbor, atlasgrid_sheet_extent)
+
+def registerFunctions():
+    # Must be called in the main thread, where the layers of the project are followed
+    if None in _connections:
+        # Already registered
+        return
+    for function in FUNCTIONS:
+        QgsExpression.registerFunction(function)
+    project = QgsProject.instance()
+    _connect(None, project.layersAdded, _watch)
+    _connect(None, project.layersWillBeRemoved, _unwatch)
+    _watch(project.mapLayers().values())
+    return
+
+def unregisterFunctions():
+    for function in FUNCTIONS:
+        QgsExpression.unregisterFunction(function.name())
+    for key in list(_connections):
+        _disconnect(key)
+    with _sourcesLock:
+        _sources.clear()
+    return
@@ -1,19 +1,46 @@
 # -*- coding: utf-8 -*-
 
-from qgis.PyQt.QtCore import QVariant, QMetaType
-from qgis.core import Qgis, QgsProject, QgsVectorLayer, QgsFeature, QgsFeatureRequest, QgsExpression, QgsMessageLog, \
-                      QgsField, QgsRectangle, QgsGeometry, QgsVector, QgsLayoutMeasurement, QgsLayoutMeasurementConverter, \
-                      QgsCoordinateReferenceSystem, QgsProcessingFeatureSourceDefinition
-from qgis.core.additions.edit import edit
-from qgis.utils import iface
-from qgis import processing
+import numpy as np
+from contextlib import nullcontext
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import Qgis, QgsVectorLayer, QgsFeature, QgsMessageLog, QgsField, QgsRectangle, QgsGeometry, \
+                      QgsLayoutMeasurement, QgsLayoutMeasurementConverter, QgsCoordinateReferenceSystem, \
+                      QgsProcessingContext
+from .cellstore import Lattice, CellStore, ORDER_ROWS, NEIGHBOURS, sheetDimensions, fitExtent, levelFactor, numberConsecutively
+from .aoi import AoiIndex
+from .gridlayer import storeLattice
+from .scanline import NetCellRaster, ZoneRaster, PixelRaster, OUTSIDE, INSIDE, BOUNDARY
+from .memorytracker import MemoryTracker, MB
 
 class GridCreator():
-    feedback = None
-    crs = None
-    
+
     def __init__(self):
-        pass
+        # All state is kept per instance, so several grids can be created
+        # concurrently (e.g. batch processing running in background threads).
+        # Intermediate data is kept in the cell store and the AoI index, and
+        # no layer is added to the project
+        self.feedback = None
+        self.crs = None
+        self.context = QgsProcessingContext()
+        self.neighbourFields = False
+        self.adjacencyTable = False
+        self.adjacencyLayer = None
+        self.sheetOrder = ORDER_ROWS
+        self.printOrderField = False
+        self.approximate = False
+        self.pixelSize = 0
+        self.compareExact = False
+        self.approximateDifferences = None
+        self.simplifyTolerance = 0
+        self.lattice = None
+        self.subdivisions = ()
+        self.clusterGrids = False
+        self.clusterDistance = 0
+        self.coverage = False
+        self.minCoverage = 0
+        self.masks = False
+        self.maskLayer = None
+        self.memoryTracker = None
 
     def setCRS(self,crs):
         self.crs = crs
@@ -22,6 +49,94 @@ class GridCreator():
         self.feedback = feedback
         return
 
+    def setNeighbourFields(self,neighbourFields):
+        # Write the names of the adjoining sheets (n_sheet, ne_sheet, ... ) on each sheet
+        self.neighbourFields = neighbourFields
+        return
+
+    def setAdjacencyTable(self,adjacencyTable):
+        # Create a table with a row for each pair of adjoining sheets (available as adjacencyLayer)
+        self.adjacencyTable = adjacencyTable
+        return
+
+    def setSheetOrder(self,sheetOrder,printOrderField=False):
+        # Order in which the sheets are numbered (see cellstore.SHEET_ORDERS). With printOrderField,
+        # the order is written to a print_order field, and cellnum is numbered row by row
+        self.sheetOrder = sheetOrder
+        self.printOrderField = printOrderField
+        return
+
+    def setApproximate(self,approximate,pixelSize=0,compareExact=False):
+        # Classify the sheets on a conservative bitmap of the AoI with the given pixel size (0 = half
+        # the net sheet size) instead of exact geometry tests. No sheet intersecting the AoI is deleted,
+        # but some sheets may be kept that exact classification deletes. With compareExact, exact
+        # classification is run as well, and the number of differences is reported
+        self.approximate = approximate
+        self.pixelSize = pixelSize
+        self.compareExact = compareExact
+        return
+
+    def setSimplifyTolerance(self,simplifyTolerance):
+        # Simplify the AoI outward with the given tolerance before testing the sheets (0 = no
+        # simplification). Sheets may be kept within the tolerance of the AoI, but none is deleted
+        self.simplifyTolerance = simplifyTolerance
+        return
+
+    def setSubdivisions(self,subdivisions):
+        # Create a nested map series: after the grid itself, a level is created for each factor, with
+        # each sheet of the previous level subdivided into factor x factor sheets. All levels are
+        # written to the output layer with the fields level, scale, parent_name and parent_key
+        self.subdivisions = tuple(int(n) for n in subdivisions)
+        return
+
+    def setClusterGrids(self,clusterGrids,clusterDistance=0):
+        # Instead of one grid over the extent, create a separate grid centered on each cluster of AoI
+        # parts closer than clusterDistance (0 = the sheet size) to each other. The sheets are numbered
+        # consecutively over all clusters and get a cluster field, and the cluster number is prefixed
+        # to the cell names
+        self.clusterGrids = clusterGrids
+        self.clusterDistance = clusterDistance
+        return
+
+    def setCoverage(self,coverage,minCoverage=0):
+        # Write the fractions of each sheet and of its net rectangle covered by the AoI to the coverage and
+        # net_coverage fields. Sheets covered less than minCoverage (a fraction) are deleted, if the
+        # AoI on them is within overlaps with other kept sheets (only for AoIs of polygons)
+        self.coverage = coverage
+        self.minCoverage = minCoverage
+        return
+
+    def setMasks(self,masks):
+        # Create a layer with the part of each sheet outside the AoI, keyed by cellnum (available as
+        # maskLayer), e.g. to grey out the surroundings of the AoI on each atlas page
+        self.masks = masks
+        return
+
+    def setTrackMemory(self,trackMemory):
+        # Record the Python allocations and the RSS of the process for each stage of createGrid (available
+        # as memoryTracker and reported at the end)
+        self.memoryTracker = MemoryTracker() if trackMemory else None
+        return
+
+    def setContext(self,context):
+        # Coordinate transforms use the transform context of this context
+        self.context = context
+        return
+
+    def setProgress(self,progress):
+        if self.feedback:
+            self.feedback.setProgress(progress)
+        return
+
+    def isCanceled(self):
+        return self.feedback is not None and self.feedback.isCanceled()
+
+    def stage(self,name):
+        # Context of a stage of createGrid, recording its memory use if memory is tracked
+        if self.memoryTracker is None:
+            return nullcontext()
+        return self.memoryTracker.stage(name)
+
     def logMessage(self,message,level=Qgis.MessageLevel.Info):
         if self.feedback:
             self.feedback.pushInfo(message)
@@ -39,325 +154,472 @@ class GridCreator():
         height_map_units = converter.convert(QgsLayoutMeasurement(atlasCellSize.height(), atlasCellSize.units()), Qgis.LayoutUnit.Meters).length()
 
         # Calculate the real-world dimensions
-        rwWidth = width_map_units * mapScale
-        rwHeight = height_map_units * mapScale
-        rwWidthNet = width_map_units * ((100-horizOverlap)/100) * mapScale
-        rwHeightNet = height_map_units * ((100-vertOverlap)/100) * mapScale
-
-        # Calculate number of rows and columns
-        rwDimensions = (rwWidth,rwHeight,rwWidthNet,rwHeightNet)
-        cols = int((extent.width()-rwWidth) / rwWidthNet) + 2
-        rows = int((extent.height()-rwHeight) / rwHeightNet) + 2
-        nRowsAndCols = (rows,cols)
-        
-        # Adjust extent, so that the grid is centered
-        adjustX = -(rwWidth + (cols-1) * rwWidthNet - extent.width()) / 2
-        adjustY = (rwHeight + (rows-1) * rwHeightNet - extent.height()) / 2
-        gridExtent = extent + QgsVector(adjustX, adjustY)
-        
+        rwDimensions = sheetDimensions(width_map_units,height_map_units,mapScale,horizOverlap,vertOverlap)
+        (nRowsAndCols,gridExtent) = self.fitExtent(extent,rwDimensions)
         return (rwDimensions,nRowsAndCols,gridExtent)
 
+    def fitExtent(self,extent,rwDim):
+        # Calculate number of rows and columns, and center the grid on the extent
+        (nRowsAndCols,(xmin,ymin,xmax,ymax)) = fitExtent(extent.xMinimum(),extent.yMinimum(),extent.xMaximum(),extent.yMaximum(),rwDim)
+        return (nRowsAndCols,QgsRectangle(xmin,ymin,xmax,ymax))
+
+    def createLattice(self,extent,rwDim,nRowsAndCols):
+        # The lattice of the grid with the metrics from calcGridMetrics
+        return Lattice(extent.xMinimum(),extent.yMaximum(),rwDim[0],rwDim[1],rwDim[2],rwDim[3],nRowsAndCols[0],nRowsAndCols[1])
+
     def createGrid(self,mapScale,extent,rwDim,nRowsAndCols,deleteNonIntersecting,aoiLayer):
         self.logMessage("Creating grid (v. 2.1.0)")
-        
-        # create layer
-        gridLayer = QgsVectorLayer("Polygon?crs={}".format(self.crs), 'AtlasGrid', "memory")
-
-        fieldName = 'cellname'
-        field = QgsField(fieldName, QVariant.String)
-        numfield = QgsField('cellnum', QVariant.Int)
-        disjoint_numfield = QgsField('dj_cellnum', QVariant.Int)
-        gridLayer.dataProvider().addAttributes([field,numfield,disjoint_numfield])
-        gridLayer.updateFields()
-
-        # calculate start rectangle as upper leftmost rectangle
-        x = extent.xMinimum()
-        y = extent.yMaximum() - rwDim[1]
-        prefix = ''
-        colname = 'A'
-        rownum = 1
-
-        gridLayer.startEditing()
-
-        # generate the net
-        for i in range(0,nRowsAndCols[0]):
-            for j in range(0,nRowsAndCols[1]):
-                rectangle = QgsRectangle(x, y, x + rwDim[0], y + rwDim[1])
-                cellname = "{}{}{}".format(prefix,colname,str(rownum))
-                feat = QgsFeature(gridLayer.fields())
-                feat.setAttribute(fieldName, cellname)
-                feat.setGeometry(QgsGeometry.fromRect(rectangle))
-                gridLayer.dataProvider().addFeatures([feat])
-
-                x += rwDim[2]
-                if colname < 'Z':
-                    colname = chr(ord(colname)+1)
-                else:
-                    if prefix == '':
-                        prefix = 'A'
+        if self.memoryTracker is None:
+            return self.createGridStages(mapScale,extent,rwDim,nRowsAndCols,deleteNonIntersecting,aoiLayer)
+
+        # Memory is traced from here, and the stages are reported at the end (also when canceled)
+        self.memoryTracker.start()
+        try:
+            return self.createGridStages(mapScale,extent,rwDim,nRowsAndCols,deleteNonIntersecting,aoiLayer)
+        finally:
+            self.memoryTracker.stop()
+            self.logMessage("Memory use by stage (MB):\n" + self.memoryTracker.report())
+            peakRss = self.memoryTracker.peakRss()
+            self.logMessage("Peak of Python allocations: {:.1f} MB, peak RSS: {}".format(self.memoryTracker.peakPython() / MB,
+                            'unknown' if peakRss is None else '{:.1f} MB'.format(peakRss / MB)))
+
+    def createGridStages(self,mapScale,extent,rwDim,nRowsAndCols,deleteNonIntersecting,aoiLayer):
+
+        # The cells are kept in a column store, and geometries are derived from the lattice
+        lattice = self.createLattice(extent,rwDim,nRowsAndCols)
+        self.lattice = lattice
+        self.setProgress(20)
+
+        aoiIndex = None
+        if deleteNonIntersecting or self.clusterGrids or self.coverage or self.minCoverage > 0 or self.masks:
+            self.logMessage("Preparing the area of interest")
+            with self.stage("AoI index"):
+                aoiIndex = AoiIndex(aoiLayer,QgsCoordinateReferenceSystem(self.crs),self.context.transformContext(),
+                                    self.AOI_MAX_VERTICES,self.simplifyTolerance)
+
+        # With cluster grids, a separate grid centered on each cluster of the AoI replaces the grid
+        # over the full extent. The clusters are ordered from the north-west
+        lattices = [lattice]
+        if self.clusterGrids:
+            distance = self.clusterDistance if self.clusterDistance > 0 else max(rwDim[0],rwDim[1])
+            clusters = sorted(aoiIndex.clusters(distance), key=lambda r: (-r.yMaximum(), r.xMinimum()))
+            self.logMessage("Creating grids for {} clusters of the area of interest".format(len(clusters)))
+            lattices = [self.createLattice(gridExtent,rwDim,nRowsAndCols)
+                        for (nRowsAndCols,gridExtent) in [self.fitExtent(cluster,rwDim) for cluster in clusters]]
+
+        # The sub-grids as (cluster, level, store, parent store)
+        grids = []
+        for (cluster,lattice) in enumerate(lattices):
+            levels = self.createLevels(lattice,deleteNonIntersecting,aoiIndex,mapScale)
+            if levels is None:
+                return None
+            grids += [(cluster + 1, level, store, levels[level - 1] if level > 0 else None) for (level,store) in enumerate(levels)]
+
+        # The sheets of the clusters are numbered consecutively, cluster by cluster
+        for level in range(len(self.subdivisions) + 1):
+            numberConsecutively([store for (cluster,gridLevel,store,parent) in grids if gridLevel == level])
+
+        with self.stage("Output layer"):
+            outLayer = self.createOutputLayer(grids,mapScale)
+        if outLayer is None:
+            return None
+        if self.adjacencyTable:
+            with self.stage("Adjacency table"):
+                self.adjacencyLayer = self.createAdjacencyLayer(grids)
+        if self.masks:
+            with self.stage("Masks"):
+                self.maskLayer = self.createMaskLayer(grids,aoiIndex)
+            if self.maskLayer is None:
+                return None
+        self.setProgress(100)
+        return outLayer
+
+    def createLevels(self,lattice,deleteNonIntersecting,aoiIndex,mapScale):
+        # Creates the store of the lattice and of each level of a nested series. With subdivisions, each
+        # level is derived from the previous one, and only the children of kept sheets (and their
+        # neighbours) are classified
+        stores = []
+        candidates = None
+        for level in range(len(self.subdivisions) + 1):
+            if level > 0:
+                n = self.subdivisions[level - 1]
+                self.logMessage("Creating level {} (1:{:g})".format(level, mapScale / self.levelFactor(level)))
+                if deleteNonIntersecting:
+                    candidates = stores[-1].childCandidates(n)
+                lattice = lattice.subdivide(n)
+            # Stages are named by level in nested series
+            suffix = " (level {})".format(level) if self.subdivisions else ""
+            with self.stage("Cell store" + suffix):
+                store = CellStore(lattice)
+
+            # Check for non-intersecting cells if user has chosen to do so
+            if deleteNonIntersecting:
+                with self.stage("Classification" + suffix):
+                    if self.approximate:
+                        identified = self.identifyCellsToDeleteApproximately(store,aoiIndex,candidates)
                     else:
-                        prefix = chr(ord(prefix)+1)
-                    colname = 'A'
-
-            x = extent.xMinimum()
-            y -= rwDim[3]
-            rownum += 1
-            colname = 'A'
-            prefix = ''
-
-        # Check for non-intersecting cells if user has chosen to do so
-        if deleteNonIntersecting:
-            toBeDeleted = self.identifyCellsToDelete(gridLayer,aoiLayer)
-        else:
-            toBeDeleted = []
-        
-        # Delete cells not intersecting and number the remaining
-        n = 0
-        for f in gridLayer.getFeatures():
-            if f["cellname"] in toBeDeleted:
-                gridLayer.deleteFeature(f.id())
+                        identified = self.identifyCellsToDelete(store,aoiIndex,candidates)
+                if not identified:
+                    return None
+
+            # Compute the AoI coverage of the kept cells, and delete cells with little coverage
+            if self.coverage or self.minCoverage > 0:
+                with self.stage("Coverage" + suffix):
+                    covered = self.calculateCoverage(store,aoiIndex) and \
+                              (self.minCoverage <= 0 or self.deleteLowCoverage(store,aoiIndex))
+                if not covered:
+                    return None
+
+            # Number the remaining cells
+            self.setProgress(85)
+            with self.stage("Numbering" + suffix):
+                if self.printOrderField:
+                    store.number()
+                    store.numberPrintOrder(self.sheetOrder)
+                else:
+                    store.number(self.sheetOrder)
+
+            # Calculate disjoint cell numbers
+            if deleteNonIntersecting:
+                self.setProgress(90)
+                with self.stage("Disjoint cell numbers" + suffix):
+                    numbered = self.calculateDisjointCellNums(store,aoiIndex)
+                if not numbered:
+                    return None
             else:
-                n += 1
-                f["cellnum"] = n
-                if not deleteNonIntersecting:   
-                    f["dj_cellnum"] = n
-
-                gridLayer.updateFeature(f)
-
-        gridLayer.commitChanges()
-
-        # Calculate disjoint cell numbers
-        if deleteNonIntersecting:
-            self.calculateDisjointCellNums(gridLayer,aoiLayer,rwDim)
-        
-        return gridLayer
-
-    def calculateDisjointCellNums(self,grid,aoi,rwDim):
-        self.logMessage("Calculating disjoint cell numbers")
-        # Dissolve AOI keeping disjoints AOIs separate
-        alg_params = {'INPUT': aoi,
-                      'FIELD':[],
-                      'SEPARATE_DISJOINT':True,
-                      'OUTPUT':'TEMPORARY_OUTPUT'
-                      }
-        merged_aois = processing.run("native:dissolve", alg_params)['OUTPUT']
-        merged_aois.setName('merged_aois')
-
-        # Add autoincremental field (unique ID)
-        alg_params = {
-            'INPUT': merged_aois,
-            'FIELD_NAME': 'uid',
-            'START': 1,
-            'GROUP_FIELDS': [],
-            'MODULUS': 0,
-            'OUTPUT': 'memory:'
-        }
-        merged_unique_aois = processing.run('native:addautoincrementalfield', alg_params)['OUTPUT']
-        merged_unique_aois.setName('merged_unique_aois')
-
-        # Create copy of gridlayer, where all grid cells are shrunk to their net width/height 
-        # to ensure disjoint polygons do not overlap or touch at edges
-        shrink_x = (rwDim[0] - rwDim[2]) / 2
-        shrink_y = (rwDim[1] - rwDim[3]) / 2
-        copyLayer = QgsVectorLayer("Polygon?crs={}".format(self.crs), 'shrunk_cells', "memory")
-        
-        # Resolve the correct enum for Int across PyQt versions
-        META_INT = getattr(QMetaType, 'Int', getattr(QMetaType.Type, 'Int'))
-
+                store.dj_cellnum[:] = store.cellnum
+            stores.append(store)
+        return stores
+
+    def levelFactor(self,level):
+        # Scale factor of a level of a nested map series relative to the grid itself
+        return levelFactor(self.subdivisions,level)
+
+    def gridCellName(self,cluster,lattice,row,col):
+        # With cluster grids, the names are prefixed by the cluster number (e.g. 2-B4)
+        if self.clusterGrids:
+            return "{}-{}".format(cluster, lattice.cellName(row,col))
+        return lattice.cellName(row,col)
+
+    # Neighbour directions as (field prefix, row offset, column offset) - see cellstore.NEIGHBOURS
+    NEIGHBOURS = NEIGHBOURS
+
+    # Number of features added to the output layer at a time
+    BATCH_SIZE = 10000
+
+    # Maximum number of vertices of the pieces the AoI is subdivided into for the intersection tests
+    AOI_MAX_VERTICES = 256
+
+    def createOutputLayer(self,grids,mapScale):
+        # Features are only created here. They are inserted in cellnum order, so feature ids follow the
+        # atlas order, and a spatial index is built for fast atlas rendering and intersects filtering
+        self.logMessage("Creating output layer")
+        nested = len(self.subdivisions) > 0
+        outLayer = QgsVectorLayer("Polygon?crs={}".format(self.crs), 'AtlasGrid', "memory")
+        fields = [QgsField('cellname', QVariant.String), QgsField('cellnum', QVariant.Int), QgsField('dj_cellnum', QVariant.Int),
+                  QgsField('row', QVariant.Int), QgsField('col', QVariant.Int), QgsField('cell_key', QVariant.LongLong)]
+        if self.printOrderField:
+            fields.append(QgsField('print_order', QVariant.Int))
+        if self.neighbourFields:
+            fields += [QgsField('{}_sheet'.format(direction), QVariant.String) for (direction,di,dj) in self.NEIGHBOURS]
+        if nested:
+            fields += [QgsField('level', QVariant.Int), QgsField('scale', QVariant.Double),
+                       QgsField('parent_name', QVariant.String), QgsField('parent_key', QVariant.LongLong)]
+        if self.clusterGrids:
+            fields.append(QgsField('cluster', QVariant.Int))
+        if self.coverage:
+            fields += [QgsField('coverage', QVariant.Double), QgsField('net_coverage', QVariant.Double)]
+        outLayer.dataProvider().addAttributes(fields)
+        outLayer.updateFields()
+
+        # Sheets of the same level are added in cellnum order
+        for (cluster,level,store,parent) in sorted(grids, key=lambda grid: (grid[1], grid[0])):
+            lattice = store.lattice
+            kept = store.keptIndices()
+            kept = kept[store.cellnum[kept].argsort()]
+            if self.neighbourFields:
+                neighbours = [store.neighbour(kept,di,dj) for (direction,di,dj) in self.NEIGHBOURS]
+            if parent is not None:
+                # The parents are found arithmetically in the lattice of the previous level
+                n = self.subdivisions[level - 1]
+                (parentRow,parentCol) = (store.row[kept] // n, store.col[kept] // n)
+                parentKeys = parent.lattice.cellKey(parentRow,parentCol)
+
+            for start in range(0, len(kept), self.BATCH_SIZE):
+                if self.isCanceled():
+                    return None
+                batch = kept[start:start + self.BATCH_SIZE]
+                (xmin,ymin,xmax,ymax) = store.bounds(batch)
+                keys = store.cellKey(batch)
+                features = []
+                for k,i in enumerate(batch):
+                    (row,col) = (int(store.row[i]), int(store.col[i]))
+                    feat = QgsFeature(outLayer.fields())
+                    feat.setGeometry(QgsGeometry.fromRect(QgsRectangle(xmin[k],ymin[k],xmax[k],ymax[k])))
+                    attributes = [self.gridCellName(cluster,lattice,row,col), int(store.cellnum[i]), int(store.dj_cellnum[i]),
+                                  row, col, int(keys[k])]
+                    if self.printOrderField:
+                        attributes.append(int(store.print_order[i]))
+                    if self.neighbourFields:
+                        attributes += [self.gridCellName(cluster,lattice,int(store.row[nb[start + k]]),int(store.col[nb[start + k]]))
+                                       if nb[start + k] >= 0 else None for nb in neighbours]
+                    if nested:
+                        attributes += [level, mapScale / self.levelFactor(level)]
+                        if parent is not None:
+                            attributes += [self.gridCellName(cluster,parent.lattice,int(parentRow[start + k]),int(parentCol[start + k])),
+                                           int(parentKeys[start + k])]
+                        else:
+                            attributes += [None, None]
+                    if self.clusterGrids:
+                        attributes.append(cluster)
+                    if self.coverage:
+                        attributes += [float(store.coverage[i]), float(store.net_coverage[i])]
+                    feat.setAttributes(attributes)
+                    features.append(feat)
+                outLayer.dataProvider().addFeatures(features)
+
+        outLayer.dataProvider().createSpatialIndex()
+        # The lattice parameters are stored with the layer for the AtlasGrid expression functions (only
+        # for a single grid - levels of a nested series and cluster grids have different lattices)
+        if len(grids) == 1:
+            storeLattice(outLayer,grids[0][2].lattice)
+        return outLayer
+
+    def createAdjacencyLayer(self,grids):
+        self.logMessage("Creating adjacency table")
+        nested = len(self.subdivisions) > 0
+        adjacencyLayer = QgsVectorLayer("None", 'AtlasGrid adjacency', "memory")
         fields = [
-            QgsField('cellnum', META_INT),
-            QgsField('dj_cellnum', META_INT),
+            QgsField('cellname', QVariant.String),
+            QgsField('cellnum', QVariant.Int),
+            QgsField('direction', QVariant.String),
+            QgsField('nb_cellname', QVariant.String),
+            QgsField('nb_cellnum', QVariant.Int),
         ]
-
-        copyLayer.dataProvider().addAttributes(fields)
-        copyLayer.updateFields()
-
-        copyLayer.startEditing()
-
-        for f in grid.getFeatures():
-            geom = f.geometry().boundingBox()
-            shrunkenCell = QgsRectangle(geom.xMinimum()+shrink_x, geom.yMinimum()+shrink_y, geom.xMaximum()-shrink_x, geom.yMaximum()-shrink_y)
-            shrunkenFeat = QgsFeature(copyLayer.fields())
-            shrunkenFeat.setGeometry(QgsGeometry.fromRect(shrunkenCell))
-            shrunkenFeat["cellnum"] = f["cellnum"]
-            copyLayer.dataProvider().addFeatures([shrunkenFeat])
-        copyLayer.commitChanges()
-
-        # Add layers to layer panel to be able to use them in selections below
-        QgsProject.instance().addMapLayer(copyLayer, False)
-        QgsProject.instance().addMapLayer(merged_unique_aois, False)
-
-        # Select all cells in the copy layer without an assignment in 'dj_cellnum' until all are assigned
-        cellnum = 0
-        f_idx = copyLayer.fields().indexOf("dj_cellnum")
-        copyLayer.selectByExpression('is_empty_or_null(dj_cellnum)', QgsVectorLayer.SetSelection)
-        while copyLayer.selectedFeatureCount() > 0:
-            # Select the first (northwestern most) cell 
-            cell = next(copyLayer.getSelectedFeatures(QgsFeatureRequest().addOrderBy("cellnum", ascending=True)))
-            copyLayer.selectByExpression(f'cellnum = {cell["cellnum"]}')
-
-            # Select alternating aois and cells until the number of cells selected doesn't change
-            cellsSelected = 1
-            continueSelecting = True
-
-            while continueSelecting:
-                alg_params = {
-                        'INPUT': merged_unique_aois,
-                        'PREDICATE': [0],        # 0 = intersects
-                        'INTERSECT': QgsProcessingFeatureSourceDefinition(copyLayer.id(),selectedFeaturesOnly = True),
-                        'METHOD': 1             # add to selection
-                }
-                processing.run('native:selectbylocation', alg_params)
-
-                alg_params = {
-                        'INPUT': copyLayer,
-                        'PREDICATE': [0],        # 0 = intersects
-                        'INTERSECT': QgsProcessingFeatureSourceDefinition(merged_unique_aois.id(),selectedFeaturesOnly = True),
-                        'METHOD': 1             # add to selection
-                }
-                processing.run('native:selectbylocation', alg_params)
-
-                if cellsSelected < copyLayer.selectedFeatureCount():
-                    cellsSelected = copyLayer.selectedFeatureCount()
-                    continueSelecting = True
-                else:
-                    continueSelecting = False
-
-            # All cells selected - start numbering
-            copyLayer.startEditing()
-            for cell in copyLayer.getSelectedFeatures(QgsFeatureRequest().addOrderBy("cellnum", ascending=True)):
-                cellnum += 1
-                cell.setAttribute(f_idx, cellnum)
-                copyLayer.updateFeature(cell)
-            copyLayer.commitChanges()
-
-            copyLayer.selectByExpression('is_empty_or_null(dj_cellnum)', QgsVectorLayer.SetSelection)
-            merged_unique_aois.removeSelection()
-
-        # Copy the value of dj_cellnum from the copyLayer to the grid
-        t_idx = grid.fields().indexOf("dj_cellnum")
-
-        # Collect values to update
-        lookup = {}
-        for f in copyLayer.getFeatures():
-            lookup[f["cellnum"]] = f["dj_cellnum"]
-
-        # Prepare changes
-        changes = {}
-        for f in grid.getFeatures():
-            key = f["cellnum"]
-            changes[f.id()] = {t_idx: lookup[key]}
-
-        # Apply changes in bulk
-        with edit(grid):
-            grid.dataProvider().changeAttributeValues(changes)
-
-        # Remove temporary layers from layer panel
-        QgsProject.instance().removeMapLayers([copyLayer, merged_unique_aois])
-
-        return
-
-    def identifyCellsToDelete(self,grid,aoi):
+        if nested:
+            fields.append(QgsField('level', QVariant.Int))
+        adjacencyLayer.dataProvider().addAttributes(fields)
+        adjacencyLayer.updateFields()
+
+        # Sheets are only adjacent within the same grid
+        features = []
+        for (cluster,level,store,parent) in sorted(grids, key=lambda grid: (grid[1], grid[0])):
+            lattice = store.lattice
+            kept = store.keptIndices()
+            neighbours = [store.neighbour(kept,di,dj) for (direction,di,dj) in self.NEIGHBOURS]
+            for k,i in enumerate(kept):
+                for (direction,di,dj),nb in zip(self.NEIGHBOURS,neighbours):
+                    if nb[k] < 0:
+                        continue
+                    feat = QgsFeature(adjacencyLayer.fields())
+                    attributes = [self.gridCellName(cluster,lattice,int(store.row[i]),int(store.col[i])),int(store.cellnum[i]),direction.upper(),
+                                  self.gridCellName(cluster,lattice,int(store.row[nb[k]]),int(store.col[nb[k]])),int(store.cellnum[nb[k]])]
+                    if nested:
+                        attributes.append(level)
+                    feat.setAttributes(attributes)
+                    features.append(feat)
+        adjacencyLayer.dataProvider().addFeatures(features)
+        return adjacencyLayer
+
+    def createMaskLayer(self,grids,aoiIndex):
+        self.logMessage("Creating masks")
+        nested = len(self.subdivisions) > 0
+        maskLayer = QgsVectorLayer("MultiPolygon?crs={}".format(self.crs), 'AtlasGrid masks', "memory")
+        fields = [QgsField('cellname', QVariant.String), QgsField('cellnum', QVariant.Int)]
+        if nested:
+            fields.append(QgsField('level', QVariant.Int))
+        maskLayer.dataProvider().addAttributes(fields)
+        maskLayer.updateFields()
+
+        # Each sheet is only clipped against the AoI pieces intersecting it. Sheets within the AoI get an
+        # empty mask, so each sheet has a mask
+        for (cluster,level,store,parent) in sorted(grids, key=lambda grid: (grid[1], grid[0])):
+            lattice = store.lattice
+            kept = store.keptIndices()
+            kept = kept[store.cellnum[kept].argsort()]
+            for start in range(0, len(kept), self.BATCH_SIZE):
+                batch = kept[start:start + self.BATCH_SIZE]
+                (xmin,ymin,xmax,ymax) = store.bounds(batch)
+                features = []
+                for k,i in enumerate(batch):
+                    if k % 1000 == 0 and self.isCanceled():
+                        return None
+                    rect = QgsGeometry.fromRect(QgsRectangle(xmin[k],ymin[k],xmax[k],ymax[k]))
+                    aoi = aoiIndex.clip(xmin[k],ymin[k],xmax[k],ymax[k])
+                    mask = rect if aoi is None else rect.difference(aoi)
+                    mask.convertToMultiType()
+                    feat = QgsFeature(maskLayer.fields())
+                    feat.setGeometry(mask)
+                    attributes = [self.gridCellName(cluster,lattice,int(store.row[i]),int(store.col[i])),int(store.cellnum[i])]
+                    if nested:
+                        attributes.append(level)
+                    feat.setAttributes(attributes)
+                    features.append(feat)
+                maskLayer.dataProvider().addFeatures(features)
+        return maskLayer
+
+    def calculateDisjointCellNums(self,store,aoi):
+        self.logMessage("Calculating disjoint cell numbers")
+        # Find the groups of connected AoI parts (corresponding to dissolving the AoI keeping disjoint AoIs separate)
+        (parts,groups) = aoi.connectedParts()
+        if self.isCanceled():
+            return False
+
+        # Cells intersecting the same group of AoI parts are connected. The cells are shrunk to their
+        # net width/height, so the overlaps do not connect cells of disjoint AoIs
+        lattice = store.lattice
+        # (cell, group) pairs, collected as arrays for each AoI piece
+        (cells,cellGroups) = ([np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)])
+        for (geom,group) in zip(parts,groups):
+            if self.isCanceled():
+                return False
+            bbox = geom.boundingBox()
+            indexRange = lattice.indexRange(bbox.xMinimum(),bbox.yMinimum(),bbox.xMaximum(),bbox.yMaximum(),net=True)
+            if indexRange is None:
+                continue
+            # The net cells within the bounding box of the piece are classified in a scanline pass - cells
+            # inside the piece are connected to it directly, and only kept boundary cells are tested exactly
+            (row0,row1,col0,col1) = indexRange
+            (rings,paths) = AoiIndex.partRings(geom.asGeometryCollection())
+            states = NetCellRaster(lattice,row0,row1,col0,col1,rings,paths).cellStates()
+            (row,col) = np.nonzero(states != OUTSIDE)
+            index = store.cellIndex(row0 + row, col0 + col)
+            (inside,boundary) = (states[row,col] == INSIDE, states[row,col] == BOUNDARY)
+            connected = index[inside & store.keep[index]]
+            boundary = index[boundary & store.keep[index]]
+            if len(boundary):
+                engine = QgsGeometry.createGeometryEngine(geom.constGet())
+                engine.prepareGeometry()
+                (xmin,ymin,xmax,ymax) = lattice.netCellBounds(store.row[boundary], store.col[boundary])
+                intersects = [engine.intersects(QgsGeometry.fromRect(QgsRectangle(xmin[k],ymin[k],xmax[k],ymax[k])).constGet())
+                              for k in range(len(boundary))]
+                connected = np.concatenate((connected, boundary[np.array(intersects, dtype=np.bool_)]))
+            cells.append(connected)
+            cellGroups.append(np.full(len(connected), group, dtype=np.int64))
+
+        store.numberDisjointGroups(np.concatenate(cells), np.concatenate(cellGroups))
+        return True
+
+    # Uncovered AoI area (as a fraction of the sheet area) ignored when deleting sheets with little coverage
+    COVERAGE_TOLERANCE = 1e-9
+
+    def calculateCoverage(self,store,aoiIndex):
+        self.logMessage("Calculating the AoI coverage of the sheets")
+        # The AoI is clipped to each kept cell - only the AoI pieces found through the spatial index are clipped
+        lattice = store.lattice
+        kept = store.keptIndices()
+        (xmin,ymin,xmax,ymax) = store.bounds(kept)
+        (netXmin,netYmin,netXmax,netYmax) = lattice.netCellBounds(store.row[kept], store.col[kept])
+        (area,netArea) = (lattice.width * lattice.height, lattice.netWidth * lattice.netHeight)
+        for k,i in enumerate(kept):
+            if k % 1000 == 0 and self.isCanceled():
+                return False
+            store.coverage[i] = min(1.0, aoiIndex.clippedArea(xmin[k],ymin[k],xmax[k],ymax[k]) / area)
+            store.net_coverage[i] = min(1.0, aoiIndex.clippedArea(netXmin[k],netYmin[k],netXmax[k],netYmax[k]) / netArea)
+        return True
+
+    def deleteLowCoverage(self,store,aoiIndex):
+        # Cells covered less than the minimum are deleted, starting with the least covered, if the AoI on them
+        # is only within zones shared with other kept cells. The core of a cell is not shared, so cells are
+        # only deleted if the AoI merely touches their core. Cells whose core has no area are never deleted
+        if not aoiIndex.isPolygonal():
+            self.logMessage("Sheets are only deleted by their coverage for an AoI of polygons")
+            return True
+        tolerance = self.COVERAGE_TOLERANCE * store.lattice.width * store.lattice.height
+        low = store.lowCoverage(self.minCoverage)
+        deleted = 0
+        for n,i in enumerate(low):
+            if n % 1000 == 0 and self.isCanceled():
+                return False
+            if store.coveredByOthers(i,aoiIndex.clippedArea,tolerance):
+                store.keep[i] = False
+                deleted += 1
+        self.logMessage("{} of {} sheets covered less than {:g}% deleted".format(deleted, len(low), 100 * self.minCoverage))
+        return True
+
+    def identifyCellsToDelete(self,store,aoiIndex,candidates=None):
+        # With candidates (a mask over the cells), only those cells can be kept
         self.logMessage("Identifying mapsheets to be deleted")
-        if self.feedback:
-            curr_prog = self.feedback.progress()
-        # Generate line layer from grid polygons
-        lines = processing.run("native:polygonstolines", {'INPUT':grid,'OUTPUT':'TEMPORARY_OUTPUT'}, feedback=self.feedback)['OUTPUT']
-
-        # Split polygons by lines
-        self.logMessage("Splitting grid")
-        if self.feedback:
-            prog_step = int((100-curr_prog)/5)
-            self.feedback.setProgress(curr_prog + prog_step)
-        split = processing.run('native:splitwithlines', {'INPUT':grid,'LINES':lines, 'OUTPUT':'TEMPORARY_OUTPUT'}, feedback=self.feedback)['OUTPUT']
-
-        # Add the split layer temporarily to the project (to be able to reference it in a field calculator expression)
-        QgsProject.instance().addMapLayer(split, addToLegend=False)
-        split.setName('split')
-
-        # Use field calculator to determine which cells overlap each other
-        self.logMessage("Calculating overlap")
-        if self.feedback:
-            self.feedback.setProgress(curr_prog + (2*prog_step))
-
-        alg_params = {
-            'FIELD_LENGTH': 20,
-            'FIELD_NAME': 'overlaps',
-            'FIELD_PRECISION': 0,
-            'FIELD_TYPE': 2,  # Text
-            'FORMULA': "array_to_string(array_sort( aggregate( layer:= '{}', aggregate:='array_agg', expression:=cellname, filter:=contains($geometry, geometry(@parent)))))".format(split.name()),
-            'INPUT': split,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        split = processing.run('native:fieldcalculator', alg_params, feedback=self.feedback)['OUTPUT']
-
-        # Are grid and aoi in the same reference system?
-        if grid.crs().authid() != aoi.crs().authid():
-            projected = True
-            proj_aoi = self.reprojectAOI(aoi,grid.crs().authid())
-        else:
-            proj_aoi = aoi.materialize(QgsFeatureRequest().setFilterFids(aoi.allFeatureIds()))
-        QgsProject.instance().addMapLayer(proj_aoi, addToLegend=False)
-
-        # Use field calculator to determine which cells to keep initially
+        lattice = store.lattice
+
+        # Classify the cores and overlaps of all cells as inside, outside or on the boundary of
+        # the AoI in a single scanline pass - only boundary zones need an exact geometry test
+        self.logMessage("Rasterizing the AoI")
+        (rings,paths) = aoiIndex.rings()
+        raster = ZoneRaster(lattice,rings,paths)
+        states = raster.coreStates()
+        if self.isCanceled():
+            return False
+
+        # A cell is kept, if the part of it not overlapped by other cells intersects the AoI
         self.logMessage("Locating sheets to keep")
-        if self.feedback:
-            self.feedback.setProgress(curr_prog + (3*prog_step))
-        alg_params = {
-            'FIELD_LENGTH': 0,
-            'FIELD_NAME': 'keep',
-            'FIELD_PRECISION': 0,
-            'FIELD_TYPE': 6,  # Boolean
-            'FORMULA': "aggregate( layer:= '{}', aggregate:='count', expression:=@id, filter:=intersects($geometry, geometry(@parent))) > 0".format(proj_aoi.id()),
-            'INPUT': split,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        split = processing.run('native:fieldcalculator', alg_params, feedback=self.feedback)['OUTPUT']
-
-        # Check for intersection in the overlaps
+        if candidates is not None:
+            states = np.where(candidates.reshape(states.shape), states, OUTSIDE)
+        store.keepCores((states == INSIDE).ravel(), candidates)
+        boundary = np.argwhere((states == BOUNDARY) & ~store.keep.reshape(states.shape))
+        for n,(row,col) in enumerate(boundary):
+            if n % 100 == 0:
+                if self.isCanceled():
+                    return False
+                self.setProgress(20 + 50 * n / len(boundary))
+            (xmin,ymin,xmax,ymax) = lattice.coreBounds(int(row),int(col))
+            if aoiIndex.intersectsRect(xmin,ymin,xmax,ymax):
+                store.keep[store.cellIndex(int(row),int(col))] = True
+
+        # If the AoI only intersects an overlap, where none of the overlapping cells are kept,
+        # the last (south-eastern most) of the overlapping cells is kept. Only the zones the
+        # raster does not classify as outside are enumerated
         self.logMessage("Checking for intersections in the overlaps")
-        if self.feedback:
-            self.feedback.setProgress(curr_prog + (4*prog_step))
-        split.startEditing()
-        for f in split.getFeatures():
-            overlaps = f["overlaps"].split(',') if f["overlaps"] else []
-            if f["keep"] and len(overlaps)>1:
-                str = "cellname in ({}) and cellname = overlaps".format(','.join("'{}'".format(o) for o in overlaps))
-                request = QgsFeatureRequest(QgsExpression(str))
-                alreadyKept = False
-                for o in split.getFeatures(request):
-                    if o["keep"]:
-                        alreadyKept = True
-                
-                if not alreadyKept:
-                    o["keep"] = True
-                    split.updateFeature(o)
-                    
-        split.commitChanges()
-
-        str = "cellname = overlaps and not keep"
-        request = QgsFeatureRequest(QgsExpression(str))
-        toBeDeleted = []
-        for f in split.getFeatures(request):
-            toBeDeleted.append(f["cellname"])
-
-        # Remove the temporary layer again
-        QgsProject.instance().removeMapLayer(split)
-        QgsProject.instance().removeMapLayer(proj_aoi)
-
-        return toBeDeleted
-
-    def reprojectAOI(self,aoi,targetCrs):
-        # Reproject layer
-        alg_params = {
-            'CONVERT_CURVED_GEOMETRIES': False,
-            'INPUT': aoi,
-            'OPERATION': '',
-            'TARGET_CRS': QgsCoordinateReferenceSystem(targetCrs),
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        proj_aoi = processing.run('native:reprojectlayer', alg_params)['OUTPUT']
-        QgsProject.instance().addMapLayer(proj_aoi, addToLegend=False)
-        return proj_aoi
-
-
+        self.setProgress(70)
+        for n,(bounds,sharing) in enumerate(store.overlapZones(lambda *b: raster.zoneStates(*b) != OUTSIDE)):
+            if n % 1000 == 0 and self.isCanceled():
+                return False
+            if candidates is not None and not candidates[sharing].any():
+                continue
+            state = raster.state(*bounds)
+            if state == INSIDE or (state == BOUNDARY and aoiIndex.intersectsRect(*bounds)):
+                store.keepZone(sharing)
+
+        return True
+
+    def identifyCellsToDeleteApproximately(self,store,aoiIndex,candidates=None):
+        self.logMessage("Identifying mapsheets to be deleted (approximately)")
+        lattice = store.lattice
+        pixelSize = self.pixelSize
+        if pixelSize <= 0:
+            pixelSize = min(lattice.netWidth, lattice.netHeight) / 2
+
+        # Rasterize the AoI over the extent of the grid
+        (rings,paths) = aoiIndex.rings()
+        (xmin,ymin,xmax,ymax) = lattice.cellBounds(lattice.rows - 1, lattice.cols - 1)
+        raster = PixelRaster(lattice.xMin,ymin,xmax,lattice.yMax,pixelSize,rings,paths)
+        if self.isCanceled():
+            return False
+        self.setProgress(50)
+
+        # A cell is kept, if any pixel covering its core is set
+        bounds = lattice.coreBounds(store.row, store.col)
+        store.keepCores(raster.touchedSum(*bounds) > 0, candidates)
+        uncertain = np.count_nonzero(store.keep & ~store.degenerateCores() & (raster.insideSum(*bounds) == 0))
+
+        # Overlaps are handled as in exact mode, testing only the zones with set pixels
+        self.setProgress(70)
+        for n,(bounds,sharing) in enumerate(store.overlapZones(lambda *b: raster.touchedSum(*b) > 0)):
+            if n % 1000 == 0 and self.isCanceled():
+                return False
+            if candidates is not None and not candidates[sharing].any():
+                continue
+            if raster.insideSum(*bounds) == 0:
+                uncertain += 1
+            store.keepZone(sharing)
+
+        self.logMessage("{} sheets kept, of which at most {} may be deleted in exact mode".format(
+            np.count_nonzero(store.keep), uncertain))
+
+        if self.compareExact:
+            exactStore = CellStore(lattice)
+            if not self.identifyCellsToDelete(exactStore,aoiIndex,candidates):
+                return False
+            self.approximateDifferences = int(np.count_nonzero(store.keep != exactStore.keep))
+            self.logMessage("{} sheets are classified differently in exact mode".format(self.approximateDifferences))
+        return True
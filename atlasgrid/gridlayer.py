@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import json
+import numpy as np
+from qgis.core import QgsFeatureRequest
+from .cellstore import Lattice
+
+# Custom property of grid layers holding the lattice parameters
+LATTICE_PROPERTY = 'atlasgrid/lattice'
+
+def storeLattice(layer,lattice):
+    # Store the lattice parameters with the layer (saved with the project)
+    layer.setCustomProperty(LATTICE_PROPERTY, json.dumps(lattice.params()))
+    return
+
+class GridLayer():
+    """The lattice of an existing AtlasGrid layer and the cell numbers of its sheets.
+
+    The lattice is read from the parameters stored with the layer, or reconstructed from the
+    sheet rectangles and their row and column indices (from the row and col fields, or parsed
+    from cellname for layers created by older versions). cellnum is a dense array over all
+    cells of the lattice in row-major order, with 0 for cells without a sheet in the layer.
+    """
+
+    def __init__(self,layer):
+        self.read(layer.name(),layer.crs(),layer.fields(),layer.customProperty(LATTICE_PROPERTY),layer)
+
+    @classmethod
+    def fromSource(cls,name,crs,fields,params,source):
+        # The grid read from a feature source (e.g. a QgsVectorLayerFeatureSource created in the main
+        # thread) with the name, CRS, fields and lattice property of its layer, so it can be read in any thread
+        grid = cls.__new__(cls)
+        grid.read(name,crs,fields,params,source)
+        return grid
+
+    def read(self,name,crs,fields,params,source):
+        self.crs = crs
+        if fields.indexOf('cellname') < 0 or fields.indexOf('cellnum') < 0:
+            raise ValueError("{} is not an AtlasGrid layer (no cellname and cellnum fields)".format(name))
+        if not params and fields.indexOf('parent_key') >= 0:
+            raise ValueError("{} is a nested AtlasGrid layer with several levels".format(name))
+        if not params and fields.indexOf('cluster') >= 0:
+            raise ValueError("{} is an AtlasGrid layer with a grid for each cluster".format(name))
+        hasIndex = fields.indexOf('row') >= 0 and fields.indexOf('col') >= 0
+        names = ['cellname', 'cellnum'] + (['row', 'col'] if hasIndex else [])
+        request = QgsFeatureRequest().setSubsetOfAttributes(names, fields)
+
+        if params:
+            # With stored parameters, only the attributes are read
+            self.lattice = Lattice.fromParams(json.loads(params))
+            request.setFlags(QgsFeatureRequest.Flag.NoGeometry)
+            (rows,cols,nums) = ([], [], [])
+            for f in source.getFeatures(request):
+                (row,col) = (f['row'], f['col']) if hasIndex else Lattice.parseCellName(f['cellname'])
+                rows.append(row)
+                cols.append(col)
+                nums.append(f['cellnum'])
+            self.setCellNums(rows,cols,nums)
+            return
+
+        (rows,cols,nums,bounds) = ([], [], [], [])
+        for f in source.getFeatures(request):
+            if f.geometry().isNull():
+                continue
+            if hasIndex:
+                (row,col) = (f['row'], f['col'])
+            else:
+                (row,col) = Lattice.parseCellName(f['cellname'])
+            bbox = f.geometry().boundingBox()
+            rows.append(row)
+            cols.append(col)
+            nums.append(f['cellnum'])
+            bounds.append((bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum()))
+        if not rows:
+            raise ValueError("{} has no sheets".format(name))
+
+        (row,col) = (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64))
+        bounds = np.array(bounds, dtype=np.float64)
+        width = float(np.median(bounds[:,2] - bounds[:,0]))
+        height = float(np.median(bounds[:,3] - bounds[:,1]))
+        # The net size is the offset between sheets in different columns/rows (without any, it is not needed)
+        (first,last) = (np.argmin(col), np.argmax(col))
+        netWidth = (bounds[last,0] - bounds[first,0]) / (col[last] - col[first]) if col[last] > col[first] else width
+        (first,last) = (np.argmin(row), np.argmax(row))
+        netHeight = (bounds[first,3] - bounds[last,3]) / (row[last] - row[first]) if row[last] > row[first] else height
+        xMin = float(np.median(bounds[:,0] - col * netWidth))
+        yMax = float(np.median(bounds[:,3] + row * netHeight))
+
+        self.lattice = Lattice(xMin,yMax,width,height,float(netWidth),float(netHeight),int(row.max()) + 1,int(col.max()) + 1)
+        self.setCellNums(row,col,nums)
+
+    def setCellNums(self,rows,cols,nums):
+        lattice = self.lattice
+        (row,col) = (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64))
+        inside = (row >= 0) & (row < lattice.rows) & (col >= 0) & (col < lattice.cols)
+        self.cellnum = np.zeros(lattice.rows * lattice.cols, dtype=np.int64)
+        self.cellnum[row[inside] * lattice.cols + col[inside]] = np.array(nums, dtype=np.int64)[inside]
+        return
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+MB = 1024 * 1024
+
+# tracemalloc traces the whole process, so the trackers of concurrent runs (e.g. of a batch) share it:
+# the first tracker started starts tracing (unless it is already on), and the last one stopped stops it
+_lock = threading.Lock()
+_active = 0
+_ownTracing = False
+
+def processMemory():
+    """Returns the resident set size (RSS) of the process and its peak so far in bytes. Either is
+    None where it cannot be determined (outside Linux, psutil is used if installed)."""
+    if sys.platform.startswith('linux'):
+        values = {}
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    (key,value) = line.split(':', 1)
+                    values[key] = int(value.split()[0]) * 1024
+        return (values.get('VmRSS'), values.get('VmHWM'))
+
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        # The peak is only available on Windows (peak_wset)
+        return (info.rss, getattr(info, 'peak_wset', None))
+    except ImportError:
+        pass
+
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return (counters.WorkingSetSize, counters.PeakWorkingSetSize)
+        return (None, None)
+
+    # Elsewhere (e.g. macOS) only the peak is known - in bytes on macOS, in kilobytes on other systems
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return (None, peak if sys.platform == 'darwin' else peak * 1024)
+    except ImportError:
+        return (None, None)
+
+class MemoryTracker():
+    """Records the memory use of the stages of a run: the peak of the Python allocations (traced by
+    tracemalloc) within each stage, and the RSS of the process at the entry and exit of each stage
+    and its peak at exit.
+
+    Tracing slows down allocations, so the tracker is only used on request. tracemalloc traces the
+    whole process, so allocations of other threads running at the same time are included. While
+    other trackers are active, the peak is not reset at the start of a stage (that would reset the
+    peaks of the other runs), so the peak of the stage is the peak since an earlier point - such
+    stages are marked as shared in the report.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.started = False
+
+    def start(self):
+        global _active, _ownTracing
+        with _lock:
+            if not self.started:
+                if _active == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    _ownTracing = True
+                _active += 1
+                self.started = True
+        return
+
+    def stop(self):
+        global _active, _ownTracing
+        with _lock:
+            if self.started:
+                _active -= 1
+                self.started = False
+                if _active == 0 and _ownTracing:
+                    tracemalloc.stop()
+                    _ownTracing = False
+        return
+
+    @contextmanager
+    def stage(self,name):
+        # Without reset_peak (before Python 3.9), the peak is the peak since tracing started
+        with _lock:
+            shared = _active > 1 or not hasattr(tracemalloc, 'reset_peak')
+            if not shared:
+                tracemalloc.reset_peak()
+            (current,peak) = tracemalloc.get_traced_memory()
+        (rss,peakRss) = processMemory()
+        try:
+            yield
+        finally:
+            with _lock:
+                (exitCurrent,exitPeak) = tracemalloc.get_traced_memory()
+                shared = shared or _active > 1
+            (exitRss,exitPeakRss) = processMemory()
+            self.stages.append({'stage': name, 'python_entry': current, 'python_exit': exitCurrent,
+                                'python_peak': exitPeak, 'rss_entry': rss, 'rss_exit': exitRss, 'rss_peak': exitPeakRss,
+                                'shared': shared})
+
+    def peakPython(self):
+        return max((stage['python_peak'] for stage in self.stages), default=0)
+
+    def peakRss(self):
+        # The highest peak RSS of the stages, or the highest RSS at entry or exit without the peak
+        values = [stage[key] for stage in self.stages for key in ('rss_peak', 'rss_entry', 'rss_exit') if stage[key] is not None]
+        return max(values, default=None)
+
+    def report(self):
+        # One line per stage, with the amounts in MB
+        def mb(value):
+            return '-' if value is None else '{:.1f}'.format(value / MB)
+        lines = ['{:<32} {:>12} {:>12} {:>12} {:>12}'.format('Stage', 'Python peak', 'RSS entry', 'RSS exit', 'RSS peak')]
+        for stage in self.stages:
+            lines.append('{:<32} {:>12} {:>12} {:>12} {:>12}'.format(stage['stage'], mb(stage['python_peak']) + ('*' if stage['shared'] else ''),
+                         mb(stage['rss_entry']), mb(stage['rss_exit']), mb(stage['rss_peak'])))
+        if any(stage['shared'] for stage in self.stages):
+            lines.append('* Traced while other runs were traced - the peak includes them and earlier stages')
+        return "\n".join(lines)
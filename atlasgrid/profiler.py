@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+
+# Setting with a directory for profiles of grids created from the dialog (not shown in the dialog)
+PROFILE_SETTING = 'atlasgrid/profileDirectory'
+
+# Only one profiler can be enabled at a time (since Python 3.12, enabling a second one fails), so
+# concurrent runs (e.g. of a batch) are profiled one at a time and the others are not profiled
+_profiling = threading.Lock()
+
+class Profiler():
+    """Profiles the code run within a with block with cProfile, if a path is given.
+
+    The statistics are written to the path (a .pstats file, e.g. for snakeviz or pstats), and a
+    summary of the hottest functions is written next to it as a .txt file and returned by summary().
+    cProfile only profiles the thread it is enabled in, so the block must run in a single thread.
+    If another run is being profiled, the block is not profiled (see profiled()).
+    """
+
+    # Number of functions listed in the summary
+    SUMMARY_FUNCTIONS = 25
+
+    def __init__(self,path=None):
+        self.path = path
+        self.profile = None
+        self.text = None
+
+    def __enter__(self):
+        if self.path and _profiling.acquire(blocking=False):
+            self.profile = cProfile.Profile()
+            try:
+                self.profile.enable()
+            except ValueError:
+                # Another profiling tool (e.g. of a debugger) is active
+                self.profile = None
+                _profiling.release()
+        return self
+
+    def __exit__(self,excType,excValue,traceback):
+        if self.profile is None:
+            return False
+        self.profile.disable()
+        _profiling.release()
+        self.profile.dump_stats(self.path)
+
+        # The functions of the plugin by cumulative time (the time of each stage), then all functions by own time
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(re.escape(os.path.basename(os.path.dirname(os.path.abspath(__file__)))), self.SUMMARY_FUNCTIONS)
+        stats.sort_stats('tottime').print_stats(self.SUMMARY_FUNCTIONS)
+        self.text = stream.getvalue()
+        with open(self.summaryPath(), 'w', encoding='utf-8') as f:
+            f.write(self.text)
+        return False
+
+    def profiled(self):
+        # False if a path was given, but another run was being profiled
+        return self.text is not None
+
+    def summaryPath(self):
+        return os.path.splitext(self.path)[0] + '.txt'
+
+    def summary(self):
+        return self.text
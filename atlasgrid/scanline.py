@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+# Zone states
+OUTSIDE = 0
+INSIDE = 1
+BOUNDARY = 2
+
+class Raster():
+    """Scanline rasterization of the AoI into a rectilinear grid of zones.
+
+    The zone edges are given as ascending x and y coordinates. Each zone is classified as
+    certainly inside the AoI, certainly outside the AoI, or boundary (touched by an edge of
+    the AoI, including edges running along the zone edges).
+
+    The AoI is given as rings - a list of (part, x, y) with the part number and the vertex
+    coordinates (NumPy arrays) of each closed ring. The interior is found by an even-odd
+    fill within each part, so overlapping parts are handled correctly. Lines and points are
+    given as paths - a list of (x, y) - which only mark the zones they touch as boundary.
+    Zone rows are numbered from the south.
+    """
+
+    def __init__(self,xs,ys,rings,paths=()):
+        self.xs = xs
+        self.ys = ys
+        self.states = np.full((len(self.ys) - 1, len(self.xs) - 1), OUTSIDE, dtype=np.int8)
+
+        if rings:
+            part = np.concatenate([np.full(len(x) - 1, p, dtype=np.int64) for (p,x,y) in rings])
+            x0 = np.concatenate([x[:-1] for (p,x,y) in rings])
+            x1 = np.concatenate([x[1:] for (p,x,y) in rings])
+            y0 = np.concatenate([y[:-1] for (p,x,y) in rings])
+            y1 = np.concatenate([y[1:] for (p,x,y) in rings])
+            self.fillInterior(part,x0,y0,x1,y1)
+            self.markBoundary(x0,y0,x1,y1)
+        for (x,y) in paths:
+            # A point is a path with a single vertex
+            (x,y) = (np.append(x, x[-1:]), np.append(y, y[-1:])) if len(x) == 1 else (x,y)
+            self.markBoundary(x[:-1],y[:-1],x[1:],y[1:])
+
+    @staticmethod
+    def expand(first,last):
+        # For ranges [first,last], returns the index of the range and each value in the ranges
+        counts = np.maximum(last - first + 1, 0)
+        index = np.repeat(np.arange(len(first)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return (index, first[index] + offsets)
+
+    def markBoundary(self,x0,y0,x1,y1):
+        (xs,ys) = (self.xs, self.ys)
+        (nx,ny) = (len(xs) - 1, len(ys) - 1)
+        (xa,xb) = (np.minimum(x0,x1), np.maximum(x0,x1))
+        (ya,yb) = (np.minimum(y0,y1), np.maximum(y0,y1))
+        inside = (xb >= xs[0]) & (xa <= xs[-1]) & (yb >= ys[0]) & (ya <= ys[-1])
+        (x0,y0,x1,y1,xa,xb) = (x0[inside], y0[inside], x1[inside], y1[inside], xa[inside], xb[inside])
+
+        # Zone columns touched by each edge (an edge on a zone edge touches the zones on both sides)
+        k0 = np.clip(np.searchsorted(xs, xa, 'left') - 1, 0, nx - 1)
+        k1 = np.clip(np.searchsorted(xs, xb, 'right') - 1, 0, nx - 1)
+        (e,k) = self.expand(k0,k1)
+
+        # The part of the edge within each zone column, and the zone rows it touches
+        cx0 = np.maximum(xs[k], xa[e])
+        cx1 = np.minimum(xs[k+1], xb[e])
+        dx = x1[e] - x0[e]
+        vertical = dx == 0
+        slope = np.where(vertical, 0, (y1[e] - y0[e]) / np.where(vertical, 1, dx))
+        yc0 = np.where(vertical, y0[e], y0[e] + (cx0 - x0[e]) * slope)
+        yc1 = np.where(vertical, y1[e], y0[e] + (cx1 - x0[e]) * slope)
+        (ya,yb) = (np.minimum(yc0,yc1), np.maximum(yc0,yc1))
+        # Within a zone column, the edge may run above or below all zones
+        within = (yb >= ys[0]) & (ya <= ys[-1])
+        (e,k,ya,yb) = (e[within], k[within], ya[within], yb[within])
+        r0 = np.clip(np.searchsorted(ys, ya, 'left') - 1, 0, ny - 1)
+        r1 = np.clip(np.searchsorted(ys, yb, 'right') - 1, 0, ny - 1)
+        (m,r) = self.expand(r0,r1)
+        self.states[r, k[m]] = BOUNDARY
+        return
+
+    def fillInterior(self,part,x0,y0,x1,y1):
+        # Scanlines through the center of each zone row
+        (xs,ys) = (self.xs, self.ys)
+        (nx,ny) = (len(xs) - 1, len(ys) - 1)
+        yc = (ys[:-1] + ys[1:]) / 2
+        xc = (xs[:-1] + xs[1:]) / 2
+
+        # Crossings of the edges with the scanlines (half-open in y, so vertices are counted once)
+        (ya,yb) = (np.minimum(y0,y1), np.maximum(y0,y1))
+        (e,r) = self.expand(np.searchsorted(yc, ya, 'left'), np.searchsorted(yc, yb, 'left') - 1)
+        if len(e) == 0:
+            return
+        x = x0[e] + (yc[r] - y0[e]) * (x1[e] - x0[e]) / (y1[e] - y0[e])
+
+        # Within each part and scanline, consecutive pairs of crossings delimit the interior
+        order = np.lexsort((x, r, part[e]))
+        (x, r, p) = (x[order], r[order], part[e][order])
+        newGroup = np.ones(len(x), dtype=np.bool_)
+        newGroup[1:] = (r[1:] != r[:-1]) | (p[1:] != p[:-1])
+        groupStart = np.maximum.accumulate(np.where(newGroup, np.arange(len(x)), 0))
+        start = np.flatnonzero((np.arange(len(x)) - groupStart) % 2 == 0)
+        start = start[start + 1 < len(x)]
+        start = start[(r[start + 1] == r[start]) & (p[start + 1] == p[start])]
+
+        # Zone columns with their center within each interior interval
+        c0 = np.searchsorted(xc, x[start], 'left')
+        c1 = np.searchsorted(xc, x[start + 1], 'left')
+        diff = np.zeros((ny, nx + 1), dtype=np.int32)
+        np.add.at(diff, (r[start], c0), 1)
+        np.add.at(diff, (r[start], c1), -1)
+        self.states[np.cumsum(diff, axis=1)[:, :nx] > 0] = INSIDE
+        return
+
+
+class ZoneRaster(Raster):
+    """Rasterization of the AoI into the zones of a lattice.
+
+    The zones are the cores of the cells (the parts not overlapped by other cells) and the
+    overlaps between neighbouring cells. Their edges are the left/right and top/bottom edges
+    of all cells, so they form a rectilinear grid with 2*cols-1 columns and 2*rows-1 rows.
+    Only boundary zones need an exact test.
+    """
+
+    def __init__(self,lattice,rings,paths=()):
+        self.lattice = lattice
+        left = lattice.xMin + np.arange(lattice.cols) * lattice.netWidth
+        top = lattice.yMax - np.arange(lattice.rows) * lattice.netHeight
+        # With zero overlap, the overlap zones have zero width
+        xs = np.sort(np.concatenate((left, left + lattice.width)))
+        ys = np.sort(np.concatenate((top - lattice.height, top)))
+        Raster.__init__(self,xs,ys,rings,paths)
+
+    def zoneStates(self,xmin,ymin,xmax,ymax):
+        # States of the zones containing the centers of the rectangles (zones of the lattice, as NumPy arrays)
+        k = np.searchsorted(self.xs, (np.asarray(xmin) + xmax) / 2) - 1
+        r = np.searchsorted(self.ys, (np.asarray(ymin) + ymax) / 2) - 1
+        return self.states[r, k]
+
+    def state(self,xmin,ymin,xmax,ymax):
+        return int(self.zoneStates(xmin,ymin,xmax,ymax))
+
+    def coreStates(self):
+        # States of the cores of all cells as a (rows, cols) array - the core of column j is zone
+        # column 2j, and the core of row i is zone row 2*(rows-1-i) counted from the south
+        lattice = self.lattice
+        return self.states[2 * (lattice.rows - 1 - np.arange(lattice.rows))][:, 2 * np.arange(lattice.cols)]
+
+
+class NetCellRaster(Raster):
+    """Rasterization of the AoI into the net cells (see Lattice.netCellBounds) of the rows
+    row0..row1 and the columns col0..col1 of a lattice. The net cells tile the plane, so
+    their edges form a rectilinear grid.
+    """
+
+    def __init__(self,lattice,row0,row1,col0,col1,rings,paths=()):
+        (self.row0,self.col0) = (row0,col0)
+        (xmin,_,xmax,_) = lattice.netCellBounds(row0, np.arange(col0, col1 + 1))
+        (_,ymin,_,ymax) = lattice.netCellBounds(np.arange(row1, row0 - 1, -1), col0)
+        Raster.__init__(self,np.append(xmin, xmax[-1]),np.append(ymin, ymax[-1]),rings,paths)
+
+    def cellStates(self):
+        # States of the net cells as a (rows, cols) array, starting with row0 and col0
+        return self.states[::-1]
+
+
+class PixelRaster(Raster):
+    """Rasterization of the AoI into a bitmap of square pixels.
+
+    The bitmap is conservative: every pixel touched by the AoI is set, and the set pixels are
+    dilated by one pixel, so rounding can never drop a pixel the AoI intersects. Sums of set
+    pixels over rectangles are read from a summed-area table in constant time.
+    """
+
+    def __init__(self,xMin,yMin,xMax,yMax,pixelSize,rings,paths=()):
+        self.pixelSize = pixelSize
+        (self.xMin,self.yMin) = (xMin,yMin)
+        nx = max(1, int(np.ceil((xMax - xMin) / pixelSize)))
+        ny = max(1, int(np.ceil((yMax - yMin) / pixelSize)))
+        Raster.__init__(self,xMin + np.arange(nx + 1) * pixelSize,yMin + np.arange(ny + 1) * pixelSize,rings,paths)
+
+        bitmap = self.states != OUTSIDE
+        dilated = bitmap.copy()
+        dilated[1:,:] |= bitmap[:-1,:]
+        dilated[:-1,:] |= bitmap[1:,:]
+        dilated[:,1:] |= dilated[:,:-1].copy()
+        dilated[:,:-1] |= dilated[:,1:].copy()
+        self.touched = self.summedAreaTable(dilated)
+        self.inside = self.summedAreaTable(self.states == INSIDE)
+
+    @staticmethod
+    def summedAreaTable(bitmap):
+        table = np.zeros((bitmap.shape[0] + 1, bitmap.shape[1] + 1), dtype=np.int64)
+        table[1:,1:] = bitmap.cumsum(axis=0, dtype=np.int64).cumsum(axis=1)
+        return table
+
+    def pixelRange(self,xmin,ymin,xmax,ymax,outer):
+        # Half-open pixel column and row ranges covering (outer) or within (inner) the rectangles
+        (rnd0,rnd1) = (np.floor,np.ceil) if outer else (np.ceil,np.floor)
+        (ny,nx) = self.states.shape
+        c0 = np.clip(rnd0((np.asarray(xmin) - self.xMin) / self.pixelSize), 0, nx).astype(np.int64)
+        c1 = np.clip(rnd1((np.asarray(xmax) - self.xMin) / self.pixelSize), 0, nx).astype(np.int64)
+        r0 = np.clip(rnd0((np.asarray(ymin) - self.yMin) / self.pixelSize), 0, ny).astype(np.int64)
+        r1 = np.clip(rnd1((np.asarray(ymax) - self.yMin) / self.pixelSize), 0, ny).astype(np.int64)
+        return (c0, r0, np.maximum(c1, c0), np.maximum(r1, r0))
+
+    @staticmethod
+    def rectSum(table,c0,r0,c1,r1):
+        return table[r1,c1] - table[r0,c1] - table[r1,c0] + table[r0,c0]
+
+    def touchedSum(self,xmin,ymin,xmax,ymax):
+        # Number of set pixels covering the rectangles - zero only if the AoI certainly does not intersect them
+        return self.rectSum(self.touched, *self.pixelRange(xmin,ymin,xmax,ymax,True))
+
+    def insideSum(self,xmin,ymin,xmax,ymax):
+        # Number of pixels within the rectangles that are certainly inside the AoI
+        return self.rectSum(self.inside, *self.pixelRange(xmin,ymin,xmax,ymax,False))
@@ -0,0 +1,10 @@
+# coding=utf-8
+"""pytest configuration: the tests import the plugin modules directly (e.g. from cellstore import
+Lattice), as with make test, which puts the plugin directory on PYTHONPATH."""
+
+import os
+import sys
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PLUGIN_DIR not in sys.path:
+    sys.path.insert(0, PLUGIN_DIR)
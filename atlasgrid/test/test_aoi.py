@@ -0,0 +1,142 @@
+# coding=utf-8
+"""Tests of the AoI index (connected parts, subdivision, outward simplification and clipping for the
+masks), which need QGIS.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'morten@styrke10.dk'
+__date__ = '2024-06-24'
+__copyright__ = 'Copyright 2024, Styrke10 ApS'
+
+import math
+import unittest
+
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransformContext,
+    QgsFeature,
+    QgsGeometry,
+    QgsPointXY,
+    QgsVectorLayer)
+
+from ..aoi import AoiIndex
+
+from .utilities import get_qgis_app
+QGIS_APP = get_qgis_app()
+
+
+def aoiIndex(wkts, **kwargs):
+    # An AoI index over a memory layer with a feature for each WKT geometry
+    layer = QgsVectorLayer('MultiPolygon?crs=EPSG:25832', 'aoi', 'memory')
+    features = []
+    for wkt in wkts:
+        feat = QgsFeature(layer.fields())
+        feat.setGeometry(QgsGeometry.fromWkt(wkt))
+        features.append(feat)
+    layer.dataProvider().addFeatures(features)
+    return AoiIndex(layer, QgsCoordinateReferenceSystem('EPSG:25832'), QgsCoordinateTransformContext(), **kwargs)
+
+
+class ConnectedPartsTest(unittest.TestCase):
+    """Test the groups of touching or intersecting AoI parts."""
+
+    def test_connected_parts(self):
+        """Parts are connected through touching parts, also of other features."""
+        index = aoiIndex(['MultiPolygon(((0 0, 10 0, 10 10, 0 10, 0 0)), ((30 0, 40 0, 40 10, 30 10, 30 0)))',
+                          'MultiPolygon(((10 0, 20 0, 20 10, 10 10, 10 0)))',
+                          'MultiPolygon(((50 0, 60 0, 60 10, 50 10, 50 0)))'])
+        (parts, groups) = index.connectedParts()
+        self.assertEqual(len(parts), 4)
+        groupAt = {part.boundingBox().xMinimum(): group for (part, group) in zip(parts, groups)}
+        self.assertEqual(groupAt[0], groupAt[10])
+        self.assertEqual(len({groupAt[0], groupAt[30], groupAt[50]}), 3)
+
+    def test_connected_parts_with_overlapping_boxes(self):
+        """Parts with overlapping bounding boxes are only connected if they intersect."""
+        index = aoiIndex(['MultiPolygon(((0 0, 10 0, 0 10, 0 0)))', 'MultiPolygon(((10 10, 10 3, 3 10, 10 10)))'])
+        (parts, groups) = index.connectedParts()
+        self.assertNotEqual(groups[0], groups[1])
+
+
+def starWkt(n, rMin, rMax):
+    # A star-shaped polygon with n vertices alternating between two radii
+    points = []
+    for k in range(n):
+        (r, a) = (rMax if k % 2 == 0 else rMin, 2 * math.pi * k / n)
+        points.append('{} {}'.format(r * math.cos(a), r * math.sin(a)))
+    return 'MultiPolygon((({}, {})))'.format(', '.join(points), points[0])
+
+
+class SubdivisionTest(unittest.TestCase):
+    """Test the subdivision and the outward simplification of vertex-heavy AoIs."""
+
+    def test_subdivide(self):
+        """The pieces have at most maxVertices vertices, tile the AoI and give the same tests."""
+        wkt = starWkt(2000, 90, 100)
+        index = aoiIndex([wkt], maxVertices=64)
+        geom = QgsGeometry.fromWkt(wkt)
+        self.assertGreater(len(index.pieces), 1)
+        for piece in index.pieces:
+            self.assertLessEqual(piece.constGet().nCoordinates(), 64)
+        self.assertAlmostEqual(sum(piece.area() for piece in index.pieces), geom.area(), delta=1e-6 * geom.area())
+        for (xmin, ymin, xmax, ymax) in ((-5, -5, 5, 5), (92, -1, 96, 1), (99, 99, 120, 120), (-200, 0, -150, 50)):
+            rect = QgsGeometry.fromWkt('Polygon(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(xmin, ymin, xmax, ymax))
+            self.assertEqual(index.intersectsRect(xmin, ymin, xmax, ymax), geom.intersects(rect), (xmin, ymin, xmax, ymax))
+
+    def test_small_aoi_not_subdivided(self):
+        index = aoiIndex([starWkt(20, 90, 100)], maxVertices=64)
+        self.assertEqual(len(index.pieces), 1)
+
+    def test_simplify_outward(self):
+        """The simplified AoI contains the original one and stays within about twice the tolerance of it."""
+        geom = QgsGeometry.fromWkt(starWkt(2000, 97, 100))
+        simplified = AoiIndex.simplifyOutward(geom, 5.0)
+        self.assertTrue(simplified.contains(geom))
+        self.assertLess(simplified.constGet().nCoordinates(), geom.constGet().nCoordinates())
+        self.assertLessEqual(simplified.hausdorffDistance(geom), 11.0)
+        # Points outside the tolerance of the AoI stay outside
+        self.assertFalse(simplified.contains(QgsGeometry.fromPointXY(QgsPointXY(115, 0))))
+
+    def test_simplify_outward_keeps_small_parts(self):
+        """Parts smaller than the tolerance are kept."""
+        geom = QgsGeometry.fromWkt('MultiPolygon(((0 0, 1 0, 1 1, 0 1, 0 0)), ((100 0, 200 0, 200 100, 100 100, 100 0)))')
+        simplified = AoiIndex.simplifyOutward(geom, 5.0)
+        self.assertTrue(simplified.contains(geom))
+        self.assertEqual(len(simplified.asGeometryCollection()), 2)
+
+
+class ClipTest(unittest.TestCase):
+    """Test the clipping of the AoI to a sheet, from which the mask of the sheet is computed."""
+
+    def setUp(self):
+        # Two overlapping features
+        self.index = aoiIndex(['MultiPolygon(((0 0, 20 0, 20 20, 0 20, 0 0)))',
+                               'MultiPolygon(((10 10, 30 10, 30 30, 10 30, 10 10)))'])
+
+    def mask(self, xmin, ymin, xmax, ymax):
+        # As in GridCreator.createMaskLayer
+        rect = QgsGeometry.fromWkt('Polygon(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(xmin, ymin, xmax, ymax))
+        aoi = self.index.clip(xmin, ymin, xmax, ymax)
+        return rect if aoi is None else rect.difference(aoi)
+
+    def test_clip_dissolves(self):
+        """The features are dissolved, so their overlap is only counted once."""
+        clipped = self.index.clip(5, 5, 25, 25)
+        self.assertAlmostEqual(clipped.area(), 400 - 2 * 25)
+        self.assertAlmostEqual(self.index.clippedArea(5, 5, 25, 25), 400 - 2 * 25)
+
+    def test_masks(self):
+        """The mask is the part of the sheet outside the AoI."""
+        self.assertAlmostEqual(self.mask(5, 5, 25, 25).area(), 2 * 25)
+        self.assertTrue(self.mask(2, 2, 8, 8).isEmpty())
+        self.assertIsNone(self.index.clip(40, 40, 50, 50))
+        self.assertAlmostEqual(self.mask(40, 40, 50, 50).area(), 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
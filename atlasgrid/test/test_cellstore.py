@@ -0,0 +1,510 @@
+# coding=utf-8
+"""Tests of the QGIS-free core (lattice, naming, numbering, overlap zones and grouping).
+
+The tests only need NumPy, e.g. from the plugin directory:
+
+    PYTHONPATH=. python -m unittest discover -s test -p test_cellstore.py
+
+or with pytest from the repository root (test/conftest.py puts the plugin directory on the path).
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'morten@styrke10.dk'
+__date__ = '2024-06-24'
+__copyright__ = 'Copyright 2024, Styrke10 ApS'
+
+import unittest
+
+import numpy as np
+
+from cellstore import (Lattice, CellStore, UnionFind, SHEET_ORDERS, ORDER_ROWS, ORDER_SERPENTINE,
+                       ORDER_HILBERT, sheetOrderKeys, sheetDimensions, fitExtent, levelFactor,
+                       numberConsecutively, NEIGHBOURS)
+
+
+def lattice(rows=4, cols=5, overlap=0.2):
+    # 10 x 20 sheets with the given overlap (as a fraction of the sheet size)
+    return Lattice(1000.0, 5000.0, 10.0, 20.0, 10.0 * (1 - overlap), 20.0 * (1 - overlap), rows, cols)
+
+
+class GridMetricsTest(unittest.TestCase):
+    """Test the sheet dimensions and the fitting of the grid to an extent."""
+
+    def test_sheet_dimensions(self):
+        """A 0.2 x 0.1 m map at 1:10000 with 10% / 20% overlap."""
+        np.testing.assert_allclose(sheetDimensions(0.2, 0.1, 10000, 10, 20), (2000.0, 1000.0, 1800.0, 800.0))
+
+    def test_fit_extent_covers_and_centers(self):
+        """The grid covers the extent and is centered on it."""
+        rwDim = (2000.0, 1000.0, 1800.0, 800.0)
+        (xmin, ymin, xmax, ymax) = (500000.0, 6000000.0, 512345.0, 6004321.0)
+        ((rows, cols), (gxmin, gymin, gxmax, gymax)) = fitExtent(xmin, ymin, xmax, ymax, rwDim)
+        gridXmax = gxmin + rwDim[0] + (cols - 1) * rwDim[2]
+        gridYmin = gymax - rwDim[1] - (rows - 1) * rwDim[3]
+        self.assertLessEqual(gxmin, xmin)
+        self.assertGreaterEqual(gridXmax, xmax)
+        self.assertGreaterEqual(gymax, ymax)
+        self.assertLessEqual(gridYmin, ymin)
+        self.assertAlmostEqual(xmin - gxmin, gridXmax - xmax)
+        self.assertAlmostEqual(gymax - ymax, ymin - gridYmin)
+        # The moved extent keeps its size
+        self.assertAlmostEqual(gxmax - gxmin, xmax - xmin)
+        self.assertAlmostEqual(gymax - gymin, ymax - ymin)
+
+    def test_level_factor(self):
+        """Levels of a nested series multiply the subdivisions."""
+        self.assertEqual([levelFactor((2, 3), level) for level in range(3)], [1, 2, 6])
+
+
+class LatticeTest(unittest.TestCase):
+    """Test the lattice maths and the naming of the sheets."""
+
+    def test_bounds(self):
+        """Gross, net and core rectangles of an interior cell."""
+        grid = lattice()
+        self.assertEqual(grid.cellBounds(1, 2), (1016.0, 4964.0, 1026.0, 4984.0))
+        np.testing.assert_allclose(grid.netCellBounds(1, 2), (1017.0, 4966.0, 1025.0, 4982.0))
+        np.testing.assert_allclose(grid.coreBounds(1, 2), (1018.0, 4968.0, 1024.0, 4980.0))
+        # Cells on the edge of the lattice are not overlapped towards the edge
+        np.testing.assert_allclose(grid.coreBounds(0, 0), (1000.0, 4984.0, 1008.0, 5000.0))
+
+    def test_index_range(self):
+        """The index range contains exactly the cells intersecting a rectangle."""
+        grid = lattice()
+        rect = (1015.0, 4950.0, 1017.0, 4970.0)
+        (row0, row1, col0, col1) = grid.indexRange(*rect)
+        for row in range(grid.rows):
+            for col in range(grid.cols):
+                (xmin, ymin, xmax, ymax) = grid.cellBounds(row, col)
+                intersects = xmin <= rect[2] and xmax >= rect[0] and ymin <= rect[3] and ymax >= rect[1]
+                self.assertEqual(intersects, row0 <= row <= row1 and col0 <= col <= col1, (row, col))
+        self.assertIsNone(grid.indexRange(0.0, 0.0, 10.0, 10.0))
+
+    def test_index_range_of_point(self):
+        """The index range of a point contains exactly the cells containing it (used for points in the gazetteer)."""
+        grid = lattice()
+        rng = np.random.default_rng(9)
+        # Random points and points on the cell edges, also outside the lattice
+        x = np.concatenate((rng.uniform(990.0, 1050.0, 200), np.repeat(np.arange(990.0, 1050.0, 1.0), 2)))
+        y = np.concatenate((rng.uniform(4910.0, 5010.0, 200), np.tile([4984.0, 4920.0], 60)))
+        (rows, cols) = grid.cellsAt(x, y)
+        for k in range(len(x)):
+            containing = {(int(r), int(c)) for (r, c) in zip(rows[k], cols[k]) if r >= 0}
+            indexRange = grid.indexRange(x[k], y[k], x[k], y[k])
+            inRange = set()
+            if indexRange is not None:
+                (row0, row1, col0, col1) = indexRange
+                inRange = {(row, col) for row in range(row0, row1 + 1) for col in range(col0, col1 + 1)}
+            self.assertEqual(inRange, containing, (x[k], y[k]))
+
+    def test_cells_intersecting(self):
+        """Only points and bounding boxes within a single cell need no exact test."""
+        grid = lattice()
+        # Within the core of cell (1, 2)
+        (cells, exact) = grid.cellsIntersecting(1019.0, 4970.0, 1023.0, 4975.0)
+        self.assertEqual((cells.tolist(), exact), ([7], False))
+        # Within the overlap of cells (1, 2) and (1, 3)
+        (cells, exact) = grid.cellsIntersecting(1024.5, 4970.0, 1025.5, 4975.0)
+        self.assertEqual((cells.tolist(), exact), ([7, 8], True))
+        # A point in the overlap is on both cells
+        (cells, exact) = grid.cellsIntersecting(1025.0, 4970.0, 1025.0, 4970.0)
+        self.assertEqual((cells.tolist(), exact), ([7, 8], False))
+        # Only partly within the lattice: the geometry may be outside the single cell
+        (cells, exact) = grid.cellsIntersecting(990.0, 4990.0, 1005.0, 4995.0)
+        self.assertEqual((cells.tolist(), exact), ([0], True))
+        self.assertEqual(len(grid.cellsIntersecting(0.0, 0.0, 10.0, 10.0)[0]), 0)
+
+    def test_cells_at(self):
+        """cellsAt finds all cells containing a point, and netCellAt the one net cell."""
+        grid = lattice()
+        rng = np.random.default_rng(1)
+        x = rng.uniform(995.0, 1050.0, 500)
+        y = rng.uniform(4910.0, 5005.0, 500)
+        (rows, cols) = grid.cellsAt(x, y)
+        (netRow, netCol) = grid.netCellAt(x, y)
+        for k in range(len(x)):
+            expected = set()
+            for row in range(grid.rows):
+                for col in range(grid.cols):
+                    (xmin, ymin, xmax, ymax) = grid.cellBounds(row, col)
+                    if xmin <= x[k] <= xmax and ymin <= y[k] <= ymax:
+                        expected.add((row, col))
+            found = {(int(r), int(c)) for (r, c) in zip(rows[k], cols[k]) if r >= 0}
+            self.assertEqual(found, expected)
+            if netRow[k] >= 0:
+                (xmin, ymin, xmax, ymax) = grid.netCellBounds(int(netRow[k]), int(netCol[k]))
+                self.assertTrue(xmin <= x[k] <= xmax and ymin <= y[k] <= ymax)
+
+    def test_sheets_at(self):
+        """The sheet whose net cell contains a point comes first, then the other sheets by cellnum."""
+        grid = lattice(rows=2, cols=3)
+        cellnum = np.array([1, 2, 3, 4, 5, 6])
+        # In the overlap of all four cells of the first two columns, in the net cell of (0, 1)
+        (x, y) = ([1009.5, 1009.5, 1050.0], [4983.5, 4983.5, 4900.0])
+        (index, nums, counts) = grid.sheetsAt(x[:1], y[:1], cellnum)
+        self.assertEqual(counts.tolist(), [4])
+        self.assertEqual(index[0, :4].tolist(), [1, 0, 3, 4])
+        self.assertEqual(nums[0, :4].tolist(), [2, 1, 4, 5])
+        # Without the sheet of the net cell, the sheets follow by cellnum, and points outside have none
+        cellnum[1] = 0
+        (index, nums, counts) = grid.sheetsAt(x, y, cellnum)
+        self.assertEqual(counts.tolist(), [3, 3, 0])
+        self.assertEqual(index[0, :3].tolist(), [0, 3, 4])
+
+    def test_cell_names(self):
+        """Names run A-Z, AA-AZ, BA... and parse back to the row and column."""
+        grid = Lattice(0.0, 0.0, 1.0, 1.0, 1.0, 1.0, 100, 100)
+        self.assertEqual(grid.cellName(0, 0), 'A1')
+        self.assertEqual(grid.cellName(11, 27), 'AB12')
+        for (row, col) in ((0, 0), (3, 25), (11, 27), (99, 99)):
+            self.assertEqual(Lattice.parseCellName(grid.cellName(row, col)), (row, col))
+        with self.assertRaises(ValueError):
+            Lattice.parseCellName('12')
+
+    def test_cell_keys(self):
+        """Keys are positive, unique per cell, stable and split back to the row and column."""
+        grid = lattice(rows=30, cols=40)
+        (row, col) = np.meshgrid(np.arange(30), np.arange(40), indexing='ij')
+        keys = grid.cellKey(row.ravel(), col.ravel())
+        self.assertTrue((keys > 0).all())
+        self.assertEqual(len(np.unique(keys)), keys.size)
+        (keyRow, keyCol) = Lattice.splitKey(keys)
+        np.testing.assert_array_equal(keyRow, row.ravel())
+        np.testing.assert_array_equal(keyCol, col.ravel())
+        self.assertEqual(Lattice.fromParams(grid.params()).cellKey(3, 4), grid.cellKey(3, 4))
+        self.assertNotEqual(lattice(overlap=0.1).cellKey(3, 4), grid.cellKey(3, 4))
+
+    def test_subdivide(self):
+        """The net cells of a subdivided lattice subdivide the net cells of the lattice."""
+        grid = lattice()
+        fine = grid.subdivide(3)
+        self.assertEqual((fine.rows, fine.cols), (12, 15))
+        # The first and the last child share the north-west and south-east corner with the parent
+        (xmin, ymin, xmax, ymax) = grid.netCellBounds(1, 2)
+        np.testing.assert_allclose(np.take(fine.netCellBounds(3, 6), (0, 3)), (xmin, ymax))
+        np.testing.assert_allclose(np.take(fine.netCellBounds(5, 8), (1, 2)), (ymin, xmax))
+        self.assertAlmostEqual(fine.overlapX / fine.width, grid.overlapX / grid.width)
+
+
+class NumberingTest(unittest.TestCase):
+    """Test the sheet orders and the numbering of the kept cells."""
+
+    def test_orders_are_permutations(self):
+        """Each order gives each cell its own key."""
+        (row, col) = np.meshgrid(np.arange(7), np.arange(11), indexing='ij')
+        for order in SHEET_ORDERS:
+            keys = sheetOrderKeys(row.ravel(), col.ravel(), 7, 11, order)
+            self.assertEqual(len(np.unique(keys)), keys.size, order)
+
+    def test_consecutive_cells_adjacent(self):
+        """Consecutive cells are adjacent along the serpentine and the Hilbert curve."""
+        (row, col) = np.meshgrid(np.arange(8), np.arange(8), indexing='ij')
+        (row, col) = (row.ravel(), col.ravel())
+        for order in (ORDER_SERPENTINE, ORDER_HILBERT):
+            sort = np.argsort(sheetOrderKeys(row, col, 8, 8, order))
+            steps = np.abs(np.diff(row[sort])) + np.abs(np.diff(col[sort]))
+            self.assertTrue((steps == 1).all(), order)
+
+    def test_number_kept_cells(self):
+        """Kept cells are numbered from 1 row by row, deleted cells get 0."""
+        store = CellStore(lattice(rows=2, cols=3))
+        store.keep[:] = [True, False, True, True, True, False]
+        store.number(ORDER_ROWS)
+        np.testing.assert_array_equal(store.cellnum, [1, 0, 2, 3, 4, 0])
+        store.numberPrintOrder(ORDER_SERPENTINE)
+        np.testing.assert_array_equal(store.print_order, [1, 0, 2, 4, 3, 0])
+
+    def test_number_consecutively(self):
+        """The cells of several stores are numbered consecutively."""
+        stores = [CellStore(lattice(rows=1, cols=3)), CellStore(lattice(rows=2, cols=2))]
+        stores[1].keep[1] = False
+        for store in stores:
+            store.number()
+            store.dj_cellnum[:] = store.cellnum
+        numberConsecutively(stores)
+        np.testing.assert_array_equal(stores[0].cellnum, [1, 2, 3])
+        np.testing.assert_array_equal(stores[1].cellnum, [4, 0, 5, 6])
+        np.testing.assert_array_equal(stores[1].dj_cellnum, [4, 0, 5, 6])
+
+
+class CellStoreTest(unittest.TestCase):
+    """Test the columns of the cell store and the numbering in each sheet order."""
+
+    def test_columns(self):
+        """The cells are stored row by row, and their geometry and keys come from the lattice."""
+        store = CellStore(lattice(rows=3, cols=4))
+        grid = store.lattice
+        self.assertEqual(len(store), 12)
+        np.testing.assert_array_equal(store.cellIndex(store.row, store.col), np.arange(12))
+        np.testing.assert_array_equal(store.row, np.repeat(np.arange(3), 4))
+        indices = np.array([0, 5, 11])
+        np.testing.assert_allclose(store.bounds(indices), grid.cellBounds(store.row[indices], store.col[indices]))
+        np.testing.assert_array_equal(store.cellKey(indices), grid.cellKey(store.row[indices], store.col[indices]))
+        self.assertEqual(store.cellName(6), grid.cellName(1, 2))
+        self.assertTrue(store.keep.all())
+        self.assertFalse(store.cellnum.any() or store.dj_cellnum.any() or store.print_order.any())
+
+    def test_number_in_each_order(self):
+        """The kept cells are numbered from 1 in the order of their sheet order keys."""
+        store = CellStore(lattice(rows=5, cols=6))
+        store.keep[:] = np.random.default_rng(6).random(len(store)) < 0.7
+        kept = store.keptIndices()
+        for order in SHEET_ORDERS:
+            store.number(order)
+            keys = sheetOrderKeys(store.row[kept], store.col[kept], 5, 6, order)
+            np.testing.assert_array_equal(store.keptInOrder(order), kept[np.argsort(keys)], order)
+            np.testing.assert_array_equal(np.sort(store.cellnum[kept]), np.arange(1, len(kept) + 1), order)
+            self.assertFalse(store.cellnum[~store.keep].any(), order)
+            self.assertTrue((np.diff(store.cellnum[kept[np.argsort(keys)]]) == 1).all(), order)
+
+
+class GroupingTest(unittest.TestCase):
+    """Test the union-find and the disjoint numbering."""
+
+    def test_union_find(self):
+        unionFind = UnionFind(6)
+        unionFind.union(4, 2)
+        unionFind.union(2, 5)
+        unionFind.union(0, 1)
+        np.testing.assert_array_equal(unionFind.labels(), [0, 0, 2, 3, 2, 2])
+
+    def test_union_find_chain(self):
+        """Unions along a long chain put all elements in one set."""
+        unionFind = UnionFind(1000)
+        for i in range(999, 0, -1):
+            unionFind.union(i, i - 1)
+        self.assertEqual(len(np.unique(unionFind.labels())), 1)
+
+    def test_number_disjoint(self):
+        """Groups are numbered by their lowest cell number, cells by cell number, deleted cells get 0."""
+        store = CellStore(lattice(rows=3, cols=3))
+        store.keep[[1, 7]] = False
+        store.number(ORDER_SERPENTINE)
+        # Cell numbers 1 2 0 / 5 4 3 / 6 0 7 in groups {0, 8}, {2, 3, 4, 5} and {6} - the deleted
+        # cell 1 is in a group as well
+        np.testing.assert_array_equal(store.cellnum, [1, 0, 2, 5, 4, 3, 6, 0, 7])
+        unionFind = UnionFind(len(store))
+        for (i, j) in ((8, 0), (2, 5), (5, 4), (3, 2), (1, 6)):
+            unionFind.union(i, j)
+        store.numberDisjoint(unionFind.labels())
+        np.testing.assert_array_equal(store.dj_cellnum, [1, 0, 3, 6, 5, 4, 7, 0, 2])
+
+    def test_number_disjoint_groups(self):
+        """Cells of the same group are numbered consecutively, groups by their lowest cell number."""
+        store = CellStore(lattice(rows=2, cols=3))
+        store.number()
+        store.numberDisjointGroups([0, 5, 1, 2, 3], [7, 7, 3, 3, 7])
+        # Groups {0, 3, 5}, {1, 2} and {4}
+        np.testing.assert_array_equal(store.dj_cellnum, [1, 4, 5, 2, 6, 3])
+
+    def test_number_disjoint_groups_chained(self):
+        """Cells in several groups connect the groups, as with a union-find over the pairs."""
+        store = CellStore(lattice(rows=8, cols=9))
+        store.keep[:] = np.random.default_rng(5).random(len(store)) < 0.8
+        store.number()
+        rng = np.random.default_rng(3)
+        (cells, groups) = (rng.integers(0, len(store), 60), rng.integers(100, 140, 60))
+        store.numberDisjointGroups(cells, groups)
+        unionFind = UnionFind(len(store))
+        for group in np.unique(groups):
+            members = cells[groups == group]
+            for i in members[1:]:
+                unionFind.union(int(members[0]), int(i))
+        expected = CellStore(store.lattice)
+        (expected.keep[:], expected.cellnum[:]) = (store.keep, store.cellnum)
+        expected.numberDisjoint(unionFind.labels())
+        np.testing.assert_array_equal(store.dj_cellnum, expected.dj_cellnum)
+        # A chain of groups through shared cells is one set of connected cells
+        store.keep[:] = True
+        store.number()
+        store.numberDisjointGroups([0, 40, 40, 7, 7, 71, 20], [1, 1, 2, 2, 3, 3, 4])
+        np.testing.assert_array_equal(store.dj_cellnum[[0, 7, 40, 71]], [1, 2, 3, 4])
+
+    def test_number_disjoint_groups_empty(self):
+        """Without groups, each cell is a set of its own."""
+        store = CellStore(lattice(rows=2, cols=3))
+        store.number()
+        store.numberDisjointGroups(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        np.testing.assert_array_equal(store.dj_cellnum, store.cellnum)
+
+
+class NeighbourTest(unittest.TestCase):
+    """Test the kept neighbours of the cells (neighbour fields and adjacency table)."""
+
+    def test_neighbours(self):
+        """The kept neighbour in each direction, -1 outside the lattice and for deleted cells."""
+        store = CellStore(lattice(rows=3, cols=3))
+        store.keep[store.cellIndex(0, 1)] = False
+        centre = [store.cellIndex(1, 1)]
+        found = {direction: int(store.neighbour(centre, di, dj)[0]) for (direction, di, dj) in NEIGHBOURS}
+        self.assertEqual(found, {'n': -1, 'ne': 2, 'e': 5, 'se': 8, 's': 7, 'sw': 6, 'w': 3, 'nw': 0})
+        corner = [store.cellIndex(2, 2)]
+        self.assertEqual([int(store.neighbour(corner, di, dj)[0]) for (direction, di, dj) in NEIGHBOURS],
+                         [5, -1, -1, -1, -1, -1, 7, 4])
+
+    def test_adjacency_symmetric(self):
+        """Each adjacency of kept cells is found from both cells, in opposite directions."""
+        store = CellStore(lattice(rows=6, cols=7))
+        store.keep[:] = np.random.default_rng(4).random(len(store)) < 0.6
+        kept = store.keptIndices()
+        directions = {(di, dj) for (direction, di, dj) in NEIGHBOURS}
+        self.assertEqual(len(directions), 8)
+        pairs = set()
+        for (direction, di, dj) in NEIGHBOURS:
+            self.assertIn((-di, -dj), directions)
+            nb = store.neighbour(kept, di, dj)
+            self.assertTrue(store.keep[nb[nb >= 0]].all())
+            pairs |= {(int(i), int(j)) for (i, j) in zip(kept, nb) if j >= 0}
+        self.assertEqual(pairs, {(j, i) for (i, j) in pairs})
+        # Kept cells are adjacent if their rows and columns differ by at most one
+        expected = {(int(i), int(j)) for i in kept for j in kept if i != j and
+                    abs(int(store.row[i]) - int(store.row[j])) <= 1 and abs(int(store.col[i]) - int(store.col[j])) <= 1}
+        self.assertEqual(pairs, expected)
+
+
+def rectArea(rects):
+    # clippedArea of an AoI of disjoint rectangles
+    def clippedArea(xmin, ymin, xmax, ymax):
+        return sum(max(0.0, min(xmax, x1) - max(xmin, x0)) * max(0.0, min(ymax, y1) - max(ymin, y0))
+                   for (x0, y0, x1, y1) in rects)
+    return clippedArea
+
+
+class CoveragePruningTest(unittest.TestCase):
+    """Test the deletion of sheets covered less than a minimum (the steps of GridCreator.deleteLowCoverage)."""
+
+    # A row of three cells 1000-1010, 1008-1018 and 1016-1026 from 4980 to 5000: A within cell 0, B in the
+    # overlap of cell 0 and 1 touching the core of cell 1, and C in the overlap of cell 1 and 2
+    A = (1000.0, 4980.0, 1007.0, 5000.0)
+    B = (1008.5, 4980.0, 1010.0, 5000.0)
+    C = (1016.5, 4980.0, 1017.5, 5000.0)
+
+    def survivors(self, rects, minCoverage):
+        store = CellStore(lattice(rows=1, cols=3))
+        clippedArea = rectArea(rects)
+        grid = store.lattice
+        for i in range(len(store)):
+            store.coverage[i] = clippedArea(*store.bounds(i)) / (grid.width * grid.height)
+        store.keep[:] = store.coverage > 0
+        for i in store.lowCoverage(minCoverage):
+            if store.coveredByOthers(i, clippedArea):
+                store.keep[i] = False
+        return store.keptIndices().tolist()
+
+    def test_coverage(self):
+        store = CellStore(lattice(rows=1, cols=3))
+        store.coverage[:] = [0.85, 0.25, 0.1]
+        np.testing.assert_array_equal(store.lowCoverage(0.3), [2, 1])
+        np.testing.assert_array_equal(store.lowCoverage(0.25), [2])
+
+    def test_threshold(self):
+        """A cell whose AoI is in a shared overlap and only touches its core is deleted below the threshold."""
+        # Coverage 0.85 and 0.15
+        self.assertEqual(self.survivors([self.A, self.B], 0.1), [0, 1])
+        self.assertEqual(self.survivors([self.A, self.B], 0.15), [0, 1])
+        self.assertEqual(self.survivors([self.A, self.B], 0.15 + 1e-9), [0])
+        self.assertEqual(self.survivors([self.A, self.B], 1.0), [0])
+
+    def test_least_covered_first(self):
+        """Of two cells sharing the only AoI in an overlap, the least covered is deleted."""
+        # Coverage 0.85, 0.25 and 0.1
+        self.assertEqual(self.survivors([self.A, self.B, self.C], 0.1), [0, 1, 2])
+        self.assertEqual(self.survivors([self.A, self.B, self.C], 0.1 + 1e-9), [0, 1])
+        self.assertEqual(self.survivors([self.A, self.B, self.C], 0.3), [0, 1])
+
+    def test_core_keeps_cell(self):
+        """A cell with AoI in its core is never deleted, and neither are cells without core."""
+        core = (1011.0, 4990.0, 1012.0, 5000.0)
+        self.assertEqual(self.survivors([self.A, core], 0.5), [0, 1])
+        store = CellStore(lattice(rows=1, cols=3, overlap=0.5))
+        store.coverage[:] = 0.01
+        np.testing.assert_array_equal(store.lowCoverage(0.5), [0, 2])
+
+
+class OverlapZoneTest(unittest.TestCase):
+    """Test the zones shared by overlapping cells."""
+
+    def test_cell_zones(self):
+        """The zones of a cell tile it, and each zone is shared with the cells overlapping it."""
+        store = CellStore(lattice())
+        grid = store.lattice
+        for i in (0, 7, len(store) - 1):
+            zones = store.cellZones(i)
+            area = sum((xmax - xmin) * (ymax - ymin) for ((xmin, ymin, xmax, ymax), others) in zones)
+            self.assertAlmostEqual(area, grid.width * grid.height)
+            for ((xmin, ymin, xmax, ymax), others) in zones:
+                (cx, cy) = ((xmin + xmax) / 2, (ymin + ymax) / 2)
+                (rows, cols) = grid.cellsAt([cx], [cy])
+                containing = {int(r) * grid.cols + int(c) for (r, c) in zip(rows[0], cols[0]) if r >= 0}
+                self.assertEqual(containing, {i} | set(others))
+
+    def test_cell_zones_without_overlap(self):
+        """Without overlap, the core is the only zone."""
+        store = CellStore(lattice(overlap=0))
+        self.assertEqual(store.cellZones(7), [(store.lattice.cellBounds(1, 2), [])])
+
+    def test_overlap_zones(self):
+        """Zones where no sharing cell is kept are generated, and keepZone keeps the last cell."""
+        store = CellStore(lattice(rows=2, cols=2))
+        store.keep[:] = False
+        zones = list(store.overlapZones())
+        # East zone of cell 0 and 2, south zone of cell 0 and 1 and the central corner
+        self.assertEqual(sorted(sharing for (bounds, sharing) in zones),
+                         [[0, 1], [0, 1, 2, 3], [0, 2], [1, 3], [2, 3]])
+        (bounds, sharing) = next(zone for zone in zones if len(zone[1]) == 4)
+        store.keepZone(sharing)
+        np.testing.assert_array_equal(store.keep, [False, False, False, True])
+        # Zones shared with a kept cell are no longer generated
+        self.assertEqual(sorted(sharing for (bounds, sharing) in store.overlapZones()), [[0, 1], [0, 2]])
+
+    def test_overlap_zones_select(self):
+        """Only the zones selected by their bounds are generated."""
+        store = CellStore(lattice(rows=3, cols=3))
+        store.keep[:] = False
+        zones = list(store.overlapZones())
+        west = list(store.overlapZones(lambda xmin, ymin, xmax, ymax: xmax <= 1010.0))
+        self.assertEqual(west, [zone for zone in zones if zone[0][2] <= 1010.0])
+        self.assertTrue(0 < len(west) < len(zones))
+
+    def test_half_overlap(self):
+        """With 50% overlap, the interior cells have no core and are never deleted."""
+        store = CellStore(lattice(rows=3, cols=4, overlap=0.5))
+        degenerate = store.degenerateCores().reshape(3, 4)
+        expected = np.zeros((3, 4), dtype=bool)
+        expected[1, :] = expected[:, 1:3] = True
+        np.testing.assert_array_equal(degenerate, expected)
+        # The corner cells keep a core of a quarter of the sheet
+        np.testing.assert_allclose(store.lattice.coreBounds(0, 0), (1000.0, 4990.0, 1005.0, 5000.0))
+
+        intersecting = np.zeros(len(store), dtype=bool)
+        intersecting[store.cellIndex(2, 3)] = True
+        store.keepCores(intersecting)
+        np.testing.assert_array_equal(store.keep, expected.ravel() | intersecting)
+        candidates = np.zeros(len(store), dtype=bool)
+        candidates[:4] = True
+        store.keepCores(intersecting, candidates)
+        np.testing.assert_array_equal(store.keep, (expected.ravel() | intersecting) & candidates)
+
+        # Zones without area are not generated
+        store.keep[:] = False
+        for ((xmin, ymin, xmax, ymax), sharing) in store.overlapZones():
+            self.assertTrue(xmin < xmax and ymin < ymax)
+
+    def test_child_candidates(self):
+        """The children of the kept cells and of their neighbours are candidates."""
+        store = CellStore(lattice(rows=4, cols=4))
+        store.keep[:] = False
+        store.keep[store.cellIndex(0, 0)] = True
+        candidates = store.childCandidates(2).reshape(8, 8)
+        expected = np.zeros((8, 8), dtype=bool)
+        expected[:4, :4] = True
+        np.testing.assert_array_equal(candidates, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+# coding=utf-8
+"""Tests of the registration of the expression functions, which need QGIS.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'morten@styrke10.dk'
+__date__ = '2024-06-24'
+__copyright__ = 'Copyright 2024, Styrke10 ApS'
+
+import unittest
+
+from qgis.PyQt.QtCore import QSettings
+from qgis.core import QgsExpression
+
+from .. import classFactory
+
+from .utilities import get_qgis_app
+QGIS_APP = get_qgis_app()
+
+
+class PluginInterface():
+    """The parts of the QGIS interface used when the plugin is loaded and unloaded."""
+
+    def mainWindow(self):
+        return None
+
+    def addToolBarIcon(self, action):
+        pass
+
+    def removeToolBarIcon(self, action):
+        pass
+
+    def addPluginToMenu(self, menu, action):
+        pass
+
+    def removePluginMenu(self, menu, action):
+        pass
+
+
+class RegistrationTest(unittest.TestCase):
+    """Test that desktop QGIS gets the expression functions."""
+
+    def setUp(self):
+        if QSettings().value('locale/userLocale') is None:
+            QSettings().setValue('locale/userLocale', 'en_US')
+
+    def test_registered_by_init_gui(self):
+        """Desktop QGIS only calls initGui (the plugin has no hasProcessingProvider=yes)."""
+        plugin = classFactory(PluginInterface())
+        plugin.initGui()
+        try:
+            for name in ('atlasgrid_sheet_at', 'atlasgrid_neighbor', 'atlasgrid_sheet_extent'):
+                self.assertTrue(QgsExpression.isFunctionName(name), name)
+        finally:
+            plugin.unload()
+        self.assertFalse(QgsExpression.isFunctionName('atlasgrid_sheet_at'))
+
+
+if __name__ == "__main__":
+    unittest.main()
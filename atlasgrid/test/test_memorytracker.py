@@ -0,0 +1,86 @@
+# coding=utf-8
+"""Tests of the memory tracking of the stages of a run.
+
+The tests only need the standard library, e.g. with pytest from the repository root.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'morten@styrke10.dk'
+__date__ = '2024-06-24'
+__copyright__ = 'Copyright 2024, Styrke10 ApS'
+
+import sys
+import tracemalloc
+import unittest
+
+from memorytracker import MemoryTracker, processMemory, MB
+
+
+class MemoryTrackerTest(unittest.TestCase):
+    """Test the tracing of the stages and its sharing between concurrent runs."""
+
+    def tearDown(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def test_stage_peak(self):
+        """The peak of a stage includes its temporary allocations."""
+        tracker = MemoryTracker()
+        tracker.start()
+        with tracker.stage('Allocate'):
+            data = bytearray(8 * MB)
+            del data
+        tracker.stop()
+        self.assertFalse(tracemalloc.is_tracing())
+        (stage,) = tracker.stages
+        self.assertEqual(stage['stage'], 'Allocate')
+        self.assertGreaterEqual(stage['python_peak'], 8 * MB)
+        self.assertLess(stage['python_exit'] - stage['python_entry'], MB)
+        self.assertFalse(stage['shared'])
+        self.assertEqual(tracker.peakPython(), stage['python_peak'])
+        self.assertEqual(len(tracker.report().splitlines()), 2)
+
+    def test_concurrent_trackers(self):
+        """Tracing stops with the last tracker, and the peak is not reset while another tracker is active."""
+        (first, second) = (MemoryTracker(), MemoryTracker())
+        first.start()
+        second.start()
+        with first.stage('First'):
+            pass
+        first.stop()
+        self.assertTrue(tracemalloc.is_tracing())
+        with second.stage('Second'):
+            pass
+        second.stop()
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertTrue(first.stages[0]['shared'])
+        self.assertFalse(second.stages[0]['shared'])
+        self.assertIn('*', first.report())
+        # Stopping twice does not stop the tracing of others
+        second.start()
+        first.stop()
+        self.assertTrue(tracemalloc.is_tracing())
+        second.stop()
+
+    def test_tracing_started_elsewhere(self):
+        """Tracing started before the tracker is left on."""
+        tracemalloc.start()
+        tracker = MemoryTracker()
+        tracker.start()
+        tracker.stop()
+        self.assertTrue(tracemalloc.is_tracing())
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'The RSS is read from /proc on Linux')
+    def test_process_memory(self):
+        (rss, peakRss) = processMemory()
+        self.assertGreater(rss, 0)
+        self.assertGreaterEqual(peakRss, rss)
+
+
+if __name__ == "__main__":
+    unittest.main()
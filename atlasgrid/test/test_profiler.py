@@ -0,0 +1,70 @@
+# coding=utf-8
+"""Tests of the profiling of runs.
+
+The tests only need the standard library, e.g. with pytest from the repository root.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'morten@styrke10.dk'
+__date__ = '2024-06-24'
+__copyright__ = 'Copyright 2024, Styrke10 ApS'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from profiler import Profiler
+
+
+def work():
+    return sum(i * i for i in range(20000))
+
+
+class ProfilerTest(unittest.TestCase):
+    """Test the profile and its summary, and runs profiled at the same time."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_profile(self):
+        """The profile and the summary are written."""
+        path = os.path.join(self.directory, 'run.pstats')
+        with Profiler(path) as profiler:
+            work()
+        self.assertTrue(profiler.profiled())
+        self.assertTrue(os.path.exists(path))
+        with open(profiler.summaryPath(), encoding='utf-8') as f:
+            self.assertEqual(f.read(), profiler.summary())
+        self.assertIn('work', profiler.summary())
+
+    def test_without_path(self):
+        with Profiler() as profiler:
+            work()
+        self.assertFalse(profiler.profiled())
+        self.assertIsNone(profiler.summary())
+
+    def test_nested_runs(self):
+        """Only one run is profiled at a time, and the profiler is free again afterwards."""
+        (outer, inner) = (os.path.join(self.directory, 'outer.pstats'), os.path.join(self.directory, 'inner.pstats'))
+        with Profiler(outer) as outerProfiler:
+            with Profiler(inner) as innerProfiler:
+                work()
+        self.assertTrue(outerProfiler.profiled())
+        self.assertFalse(innerProfiler.profiled())
+        self.assertFalse(os.path.exists(inner))
+        with Profiler(inner) as profiler:
+            work()
+        self.assertTrue(profiler.profiled())
+
+
+if __name__ == "__main__":
+    unittest.main()
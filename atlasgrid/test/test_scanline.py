@@ -0,0 +1,260 @@
+# coding=utf-8
+"""Tests of the scanline rasterization of the AoI, compared with brute-force tests of each zone.
+
+The tests only need NumPy, e.g. from the plugin directory:
+
+    PYTHONPATH=. python -m unittest discover -s test -p test_scanline.py
+
+or with pytest from the repository root (test/conftest.py puts the plugin directory on the path).
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'morten@styrke10.dk'
+__date__ = '2024-06-24'
+__copyright__ = 'Copyright 2024, Styrke10 ApS'
+
+import unittest
+
+import numpy as np
+
+from cellstore import Lattice, CellStore
+from scanline import Raster, ZoneRaster, NetCellRaster, PixelRaster, OUTSIDE, INSIDE, BOUNDARY
+
+
+def star(cx, cy, rMin, rMax, n, rng):
+    # A closed ring with n vertices at random radii around a center
+    angles = np.sort(rng.uniform(0, 2 * np.pi, n))
+    radii = rng.uniform(rMin, rMax, n)
+    (x, y) = (cx + radii * np.cos(angles), cy + radii * np.sin(angles))
+    return (np.append(x, x[0]), np.append(y, y[0]))
+
+
+def aoi(cx, cy, r, seed):
+    # Two overlapping parts, the first with a hole, and a line
+    rng = np.random.default_rng(seed)
+    rings = [(0,) + star(cx, cy, 0.6 * r, r, 40, rng),
+             (0,) + star(cx, cy, 0.1 * r, 0.4 * r, 12, rng),
+             (1,) + star(cx + 0.8 * r, cy - 0.5 * r, 0.3 * r, 0.6 * r, 20, rng)]
+    paths = [(rng.uniform(cx - 2 * r, cx + 2 * r, 6), rng.uniform(cy - 2 * r, cy + 2 * r, 6))]
+    return (rings, paths)
+
+
+def segmentIntersectsRect(x0, y0, x1, y1, xmin, ymin, xmax, ymax):
+    # Liang-Barsky clipping of the segment to the closed rectangle
+    (t0, t1) = (0.0, 1.0)
+    for (p, q) in ((x0 - x1, x0 - xmin), (x1 - x0, xmax - x0), (y0 - y1, y0 - ymin), (y1 - y0, ymax - y0)):
+        if p == 0:
+            if q < 0:
+                return False
+        elif p < 0:
+            t0 = max(t0, q / p)
+        else:
+            t1 = min(t1, q / p)
+    return t0 <= t1
+
+
+def insideRings(x, y, rings):
+    # Even-odd rule within each part, and the union of the parts
+    crossings = {}
+    for (part, xs, ys) in rings:
+        for k in range(len(xs) - 1):
+            (ya, yb) = sorted((ys[k], ys[k + 1]))
+            if ya <= y < yb:
+                xc = xs[k] + (y - ys[k]) * (xs[k + 1] - xs[k]) / (ys[k + 1] - ys[k])
+                if xc <= x:
+                    crossings[part] = crossings.get(part, 0) + 1
+    return any(n % 2 == 1 for n in crossings.values())
+
+
+def bruteForceState(xmin, ymin, xmax, ymax, rings, paths):
+    segments = [(xs, ys) for (part, xs, ys) in rings] + list(paths)
+    for (xs, ys) in segments:
+        for k in range(len(xs) - 1):
+            if segmentIntersectsRect(xs[k], ys[k], xs[k + 1], ys[k + 1], xmin, ymin, xmax, ymax):
+                return BOUNDARY
+    return INSIDE if insideRings((xmin + xmax) / 2, (ymin + ymax) / 2, rings) else OUTSIDE
+
+
+class RasterTest(unittest.TestCase):
+    """Test the classification of the zones of an irregular rectilinear grid."""
+
+    def test_states(self):
+        """Each zone is classified as by a brute-force test, including zones of zero width."""
+        rng = np.random.default_rng(2)
+        xs = np.sort(np.concatenate((rng.uniform(0, 100, 25), [40.0, 40.0])))
+        ys = np.sort(rng.uniform(0, 100, 25))
+        (rings, paths) = aoi(50, 50, 35, 3)
+        raster = Raster(xs, ys, rings, paths)
+        for r in range(len(ys) - 1):
+            for k in range(len(xs) - 1):
+                self.assertEqual(raster.states[r, k], bruteForceState(xs[k], ys[r], xs[k + 1], ys[r + 1], rings, paths), (r, k))
+
+    def test_all_states_occur(self):
+        """The test AoI has zones of all three states."""
+        xs = np.linspace(0, 100, 41)
+        (rings, paths) = aoi(50, 50, 35, 3)
+        self.assertEqual(set(np.unique(Raster(xs, xs, rings, paths).states)), {OUTSIDE, INSIDE, BOUNDARY})
+
+
+class ZoneRasterTest(unittest.TestCase):
+    """Test the classification of the cores and overlaps of the cells of a lattice."""
+
+    def check(self, overlap):
+        grid = Lattice(0.0, 100.0, 10.0, 8.0, 10.0 * (1 - overlap), 8.0 * (1 - overlap), 12, 12)
+        (xmin, ymin, xmax, ymax) = grid.cellBounds(grid.rows - 1, grid.cols - 1)
+        (cx, cy) = ((grid.xMin + xmax) / 2, (ymin + grid.yMax) / 2)
+        (rings, paths) = aoi(cx, cy, (xmax - grid.xMin) / 3, 5)
+        raster = ZoneRaster(grid, rings, paths)
+        states = raster.coreStates()
+        for row in range(grid.rows):
+            for col in range(grid.cols):
+                bounds = tuple(float(b) for b in grid.coreBounds(row, col))
+                self.assertEqual(states[row, col], bruteForceState(*bounds, rings, paths), (overlap, row, col))
+                if bounds[0] < bounds[2] and bounds[1] < bounds[3]:
+                    self.assertEqual(raster.state(*bounds), states[row, col])
+
+        # The overlap zones shared by the cells
+        store = CellStore(grid)
+        store.keep[:] = False
+        zones = [bounds for (bounds, sharing) in store.overlapZones()]
+        if zones:
+            found = raster.zoneStates(*np.transpose(zones))
+            for (bounds, state) in zip(zones, found):
+                self.assertEqual(state, bruteForceState(*bounds, rings, paths), (overlap, bounds))
+        return states
+
+    def test_core_states_without_overlap(self):
+        states = self.check(0)
+        self.assertTrue((states == INSIDE).any())
+
+    def test_core_states_with_overlap(self):
+        """With overlap, the overlap zones are classified as well."""
+        self.check(0.2)
+
+    def test_core_states_with_half_overlap(self):
+        """With 50% overlap, the cores of the interior cells have zero width and height."""
+        self.check(0.5)
+
+
+class NetCellRasterTest(unittest.TestCase):
+    """Test the classification of the net cells of a range of a lattice (used for the disjoint numbering)."""
+
+    def test_cell_states(self):
+        """Each net cell of the range is classified as by a brute-force test."""
+        found = set()
+        for overlap in (0, 0.2, 0.5):
+            grid = Lattice(0.0, 100.0, 10.0, 8.0, 10.0 * (1 - overlap), 8.0 * (1 - overlap), 14, 14)
+            (rings, paths) = aoi(40, 60, 20, 12)
+            # The range of the net cells within the bounding box of the AoI, without the outer ones
+            (row0, row1, col0, col1) = grid.indexRange(15.0, 30.0, 70.0, 85.0, net=True)
+            (row0, row1, col0, col1) = (row0 + 1, row1 - 1, col0 + 1, col1 - 1)
+            states = NetCellRaster(grid, row0, row1, col0, col1, rings, paths).cellStates()
+            self.assertEqual(states.shape, (row1 - row0 + 1, col1 - col0 + 1))
+            for row in range(row0, row1 + 1):
+                for col in range(col0, col1 + 1):
+                    bounds = tuple(float(b) for b in grid.netCellBounds(row, col))
+                    self.assertEqual(states[row - row0, col - col0], bruteForceState(*bounds, rings, paths), (overlap, row, col))
+            found |= set(np.unique(states))
+        self.assertEqual(found, {OUTSIDE, INSIDE, BOUNDARY})
+
+
+class PixelRasterTest(unittest.TestCase):
+    """Test the conservative pixel sums over rectangles."""
+
+    def test_sums(self):
+        """touchedSum is positive for rectangles intersecting the AoI, and insideSum only for those."""
+        (rings, paths) = aoi(50, 50, 35, 7)
+        raster = PixelRaster(0.0, 0.0, 100.0, 100.0, 2.5, rings, paths)
+        rng = np.random.default_rng(8)
+        # Rectangles within the raster (the AoI outside it is not rasterized)
+        (xmin, ymin) = (rng.uniform(0, 85, 400), rng.uniform(0, 85, 400))
+        (xmax, ymax) = (xmin + rng.uniform(0, 15, 400), ymin + rng.uniform(0, 15, 400))
+        touched = raster.touchedSum(xmin, ymin, xmax, ymax)
+        inside = raster.insideSum(xmin, ymin, xmax, ymax)
+        for k in range(len(xmin)):
+            intersects = bruteForceState(xmin[k], ymin[k], xmax[k], ymax[k], rings, paths) != OUTSIDE
+            if intersects:
+                self.assertGreater(touched[k], 0, k)
+            if inside[k] > 0:
+                self.assertTrue(intersects, k)
+        self.assertTrue((inside > 0).any() and (touched == 0).any())
+
+    def test_sums_over_pixels(self):
+        """The sums over single pixels are those of the dilated and the inside bitmap."""
+        (rings, paths) = aoi(50, 50, 35, 7)
+        raster = PixelRaster(0.0, 0.0, 100.0, 100.0, 5.0, rings, paths)
+        (ny, nx) = raster.states.shape
+        (row, col) = np.meshgrid(np.arange(ny), np.arange(nx), indexing='ij')
+        (xmin, ymin) = (raster.xs[col], raster.ys[row])
+        inside = raster.insideSum(xmin, ymin, xmin + 5.0, ymin + 5.0)
+        np.testing.assert_array_equal(inside, raster.states == INSIDE)
+        # Every pixel within one pixel of a set pixel is touched
+        bitmap = np.pad(raster.states != OUTSIDE, 1)
+        dilated = np.zeros((ny, nx), dtype=bool)
+        for dr in (0, 1, 2):
+            for dc in (0, 1, 2):
+                dilated |= bitmap[dr:dr + ny, dc:dc + nx]
+        touched = raster.touchedSum(xmin + 1.0, ymin + 1.0, xmin + 4.0, ymin + 4.0)
+        np.testing.assert_array_equal(touched > 0, dilated)
+
+
+class ApproximateClassificationTest(unittest.TestCase):
+    """Test the classification of the cells on the pixel sums, as in approximate mode."""
+
+    def classify(self, overlap, pixelSize):
+        # The steps of GridCreator.identifyCellsToDeleteApproximately on a grid fitted to the AoI
+        grid = Lattice(0.0, 100.0, 10.0, 8.0, 10.0 * (1 - overlap), 8.0 * (1 - overlap), 12, 12)
+        (xmin, ymin, xmax, ymax) = grid.cellBounds(grid.rows - 1, grid.cols - 1)
+        (rings, paths) = aoi((grid.xMin + xmax) / 2, (ymin + grid.yMax) / 2, (xmax - grid.xMin) / 3, 11)
+        raster = PixelRaster(grid.xMin, ymin, xmax, grid.yMax, pixelSize, rings, paths)
+        store = CellStore(grid)
+        store.keepCores(raster.touchedSum(*grid.coreBounds(store.row, store.col)) > 0)
+        for (bounds, sharing) in store.overlapZones(lambda *b: raster.touchedSum(*b) > 0):
+            store.keepZone(sharing)
+        return (store, rings, paths)
+
+    def check(self, overlap, pixelSize):
+        (store, rings, paths) = self.classify(overlap, pixelSize)
+        grid = store.lattice
+        (xmin, ymin, xmax, ymax) = grid.cellBounds(grid.rows - 1, grid.cols - 1)
+
+        # No sheet intersecting the AoI is deleted: every point on the boundary of the AoI, on the
+        # lines and inside the AoI is on a kept sheet
+        (x, y) = ([], [])
+        for (xs, ys) in [(xs, ys) for (part, xs, ys) in rings] + list(paths):
+            t = np.linspace(0, 1, 20, endpoint=False)
+            x.append((xs[:-1, None] + np.outer(np.diff(xs), t)).ravel())
+            y.append((ys[:-1, None] + np.outer(np.diff(ys), t)).ravel())
+        (gx, gy) = np.meshgrid(np.linspace(grid.xMin, xmax, 60), np.linspace(ymin, grid.yMax, 60))
+        inside = [insideRings(px, py, rings) for (px, py) in zip(gx.ravel(), gy.ravel())]
+        x = np.concatenate(x + [gx.ravel()[inside]])
+        y = np.concatenate(y + [gy.ravel()[inside]])
+        within = (x >= grid.xMin) & (x <= xmax) & (y >= ymin) & (y <= grid.yMax)
+        (rows, cols) = grid.cellsAt(x[within], y[within])
+        kept = np.where(rows >= 0, store.keep[np.where(rows >= 0, store.cellIndex(rows, cols), 0)], False)
+        self.assertTrue(kept.any(axis=1).all(), (overlap, pixelSize))
+
+        # A kept sheet is within two pixels of the AoI (sheets without a core are never deleted)
+        for i in np.flatnonzero(store.keep & ~store.degenerateCores()):
+            (xmin, ymin, xmax, ymax) = store.bounds(i)
+            d = 2 * pixelSize
+            self.assertNotEqual(bruteForceState(xmin - d, ymin - d, xmax + d, ymax + d, rings, paths), OUTSIDE, (overlap, i))
+        return store
+
+    def test_keeps_sheets_intersecting(self):
+        self.assertTrue(0 < np.count_nonzero(self.check(0.2, 2.0).keep) < 144)
+
+    def test_keeps_sheets_intersecting_without_overlap(self):
+        self.check(0, 1.5)
+
+    def test_keeps_sheets_intersecting_with_half_overlap(self):
+        self.check(0.5, 2.0)
+
+
+if __name__ == "__main__":
+    unittest.main()